@@ -0,0 +1,80 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Compare the command line built from the compiled command plans with the
+previous builder, that walked command_builder and converted every option on
+each start, for the main brick types.
+
+    python benchmarks/bench_cmdline.py [--number N] [--repeat N]
+"""
+
+import argparse
+import timeit
+
+from twisted.internet import defer
+
+from virtualbricks import brickfactory
+
+
+def legacy_build_cmd_line(brick):
+    res = []
+    for switch, value in brick.command_builder.items():
+        if not switch.startswith("#"):
+            if callable(value):
+                value = value()
+            else:
+                value = brick.config.get(value)
+            if value == "*":
+                res.append(switch)
+            elif value is not None and len(value) > 0:
+                if not switch.startswith("*"):
+                    res.append(switch)
+                res.append(value)
+    return res
+
+
+def bench(name, func, number, repeat):
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    print("%-32s %8.2f us" % (name, best / number * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--number", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    factory = brickfactory.BrickFactory(defer.Deferred())
+    bricks = [factory.new_brick(type, type.lower()) for type in
+              ("Switch", "Tap", "Capture", "TunnelConnect", "Qemu")]
+    vm = bricks[-1]
+    vm.prog = lambda: "qemu-system-x86_64"
+    vm.config["kvm"] = True
+    for brick in bricks:
+        assert legacy_build_cmd_line(brick) == brick.build_cmd_line(), \
+            brick.get_type()
+        bench("legacy %s" % brick.get_type(),
+              lambda: legacy_build_cmd_line(brick), args.number, args.repeat)
+        bench("compiled %s" % brick.get_type(), brick.build_cmd_line,
+              args.number, args.repeat)
+    bench("qemu argv", lambda: vm._VirtualMachine__args([]), args.number,
+          args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Compare the project file parser with the previous one, that called tell()
+before every line and seeked back at the end of every section, on a
+synthetic project.
+
+    python benchmarks/bench_configparser.py [--sections N] [--repeat N]
+"""
+
+import argparse
+import io
+import os
+import re
+import tempfile
+import timeit
+
+from virtualbricks import _configparser
+
+
+class LegacySection:
+
+    EMPTY = re.compile(r"^\s*$")
+    CONFIG_LINE = re.compile(r"^(\w+)\s*=\s*(.*)$")
+
+    def __init__(self, type, name, fileobj):
+        self.type = type
+        self.name = name
+        self.fileobj = fileobj
+
+    def __iter__(self):
+        curpos = self.fileobj.tell()
+        line = self.fileobj.readline()
+        while line:
+            if line.startswith("#") or self.EMPTY.match(line):
+                curpos = self.fileobj.tell()
+                line = self.fileobj.readline()
+                continue
+            match = self.CONFIG_LINE.match(line)
+            if match:
+                yield match.groups()
+                curpos = self.fileobj.tell()
+                line = self.fileobj.readline()
+            else:
+                self.fileobj.seek(curpos)
+                return
+
+
+class LegacyParser:
+
+    EMPTY = re.compile(r"^\s*$")
+    SECTION_HEADER = _configparser.SECTION_HEADER
+    LINK = _configparser.LINK
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def __iter__(self):
+        line = self.fileobj.readline()
+        while line:
+            if line.startswith('#') or self.EMPTY.match(line):
+                line = self.fileobj.readline()
+                continue
+            match = self.SECTION_HEADER.match(line)
+            if match:
+                yield LegacySection(match.group(1), match.group(2),
+                                    self.fileobj)
+            else:
+                match = self.LINK.match(line)
+                if match:
+                    yield _configparser.Link._make(match.groups())
+            line = self.fileobj.readline()
+
+
+def synthetic_project(sections):
+    buf = io.StringIO()
+    for i in range(sections):
+        if i % 3 == 0:
+            buf.write("[Switch:sw%d]\nnumports=32\nfstp=*\n\n" % i)
+        else:
+            buf.write("[Qemu:vm%d]\nhda=image\nprivatehda=*\nram=512\n"
+                      "smp=2\nkvm=*\nname=vm%d\n\n" % (i, i))
+    for i in range(sections):
+        if i % 3:
+            buf.write("link|vm%d|sw%d_port|rtl8139|00:aa:00:00:%02x:%02x\n" %
+                      (i, i - i % 3, i // 256 % 256, i % 256))
+    return buf.getvalue()
+
+
+def consume(parser):
+    count = 0
+    for item in parser:
+        if not isinstance(item, tuple):
+            for _ in item:
+                count += 1
+        count += 1
+    return count
+
+
+def bench(name, factory, open_project, repeat):
+
+    def run():
+        with open_project() as fp:
+            return consume(factory(fp))
+
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    print("%-24s %8.2f ms" % (name, best * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sections", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    text = synthetic_project(args.sections)
+    print("%d sections, %d lines, %d bytes" % (
+        args.sections, text.count("\n"), len(text)))
+    legacy = consume(LegacyParser(io.StringIO(text)))
+    current = consume(_configparser.Parser(io.StringIO(text)))
+    assert legacy == current, (legacy, current)
+    fd, path = tempfile.mkstemp(suffix=".project")
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(text)
+        for source, open_project in (
+                ("memory", lambda: io.StringIO(text)),
+                ("file", lambda: open(path))):
+            bench("legacy (%s)" % source, LegacyParser, open_project,
+                  args.repeat)
+            bench("single pass (%s)" % source, _configparser.Parser,
+                  open_project, args.repeat)
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
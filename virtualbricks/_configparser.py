@@ -16,57 +16,70 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import re
+"""
+Parser of the project files.
+
+The file is read once, line by line, and never seeks, so it can be a pipe or
+a compressed stream. The sections and the links are yielded as soon as they
+are read and carry the number of the line they start at, for the
+diagnostics.
+
+The same sections and links can be saved in a snapshot, a JSON lines file
+that is loaded without any regular expression.
+"""
+
 import collections
+import json
+import re
+
+from virtualbricks import log
 
 __metaclass__ = type
 
+logger = log.Logger()
+skip_line = log.Event("Skipping invalid line {lineno}: {line!r}")
+
+
+CONFIG_LINE = re.compile(r"^(\w+)\s*=\s*(.*)$")
+SECTION_HEADER = re.compile(r"^\[([a-zA-Z0-9_]+):(.+)\]$")
+LINK = re.compile(r"^(?P<type>link|sock)\|"
+                  r"(?P<owner>[a-zA-Z][\w.-]*)\|"
+                  r"(?P<sockname>[a-zA-Z_][\w.-]*)\|"
+                  r"(?P<model>\w*)\|"
+                  "(?P<mac>(?:(?:[0-9a-hA-H]{2}:){5}[0-9a-hA-H]{2})|)$")
+LINK_PREFIXES = ("link|", "sock|")
+
 
 class Section:
+    """
+    A brick, event or image section, iterating over it yields the (name,
+    value) pairs of its parameters.
 
-    EMPTY = re.compile(r"^\s*$")
-    CONFIG_LINE = re.compile(r"^(\w+)\s*=\s*(.*)$")
+    @ivar lineno: the line of the section header.
+    """
 
-    def __init__(self, type, name, fileobj):
+    def __init__(self, type, name, lineno=None):
         self.type = type
         self.name = name
-        self.fileobj = fileobj
+        self.lineno = lineno
+        self.items = []
 
     def __iter__(self):
-        curpos = self.fileobj.tell()
-        line = self.fileobj.readline()
-        while line:
-            if line.startswith("#") or self.EMPTY.match(line):
-                curpos = self.fileobj.tell()
-                line = self.fileobj.readline()
-                continue
-            match = self.CONFIG_LINE.match(line)
-            if match:
-                name, value = match.groups()
-                if value is None:
-                    # value is None when the parameter is not set
-                    value = ""
-                yield name, value
-                curpos = self.fileobj.tell()
-                line = self.fileobj.readline()
-            else:
-                self.fileobj.seek(curpos)
-                return
+        return iter(self.items)
 
 
-Link = collections.namedtuple("Link", ["type", "owner", "sockname", "model",
-                                       "mac"])
+class Link(collections.namedtuple("Link", ["type", "owner", "sockname",
+                                           "model", "mac"])):
+    """
+    A link or sock line.
 
+    @ivar lineno: the line of the link, it is not part of the tuple.
+    """
 
-class Parser:
+    lineno = None
 
-    EMPTY = re.compile(r"^\s*$")
-    SECTION_HEADER = re.compile(r"^\[([a-zA-Z0-9_]+):(.+)\]$")
-    LINK = re.compile(r"^(?P<type>link|sock)\|"
-                      r"(?P<owner>[a-zA-Z][\w.-]*)\|"
-                      r"(?P<sockname>[a-zA-Z_][\w.-]*)\|"
-                      r"(?P<model>\w*)\|"
-                      "(?P<mac>(?:(?:[0-9a-hA-H]{2}:){5}[0-9a-hA-H]{2})|)$")
+
+class Parser:
 
     def __init__(self, fileobj):
         self.fileobj = fileobj
@@ -77,16 +90,110 @@ class Parser:
         second kind of section.
         """
 
-        line = self.fileobj.readline()
-        while line:
-            if line.startswith('#') or self.EMPTY.match(line):
-                line = self.fileobj.readline()
+        match_config = CONFIG_LINE.match
+        section = items = None
+        for lineno, line in enumerate(self.fileobj, 1):
+            # most of the lines are parameters, try them first
+            if items is not None:
+                match = match_config(line)
+                if match:
+                    items.append(match.groups())
+                    continue
+            if line.startswith("#") or not line.strip():
                 continue
-            match = self.SECTION_HEADER.match(line)
-            if match:
-                yield Section(match.group(1), match.group(2), self.fileobj)
-            else:
-                match = self.LINK.match(line)
+            if section is not None:
+                # any other line ends the section
+                yield section
+                section = items = None
+            if line.startswith("["):
+                match = SECTION_HEADER.match(line)
+                if match:
+                    section = Section(match.group(1), match.group(2), lineno)
+                    items = section.items
+                    continue
+            elif line.startswith(LINK_PREFIXES):
+                match = LINK.match(line)
                 if match:
-                    yield Link._make(match.groups())
-            line = self.fileobj.readline()
+                    link = Link._make(match.groups())
+                    link.lineno = lineno
+                    yield link
+                    continue
+            logger.debug(skip_line, lineno=lineno, line=line)
+        if section is not None:
+            yield section
+
+
+SNAPSHOT_VERSION = 1
+
+
+_encode = json.JSONEncoder(separators=(",", ":")).encode
+
+
+def snapshot_record(item):
+    """
+    Return the line of the snapshot of a section or a link.
+
+    :type item: Union[Section, Link]
+    :rtype: str
+    """
+
+    if isinstance(item, Link):
+        return _encode(item)
+    return _encode({"type": item.type, "name": item.name,
+                    "items": item.items})
+
+
+def write_snapshot(records, fileobj):
+    """
+    Write the records in fileobj, the first line is a header with the
+    version of the format and every other line is a section or a link.
+
+    :type records: Iterable[str]
+    :type fileobj: io.TextIOBase
+    """
+
+    lines = [_encode({"version": SNAPSHOT_VERSION})]
+    lines.extend(records)
+    lines.append("")
+    fileobj.write("\n".join(lines))
+
+
+def dump_snapshot(items, fileobj):
+    """
+    Write the sections and the links in fileobj.
+
+    :type items: Iterable[Union[Section, Link]]
+    :type fileobj: io.TextIOBase
+    """
+
+    write_snapshot(map(snapshot_record, items), fileobj)
+
+
+def load_snapshot(fileobj):
+    """
+    Read a snapshot written by dump_snapshot. The whole file is read before
+    returning so that a corrupted snapshot is never partially loaded.
+
+    :type fileobj: io.TextIOBase
+    :rtype: List[Union[Section, Link]]
+    :raises ValueError: if the snapshot is corrupted or its version is not
+        supported.
+    """
+
+    lines = iter(fileobj)
+    header = json.loads(next(lines, "{}"))
+    if header.get("version") != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported snapshot version %r" %
+                         header.get("version"))
+    result = []
+    for lineno, line in enumerate(lines, 2):
+        record = json.loads(line)
+        if isinstance(record, list):
+            link = Link._make(record)
+            link.lineno = lineno
+            result.append(link)
+        else:
+            section = Section(record["type"], record["name"], lineno)
+            section.items = [tuple(item) for item in record["items"]]
+            result.append(section)
+    return result
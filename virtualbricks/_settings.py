@@ -54,6 +54,14 @@ DEFAULT_CONF = {
     "show_missing": True,
     "qemupath": "/usr/bin",
     "vdepath": "/usr/bin",
+    "startconcurrency": 8,
+    "stopconcurrency": 8,
+    "prepareconcurrency": 4,
+    "fsync": True,
+    "projectsnapshot": True,
+    "sampleinterval": 5,
+    "samplehistory": 120,
+    "loglines": 10000,
 }
 
 
@@ -78,7 +86,8 @@ class SettingsMeta(type):
 class Settings(metaclass=SettingsMeta):
 
     __boolean_values__ = ('kvm', 'ksm', 'python', 'femaleplugs',
-                          'erroronloop', 'systray', 'show_missing')
+                          'erroronloop', 'systray', 'show_missing', 'fsync',
+                          'projectsnapshot')
     DEFAULT_SECTION = "Main"
     DEFAULT_PROJECT = DEFAULT_PROJECT
     VIRTUALBRICKS_HOME = VIRTUALBRICKS_HOME
@@ -36,12 +36,36 @@ def file_logger():
     return log.FileLogObserver(_log_file)
 
 
-def _file_logger(filename):
+def async_file_logger():
+    from virtualbricks import log
+
+    return log.AsyncFileLogObserver(_log_file)
+
+
+def json_logger():
+    from virtualbricks import log
+
+    return log.JSONLogObserver(_log_file)
+
+
+def async_json_logger():
+    from virtualbricks import log
+
+    return log.AsyncJSONLogObserver(_log_file)
+
+
+def _file_logger(filename, rotate_length=1000000, max_rotated=None,
+                 sync=False, json=False):
     if filename != "-":
         from twisted.python import logfile
         global _log_file
-        _log_file = logfile.LogFile.fromFullPath(filename)
-    return "virtualbricks.app.file_logger"
+        _log_file = logfile.LogFile.fromFullPath(
+            filename, rotateLength=rotate_length,
+            maxRotatedFiles=max_rotated or None)
+    name = "json_logger" if json else "file_logger"
+    if not sync:
+        name = "async_" + name
+    return "virtualbricks.app." + name
 
 
 class Options(usage.Options):
@@ -53,10 +77,18 @@ class Options(usage.Options):
 
     optFlags = [
         ["noterm", None, "Do not show the terminal."],
-        ["daemon", None, ""]
+        ["daemon", None, ""],
+        ["logsync", None, "Write the log messages to the file in the main "
+         "thread."],
+        ["logjson", None, "Write the log messages to the file as JSON lines."]
     ]
     optParameters = [
         ["logfile", "l", None, "Write log messages to file."],
+        ["logsize", None, 1000000,
+         "Rotate the log file when it is bigger than this many bytes.", int],
+        ["logrotated", None, 0,
+         "Keep at most this many rotated log files, 0 keeps all of them.",
+         int],
         ["logger", None, None,
          "A fully-qualified name to a log observer factory to use for the "
          "initial log observer. Takes precedence over --logfile and --syslog "
@@ -67,11 +99,6 @@ class Options(usage.Options):
         usage.Options.__init__(self)
         self["verbosity"] = 0
 
-    def opt_logfile(self, arg):
-        """Write log messages to file."""
-
-        self["logger"] = _file_logger(arg)
-
     def opt_verbose(self):
         """Increase log verbosity."""
         self["verbosity"] += 1
@@ -91,6 +118,10 @@ class Options(usage.Options):
         sys.exit(0)
 
     def postOptions(self):
+        if self["logfile"] and not self["logger"]:
+            self["logger"] = _file_logger(self["logfile"], self["logsize"],
+                                          self["logrotated"], self["logsync"],
+                                          self["logjson"])
         if self["logger"]:
             try:
                 self["logger"] = reflect.namedAny(self["logger"])
@@ -16,6 +16,8 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import ast
+import copy
 import re
 
 from twisted.python import reflect
@@ -36,15 +38,46 @@ param_not_found = log.Event("Parameter {param} in {brick} not found. "
 
 
 class Config(dict):
+    """
+    @ivar generation: incremented every time a value is set, used to tell
+        if the values computed from the configuration are stale.
+    """
 
     CONFIG_LINE = re.compile(r"^(\w+?)=(.*)$")
     parameters = {}
+    generation = 0
 
     def __init__(self):
-        parameters = {}
-        reflect.accumulateClassDict(self.__class__, "parameters", parameters)
-        self.parameters = parameters
-        super().__init__((n, v.default) for n, v in self.parameters.items())
+        self.parameters, defaults = self._schema()
+        super().__init__(defaults)
+
+    @classmethod
+    def _schema(cls):
+        """
+        Return the parameters of the class, merged with the ones of its
+        bases, and their default values. They are computed the first time
+        and then shared by all the instances of the class.
+
+        :rtype: Tuple[Dict[str, Parameter], Dict[str, Any]]
+        """
+
+        try:
+            return cls.__dict__["_Config__schema"]
+        except KeyError:
+            parameters = {}
+            reflect.accumulateClassDict(cls, "parameters", parameters)
+            defaults = {n: p.default for n, p in parameters.items()}
+            cls.__schema = parameters, defaults
+            return cls.__schema
+
+    def __deepcopy__(self, memo):
+        # the parameters are shared, only the values are copied
+        new = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new
+        new.parameters = self.parameters
+        for name, value in self.items():
+            dict.__setitem__(new, name, copy.deepcopy(value, memo))
+        return new
 
     # dict interface
 
@@ -52,6 +85,7 @@ class Config(dict):
         if name not in self.parameters:
             raise ValueError(_("Parameter %s not found") % name)
         super(Config, self).__setitem__(name, value)
+        self.generation += 1
 
     # NOTE: old interface, values are always strings
     def get(self, name, default=None):
@@ -173,7 +207,7 @@ class ListOf(Parameter):
         self.element_type = element_type
 
     def from_string(self, in_string):
-        strings = eval(in_string, {}, {})
+        strings = ast.literal_eval(in_string)
         return [self.element_type.from_string(s) for s in strings]
 
     def to_string(self, in_object):
@@ -183,6 +217,8 @@ class ListOf(Parameter):
 class Base(object):
 
     _restore = False
+    # bumped every time the object changes, used to cache its serialization
+    revision = 0
     # type = None  # if not set in a subclass will raise an AttributeError
     _name = None
     config_factory = Config
@@ -213,14 +249,17 @@ class Base(object):
         return False
 
     def set(self, attrs):
-        for name, value in attrs.items():
-            if value != self.config[name]:
-                logger.info(attribute_set, attr=name, brick=self, value=value)
-                self.config[name] = value
-                setter = getattr(self, "cbset_" + name, None)
-                if setter:
-                    setter(value)
-        self.notify_changed()
+        # the setters can notify changes too, deliver them once
+        with observable.batch():
+            for name, value in attrs.items():
+                if value != self.config[name]:
+                    logger.info(attribute_set, attr=name, brick=self,
+                                value=value)
+                    self.config[name] = value
+                    setter = getattr(self, "cbset_" + name, None)
+                    if setter:
+                        setter(value)
+            self.notify_changed()
 
     def get(self, name):
         try:
@@ -260,6 +299,8 @@ class Base(object):
         self._restore = restore
 
     def notify_changed(self):
+        self.revision += 1
+        self.factory.touch()
         if not self._restore:
             self._observable.notify("changed", self)
 
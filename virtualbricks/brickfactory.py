@@ -32,8 +32,9 @@ from twisted.conch.insults import insults
 from twisted.conch import manhole
 
 from virtualbricks import errors, settings, configfile, console, project, log
-from virtualbricks import link, router, switches, tunnels, tuntaps
-from virtualbricks import virtualmachines, wires
+from virtualbricks import link, router, switches, topology, tunnels, tuntaps
+from virtualbricks import (observable, resources, supervisor,
+                           virtualmachines, wires)
 from virtualbricks.errors import NameAlreadyInUseError
 from virtualbricks.events import Event, is_event
 from virtualbricks.observable import Event as Signal, Observable
@@ -133,6 +134,20 @@ class BrickFactory(object):
         self._events = {}
         self.socks = []
         self._disk_images = {}
+        # Indexes used for the lookups, self._bricks and self.socks are kept
+        # to preserve the insertion order.
+        self._bricks_by_name = {}
+        self._socks_by_name = {}
+        self._socks_by_brick = {}
+        self._socks_keys = {}
+        self._images_by_path = {}
+        self._images_keys = {}
+        # bumped on every change of the project, see touch()
+        self.generation = 0
+        self.saved_generation = 0
+        # bumped when an image is renamed, the bricks refer to the images
+        # by name
+        self.images_revision = 0
         self.__factories = install_brick_types()
         self.__observable = observable = Observable('quit')
         self.changed = Signal(observable, 'brick-changed')
@@ -146,6 +161,10 @@ class BrickFactory(object):
         self.image_added = Signal(observable, 'image-added')
         self.image_removed = Signal(observable, 'image-removed')
         self.image_changed = Signal(observable, 'image-changed')
+        self.project_loaded = Signal(observable, 'project-loaded')
+        self._bulk_loads = 0
+        self.supervisor = supervisor.Supervisor(self)
+        self.resources = resources.ResourceSampler(self)
 
     def quit(self):
         if any(is_running(brick) for brick in self._bricks):
@@ -171,6 +190,9 @@ class BrickFactory(object):
             self.del_event(e)
 
         del self.socks[:]
+        self._socks_by_name.clear()
+        self._socks_by_brick.clear()
+        self._socks_keys.clear()
         for image in list(self._disk_images.values()):
             self.remove_disk_image(image)
 
@@ -193,7 +215,48 @@ class BrickFactory(object):
         self.__observable.remove_observer(name, callback, args, kwds)
 
     def set_restore(self, restore):
-        pass
+        """
+        Enter or leave the bulk load mode, see bulk_load().
+        """
+
+        if restore:
+            self._bulk_loads += 1
+            self.__observable._thawed = True
+        else:
+            self._bulk_loads -= 1
+            if self._bulk_loads == 0:
+                self.__observable._thawed = False
+                self.project_loaded.notify(self)
+
+    def batch(self):
+        """
+        Return a context manager that delivers the notifications sent inside
+        it once, at the end. Useful in scripts that change many bricks. See
+        virtualbricks.observable.batch().
+        """
+
+        return observable.batch()
+
+    def bulk_load(self):
+        """
+        Return a context manager to create many objects at once. The added
+        and changed signals are not emitted while loading, a single
+        project-loaded signal is emitted at the end instead, so the views
+        are rebuilt once.
+        """
+
+        return configfile.freeze_notify(self)
+
+    def touch(self):
+        """
+        Mark the project as changed. The project is saved by the autosave
+        only if it was touched since the last save.
+        """
+
+        self.generation += 1
+
+    def is_dirty(self):
+        return self.generation != self.saved_generation
 
     # Disk Images
 
@@ -209,15 +272,38 @@ class BrickFactory(object):
             raise errors.ImageAlreadyInUseError(path)
         disk_image = virtualmachines.Image(new_name, path, description)
         self._disk_images[new_name] = disk_image
+        self._images_by_path[disk_image.get_path()] = disk_image
+        self._images_keys[disk_image] = (new_name, disk_image.get_path())
+        disk_image.changed.connect(self._update_image_index)
         disk_image.changed.connect(self.image_changed.notify)
+        self.touch()
         self.image_added.notify(disk_image)
         return disk_image
 
     def remove_disk_image(self, disk_image):
         disk_image.changed.disconnect(self.image_changed.notify)
-        del self._disk_images[disk_image.get_name()]
+        disk_image.changed.disconnect(self._update_image_index)
+        name, path = self._images_keys.pop(disk_image)
+        del self._disk_images[name]
+        del self._images_by_path[path]
+        self.touch()
         self.image_removed.notify(disk_image)
 
+    def _update_image_index(self, disk_image):
+        # The name and the path of an image can be changed directly on the
+        # image, follow them to keep the indexes valid.
+        self.images_revision += 1
+        self.touch()
+        name, path = self._images_keys[disk_image]
+        new_name, new_path = disk_image.get_name(), disk_image.get_path()
+        if name != new_name:
+            del self._disk_images[name]
+            self._disk_images[new_name] = disk_image
+        if path != new_path:
+            del self._images_by_path[path]
+            self._images_by_path[new_path] = disk_image
+        self._images_keys[disk_image] = (new_name, new_path)
+
     def get_image_by_name(self, name):
         """
         Return a disk image given its name.
@@ -236,9 +322,7 @@ class BrickFactory(object):
         :rtype: Optional[virtualbricks.virtualmachines.Image]
         """
 
-        for disk_image in self._disk_images.values():
-            if disk_image.get_path() == path:
-                return disk_image
+        return self._images_by_path.get(path)
 
     def iter_disk_images(self):
         """
@@ -271,7 +355,9 @@ class BrickFactory(object):
             raise NameAlreadyInUseError(name)
         brick = BrickClass(self, name)
         self._bricks.append(brick)
+        self._bricks_by_name[name] = brick
         brick.changed.connect(self.brick_changed.notify)
+        self.touch()
         self.brick_added.notify(brick)
         return brick
 
@@ -292,29 +378,28 @@ class BrickFactory(object):
             msg = "Cannot delete brick {0:n}: brick is running".format(brick)
             raise errors.BrickRunningError(msg)
         logger.info(remove_brick, brick=brick.name)
-        socks = set(brick.socks)
+        socks = self._socks_by_brick.pop(brick, [])
         if socks:
             logger.info(remove_socks,
                         socks=", ".join(s.nickname for s in socks))
-            for _brick in self._bricks:
-                for plug in _brick.plugs:
-                    if plug.configured() and plug.sock in socks:
-                        logger.info(disconnect_plug, sock=plug.sock.nickname)
-                        plug.disconnect()
-            for sock in [s for s in self.socks if s.brick is brick]:
+            for sock in socks:
+                for plug in list(sock.plugs):
+                    logger.info(disconnect_plug, sock=sock.nickname)
+                    plug.disconnect()
                 self.socks.remove(sock)
+                nickname = self._socks_keys.pop(sock)
+                if self._socks_by_name.get(nickname) is sock:
+                    del self._socks_by_name[nickname]
         for plug in brick.plugs:
             if plug.configured():
                 plug.disconnect()
         brick.changed.disconnect(self.brick_changed.notify)
+        self.supervisor.forget(brick)
         self._bricks.remove(brick)
+        del self._bricks_by_name[brick.get_name()]
+        self.touch()
         self.brick_removed.notify(brick)
 
-    def _get_element_by_name(self, name, sequence):
-        for item in sequence:
-            if item.get_name() == name:
-                return item
-
     def get_brick_by_name(self, name):
         """
         Return a brick given its name.
@@ -323,11 +408,57 @@ class BrickFactory(object):
         :rtype: Optional[virtualbricks.bricks.Brick]
         """
 
-        return self._get_element_by_name(name, self.iter_bricks())
+        return self._bricks_by_name.get(name)
 
     def iter_bricks(self):
         return iter(self._bricks)
 
+    def start_all(self, bricks=None, concurrency=None):
+        """
+        Start the given bricks, or all the bricks, in dependency order. See
+        virtualbricks.topology.start().
+
+        :type bricks: Optional[Iterable[virtualbricks.bricks.Brick]]
+        :type concurrency: Optional[int]
+        :rtype: twisted.internet.defer.Deferred[
+            List[virtualbricks.topology.BrickReport]]
+        """
+
+        if bricks is None:
+            bricks = self._bricks
+        return topology.start(bricks, concurrency)
+
+    def prepare_all(self, bricks=None, concurrency=None, progress=None):
+        """
+        Create the private disks of the given virtual machines, or of all
+        the virtual machines, before starting them. See
+        virtualbricks.topology.prepare().
+
+        :type bricks: Optional[Iterable[virtualbricks.bricks.Brick]]
+        :type concurrency: Optional[int]
+        :type progress: Optional[Callable[[int, int,
+            virtualbricks.topology.DiskReport], None]]
+        :rtype: twisted.internet.defer.Deferred[
+            List[virtualbricks.topology.DiskReport]]
+        """
+
+        if bricks is None:
+            bricks = self._bricks
+        return topology.prepare(bricks, concurrency, progress)
+
+    def shutdown_all(self, concurrency=None, timeouts=None):
+        """
+        Stop all the running bricks in reverse dependency order. See
+        virtualbricks.topology.stop().
+
+        :type concurrency: Optional[int]
+        :type timeouts: Optional[Dict[str, float]]
+        :rtype: twisted.internet.defer.Deferred[
+            List[virtualbricks.topology.BrickReport]]
+        """
+
+        return topology.stop(self._bricks, concurrency, timeouts)
+
     # Events
 
     def new_event(self, name):
@@ -346,6 +477,7 @@ class BrickFactory(object):
         logger.debug(new_event_ok, name=norm_name)
         self._events[norm_name] = event
         event.changed.connect(self.event_changed.notify)
+        self.touch()
         self.event_added.notify(event)
         return event
 
@@ -359,6 +491,7 @@ class BrickFactory(object):
         event.poweroff()
         event.changed.disconnect(self.event_changed.notify)
         del self._events[event.get_name()]
+        self.touch()
         self.event_removed.notify(event)
 
     def get_event_by_name(self, name):
@@ -369,7 +502,7 @@ class BrickFactory(object):
         :rtype: Optional[virtualbricks.events.Event]
         """
 
-        return self._disk_images.get(name)
+        return self._events.get(name)
 
     def iter_events(self):
         return iter(self._events.values())
@@ -410,9 +543,15 @@ class BrickFactory(object):
             self._events[new_name] = brick
             del self._events[prev_name]
         elif is_disk_image(brick):
-            self._disk_images[new_name] = brick
-            del self._disk_images[prev_name]
+            # the image index is updated by _update_image_index
+            pass
+        else:
+            self._bricks_by_name[new_name] = brick
+            del self._bricks_by_name[prev_name]
         brick.set_name(new_name)
+        # Some bricks derive the name of their socks from their own name
+        for sock in self._socks_by_brick.get(brick, ()):
+            self._reindex_sock(sock)
         return prev_name
 
     def normalize_name(self, name):
@@ -436,22 +575,27 @@ class BrickFactory(object):
     def new_sock(self, brick, name=""):
         sock = link.Sock(brick, name)
         self.socks.append(sock)
+        self._socks_by_brick.setdefault(brick, []).append(sock)
+        self._reindex_sock(sock)
+        self.touch()
         return sock
 
+    def _reindex_sock(self, sock):
+        nickname = self._socks_keys.get(sock)
+        if nickname is not None and self._socks_by_name.get(nickname) is sock:
+            del self._socks_by_name[nickname]
+        self._socks_keys[sock] = sock.nickname
+        self._socks_by_name[sock.nickname] = sock
+
     def get_sock_by_name(self, name):
         if name == "_hostonly":
             return virtualmachines.hostonly_sock
-        for sock in self.socks:
-            if sock.nickname == name:
-                return sock
+        return self._socks_by_name.get(name)
 
     def connect_to(self, brick, nick):
-        endpoint = None
         if not nick:
             return None
-        for n in self.socks:
-            if n.nickname == nick:
-                endpoint = n
+        endpoint = self._socks_by_name.get(nick)
         if endpoint is not None:
             return brick.connect(endpoint)
         else:
@@ -542,7 +686,7 @@ class Console(basic.LineOnlyReceiver):
 
 
 def AutosaveTimer(factory, interval=180):
-    l = task.LoopingCall(configfile.safe_save, factory)
+    l = task.LoopingCall(configfile.autosave, factory)
     l.start(interval, now=False)
     return l
 
@@ -569,6 +713,9 @@ class AppLogger(app.AppLogger):
         logger.info(shut_down)
         if self.observer is not None:
             logger.publisher.removeObserver(self.observer)
+            stop = getattr(self.observer, "stop", None)
+            if stop is not None:
+                stop()
             self.observer = None
 
 
@@ -674,6 +821,7 @@ class Application:
                                       project.manager.save_current, factory)
         reactor.addSystemEventTrigger("before", "shutdown", self.logger.stop)
         AutosaveTimer(factory)
+        factory.resources.start()
         if not self.config["noterm"] and not self.config["daemon"]:
             namespace = self.get_namespace()
             namespace["factory"] = factory
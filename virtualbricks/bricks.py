@@ -22,11 +22,13 @@ import collections
 import functools
 import locale
 import re
+from dataclasses import dataclass, field
+from typing import List, Optional
 
 from twisted.internet import protocol, reactor, error, defer
 from zope.interface import implementer
 
-from virtualbricks import base, errors, settings, log, interfaces
+from virtualbricks import base, errors, settings, log, interfaces, output
 from virtualbricks.base import (Config as _Config, Parameter, String, Integer,
                                 SpinInt, Float, SpinFloat, Boolean, Object,
                                 ListOf)
@@ -55,6 +57,9 @@ console_done = log.Event("Console terminated\n{status}")
 console_terminated = log.Event("Console terminated\n{status}\nProcess stdout:"
                                "\n{out}\nProcess stderr:\n{err}\n")
 invalid_ack = log.Event("ACK received but no command sent.")
+command_failed = log.Event("Command {cmd} failed: {error}")
+commands_coalesced = log.Event("Sending {count} commands to {brick}, "
+                               "{superseded} superseded")
 
 
 class ProcessLogger(object):
@@ -76,9 +81,12 @@ class Process(protocol.ProcessProtocol):
     logger = ProcessLogger(log.Logger())
     debug = True
     debug_child = True
+    clock = reactor
 
     def __init__(self, brick):
         self.brick = brick
+        self.output = output.ProcessOutput(self, brick.config["outputrate"],
+                                           brick.config["outputlog"])
 
     def connectionMade(self):
         self.logger.info(process_started)
@@ -91,13 +99,14 @@ class Process(protocol.ProcessProtocol):
         else:
             assert status.check(error.ProcessDone)
             self.logger.info(process_terminated, status="Done")
+        self.output.close()
         self.brick.process_ended(self, status)
 
     def outReceived(self, data):
-        self.logger.info(data)
+        self.output.out_received(data)
 
     def errReceived(self, data):
-        self.logger.error(data, hide_to_user=True)
+        self.output.err_received(data)
 
     # new interface
 
@@ -111,6 +120,10 @@ class Process(protocol.ProcessProtocol):
     def write(self, data):
         self.transport.write(data)
 
+    def send_command(self, cmd, timeout=None):
+        self.write(cmd)
+        return defer.succeed(None)
+
 
 @implementer(interfaces.IProcess)
 class FakeProcess:
@@ -126,30 +139,122 @@ class FakeProcess:
     def write(self, data):
         pass
 
+    def send_command(self, cmd, timeout=None):
+        return defer.succeed(None)
+
+
+@dataclass
+class Response:
+    """
+    The response of the VDE management console to a command.
+
+    @ivar code: the status code, 1000 on success, or None if the response
+        has no status line.
+    @ivar lines: the data lines of the response.
+    """
+
+    code: Optional[int]
+    message: str
+    lines: List[str] = field(default_factory=list)
+
+
+STATUS_LINE = re.compile(r"^(\d{4}) (.*)$")
+SUCCESS = 1000
+
+
+def parse_response(data):
+    """
+    Parse a response block of the VDE management console.
+
+    :type data: bytes
+    :rtype: Response
+    """
+
+    code, message, lines = None, "", []
+    for line in data.decode("utf-8", "replace").splitlines():
+        match = STATUS_LINE.match(line)
+        if match:
+            status = int(match.group(1))
+            # 0000 introduces a data block
+            if status:
+                code, message = status, match.group(2)
+        elif line not in ("", "."):
+            lines.append(line)
+    return Response(code, message, lines)
+
+
+@dataclass
+class ManagementStats:
+
+    sent: int = 0
+    completed: int = 0
+    failed: int = 0
+    timed_out: int = 0
+    max_queue_len: int = 0
+    total_latency: float = 0.0
+
+
+class _PendingCommand:
+
+    call = None
+    sent = None
+
+    def __init__(self, cmd, timeout):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.deferred = defer.Deferred()
+
+    def cancel_timeout(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
 
 class VDEProcessProtocol(Process):
     """
     Handle the VDE management console.
 
-    Commands are serialized, until an ACK is received, the next command is not
-    sent.
+    Up to PIPELINE_SIZE commands are sent without waiting for their ACKs (the
+    prompt), the others are queued. The console answers the commands in
+    order so every ACK is matched with the oldest command sent.
 
     @cvar delimiter: The line-ending delimiter to use.
+    @cvar PIPELINE_SIZE: how many commands can be waiting for an ACK.
+    @cvar COMMAND_TIMEOUT: default seconds to wait for an ACK, None to wait
+        forever.
     """
 
     _buffer = b""
     delimiter = b"\n"
     prompt = re.compile(rb"^vde(?:\[[^]]*\]:|\$) ", re.MULTILINE)
-    PIPELINE_SIZE = 1
+    PIPELINE_SIZE = 8
+    COMMAND_TIMEOUT = 30.0
 
-    def __init__(self, brick):
+    def __init__(self, brick, pipeline_size=None):
         Process.__init__(self, brick)
-        self.queue = collections.deque()
+        if pipeline_size is not None:
+            self.PIPELINE_SIZE = pipeline_size
+        # the commands not yet acknowledged, the first self.in_flight ones
+        # are already sent
+        self._commands = collections.deque()
+        self.in_flight = 0
+        self.stats = ManagementStats()
+
+    @property
+    def queue(self):
+        """The commands not yet acknowledged, the oldest first."""
+
+        return [command.cmd for command in self._commands]
+
+    @property
+    def pending(self):
+        """The number of commands queued and not yet sent."""
 
+        return len(self._commands) - self.in_flight
 
-    def _data_received(self, data):
+    def data_received(self, data):
         """
-        Translates bytes into lines, and calls _ack_received.
+        Split the data in ACKs, and calls _ack_received for each one.
         """
 
         assert isinstance(data, bytes)
@@ -160,30 +265,168 @@ class VDEProcessProtocol(Process):
 
     def _ack_received(self, ack):
         self.logger.info(ack)
-        try:
-            self.queue.popleft()
-        except IndexError:
+        if not self.in_flight:
             self.logger.warn(invalid_ack)
             self.transport.loseConnection()
-        else:
-            if len(self.queue):
-                self._send_command()
-
-    def _send_command(self):
-        cmd = self.queue[0]
+            return
+        command = self._commands.popleft()
+        self.in_flight -= 1
+        command.cancel_timeout()
+        if not command.deferred.called:
+            response = parse_response(ack)
+            self.stats.total_latency += self.clock.seconds() - command.sent
+            if response.code in (None, SUCCESS):
+                self.stats.completed += 1
+                command.deferred.callback(response)
+            else:
+                self.stats.failed += 1
+                command.deferred.errback(errors.ManagementCommandError(
+                    response.code, response.message))
+        self._fill_pipeline()
+
+    def _fill_pipeline(self):
+        while self.in_flight < min(self.PIPELINE_SIZE, len(self._commands)):
+            command = self._commands[self.in_flight]
+            command.sent = self.clock.seconds()
+            if command.timeout is not None:
+                command.call = self.clock.callLater(
+                    command.timeout, self._timeout, command)
+            self.in_flight += 1
+            self.stats.sent += 1
+            self._send_command(command.cmd)
+
+    def _send_command(self, cmd):
         self.logger.info(cmd)
         if cmd.endswith(self.delimiter):
             return self.transport.write(cmd)
         else:
             return self.transport.writeSequence((cmd, self.delimiter))
 
+    def _timeout(self, command):
+        # The command keeps its place in the queue, its ACK will come, but
+        # the caller is not kept waiting
+        command.call = None
+        self.stats.timed_out += 1
+        command.deferred.errback(errors.ManagementTimeoutError(command.cmd))
+
     def outReceived(self, data):
-        self._data_received(data)
+        self.data_received(data)
+
+    def processEnded(self, status):
+        commands, self._commands = self._commands, collections.deque()
+        self.in_flight = 0
+        for command in commands:
+            command.cancel_timeout()
+            if not command.deferred.called:
+                command.deferred.errback(errors.ManagementError(
+                    _("Process terminated")))
+        Process.processEnded(self, status)
+
+    def send_command(self, cmd, timeout=None):
+        """
+        Queue a command for the management console.
+
+        Return a deferred that fires with the Response or fails with
+        ManagementCommandError if the console answers with an error or with
+        ManagementTimeoutError if the console does not answer in time.
+
+        :type cmd: bytes
+        :param timeout: seconds to wait for the answer, COMMAND_TIMEOUT if
+            None.
+        :type timeout: Optional[float]
+        :rtype: twisted.internet.defer.Deferred[Response]
+        """
+
+        if timeout is None:
+            timeout = self.COMMAND_TIMEOUT
+        command = _PendingCommand(cmd, timeout)
+        self._commands.append(command)
+        self.stats.max_queue_len = max(self.stats.max_queue_len,
+                                       len(self._commands))
+        self._fill_pipeline()
+        return command.deferred
 
     def write(self, cmd):
-        self.queue.append(cmd)
-        if 0 < len(self.queue) <= self.PIPELINE_SIZE:
-            self._send_command()
+        def log_error(failure):
+            self.logger.warn(command_failed, cmd=cmd,
+                             error=failure.getErrorMessage())
+
+        self.send_command(cmd).addErrback(log_error)
+
+
+class CommandCoalescer:
+    """
+    Collapse the live-management commands sent to a brick.
+
+    The commands are keyed by the parameter they change. A command scheduled
+    inside WINDOW seconds from the first pending one replaces the pending
+    command with the same key, then all the surviving commands are sent
+    together, in the order their keys were last updated.
+
+    @cvar WINDOW: seconds to wait for newer values before sending.
+    @ivar superseded: how many commands were dropped because replaced.
+    """
+
+    WINDOW = 0.1
+    clock = reactor
+
+    def __init__(self, brick, window=None):
+        self.brick = brick
+        if window is not None:
+            self.WINDOW = window
+        self.commands = {}
+        self.call = None
+        self.superseded = 0
+
+    def schedule(self, key, cmd):
+        """
+        Schedule a command, replacing the pending command with the same key.
+
+        :type key: str
+        :type cmd: bytes
+        """
+
+        assert isinstance(cmd, bytes)
+        if self.commands.pop(key, None) is not None:
+            self.superseded += 1
+        self.commands[key] = cmd
+        if self.call is None:
+            self.call = self.clock.callLater(self.WINDOW, self.flush)
+
+    def flush(self):
+        """
+        Send now the pending commands. Return a deferred that fires when all
+        the commands are acknowledged, the failures are logged.
+
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        self._cancel_call()
+        commands, self.commands = self.commands, {}
+        if not commands or self.brick.proc is None:
+            return defer.succeed(None)
+        logger.debug(commands_coalesced, count=len(commands),
+                     brick=self.brick.name, superseded=self.superseded)
+        deferreds = []
+        for cmd in commands.values():
+            d = self.brick.send_command(cmd)
+            d.addErrback(self._log_error, cmd)
+            deferreds.append(d)
+        return defer.gatherResults(deferreds).addCallback(lambda _: None)
+
+    def discard(self):
+        """Drop the pending commands."""
+
+        self._cancel_call()
+        self.commands.clear()
+
+    def _cancel_call(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def _log_error(self, failure, cmd):
+        logger.warn(command_failed, cmd=cmd, error=failure.getErrorMessage())
 
 
 class TermProtocol(protocol.ProcessProtocol):
@@ -215,11 +458,98 @@ class TermProtocol(protocol.ProcessProtocol):
             self.logger.info(console_done, status=status.value)
 
 
+class CommandPlan:
+    """
+    A command_builder compiled once. The switches starting with "#" are
+    dropped, the options taken from the configuration are bound to their
+    parameter and the options that are not in the configuration, that would
+    never be added, are dropped too.
+
+    The arguments of the configuration options can be computed once with
+    config_args() and reused until the configuration changes, the callables
+    are always called.
+
+    @ivar builder: the command_builder that was compiled.
+    """
+
+    __slots__ = ("builder", "steps")
+
+    def __init__(self, builder, parameters):
+        self.builder = builder
+        steps = []
+        for switch, value in builder.items():
+            if switch.startswith("#"):
+                continue
+            positional = switch.startswith("*")
+            if callable(value):
+                steps.append((switch, positional, None, value))
+            elif value in parameters:
+                steps.append((switch, positional, value,
+                              parameters[value].to_string))
+        self.steps = tuple(steps)
+
+    @staticmethod
+    def _expand(switch, positional, value):
+        if value == "*":
+            return (switch, )
+        elif value is not None and len(value) > 0:
+            if positional:
+                return (value, )
+            return (switch, value)
+        return ()
+
+    def config_args(self, config):
+        """
+        Return the arguments of the configuration options, None for the
+        options computed by a callable.
+
+        :type config: Config
+        :rtype: Tuple[Optional[Tuple[str, ...]], ...]
+        """
+
+        args = []
+        for switch, positional, name, to_string in self.steps:
+            if name is None:
+                args.append(None)
+            else:
+                try:
+                    value = to_string(dict.__getitem__(config, name))
+                except KeyError:
+                    value = None
+                args.append(self._expand(switch, positional, value))
+        return tuple(args)
+
+    def build(self, config_args):
+        """
+        Build the command line from the arguments returned by config_args().
+
+        :rtype: List[str]
+        """
+
+        res = []
+        for (switch, positional, name, getter), args in zip(self.steps,
+                                                            config_args):
+            if args is None:
+                args = self._expand(switch, positional, getter())
+            res.extend(args)
+        return res
+
+
+# command plans of the command_builder defined by the brick classes
+_command_plans = {}
+
+
 class Config(_Config):
 
     parameters = {
         "pon_vbevent": String(""),
-        "poff_vbevent": String("")
+        "poff_vbevent": String(""),
+        # see virtualbricks.supervisor
+        "restart": String("never"),
+        # lines of output logged per second, 0 for no limit, and the file
+        # where all the output is written
+        "outputrate": SpinInt(200, 0, 1000000),
+        "outputlog": String("")
     }
 
 
@@ -231,8 +561,14 @@ class Brick(base.Base):
     _started_d = None
     _exited_d = None
     _last_status = None
+    _stop_requested = False
+    _command_plan = None
+    _args_cache = None
     process_protocol = VDEProcessProtocol
     config_factory = Config
+    # poweroff() arguments, from the gentlest to the harshest, used to
+    # escalate when a brick does not stop in time.
+    poweroff_escalation = ({}, {"kill": True})
 
     @property
     def pid(self):
@@ -245,6 +581,7 @@ class Brick(base.Base):
         self.plugs = []
         self.socks = []
         self.config_socks = []
+        self.coalescer = CommandCoalescer(self)
 
     # IBrick interface
 
@@ -259,6 +596,7 @@ class Brick(base.Base):
             return defer.fail(errors.NotConnectedError(
                 _("Cannot start '%s': not connected") % self.name))
 
+        self._stop_requested = False
         self._started_d = started = defer.Deferred()
         self._exited_d = defer.Deferred()
         d = self._check_links()
@@ -285,6 +623,7 @@ class Brick(base.Base):
         if self.proc is None:
             return defer.succeed((self, self._last_status))
         logger.info(shutdown_brick, name=self.name, pid=self.proc.pid)
+        self._stop_requested = True
         try:
             self.proc.signal_process("KILL" if kill else "TERM")
         except OSError as e:
@@ -312,9 +651,11 @@ class Brick(base.Base):
         started, self._started_d = self._started_d, None
         started.callback(self)
         self.notify_changed()
+        self.factory.supervisor.process_started(self)
 
     def process_ended(self, proc, status):
         self.proc = None
+        self.coalescer.discard()
         self._start_related_events(off=True)
         self._last_status = status
         # ovvensive programming, raise an exception instead of hide the error
@@ -322,6 +663,8 @@ class Brick(base.Base):
         exited, self._exited_d = self._exited_d, None
         exited.callback((self, status))
         self.notify_changed()
+        requested, self._stop_requested = self._stop_requested, False
+        self.factory.supervisor.process_ended(self, status, requested)
 
     # Interal interface
 
@@ -341,26 +684,68 @@ class Brick(base.Base):
     def prog(self):
         raise NotImplementedError(_("Brick.prog() not implemented."))
 
+    def command_plan(self):
+        """
+        Return the compiled command_builder. The plan of a command_builder
+        defined in the class is shared by all the bricks of that class.
+
+        :rtype: CommandPlan
+        """
+
+        builder = self.command_builder
+        plan = self._command_plan
+        if plan is None or plan.builder is not builder:
+            if "command_builder" in vars(self):
+                plan = CommandPlan(builder, self.config.parameters)
+            else:
+                plan = _command_plans.get(type(self))
+                if plan is None or plan.builder is not builder:
+                    plan = CommandPlan(builder, self.config.parameters)
+                    _command_plans[type(self)] = plan
+            self._command_plan = plan
+        return plan
+
+    def cached_args(self, key, build, *args):
+        """
+        Return the value returned by build(*args), computed again only if the
+        configuration changed since the last time. build() must depend only
+        on the configuration and its result must not be modified.
+
+        :type key: Hashable
+        :type build: Callable[..., Any]
+        """
+
+        config = self.config
+        if self._args_cache is None:
+            self._args_cache = {}
+        try:
+            cached_config, generation, value = self._args_cache[key]
+        except KeyError:
+            pass
+        else:
+            if cached_config is config and generation == config.generation:
+                return value
+        value = build(*args)
+        self._args_cache[key] = config, config.generation, value
+        return value
+
     def build_cmd_line(self):
-        # TODO: documents the behavior of all cases (#, *, etc.)
-        res = []
+        """
+        Build the command line from command_builder. The keys are the
+        switches and the values the name of a configuration option or a
+        callable that returns the argument:
 
-        # import pdb; pdb.set_trace()
-        for switch, value in self.command_builder.items():
-            if not switch.startswith("#"):
-                if callable(value):
-                    value = value()
-                else:
-                    value = self.config.get(value)
-                if value == "*":
-                    res.append(switch)
-                elif value is not None and len(value) > 0:
-                    if not switch.startswith("*"):
-                        res.append(switch)
-                    res.append(value)
-        #res.sort()
-        #print(res)
-        return res
+            - switches that start with "#" are ignored;
+            - if the argument is "*" only the switch is added;
+            - switches that start with "*" add only the argument;
+            - empty arguments and their switches are not added.
+
+        :rtype: List[str]
+        """
+
+        plan = self.command_plan()
+        config_args = self.cached_args(plan, plan.config_args, self.config)
+        return plan.build(config_args)
 
     def _poweron(self, ignore):
 
@@ -431,6 +816,34 @@ class Brick(base.Base):
         if self.proc:
             self.proc.write(data)
 
+    def send_command(self, cmd, timeout=None):
+        """
+        Send a command to the management console of the brick. See
+        IProcess.send_command().
+
+        :type cmd: bytes
+        :type timeout: Optional[float]
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        if self.proc is None:
+            return defer.fail(errors.ManagementError(
+                _("Cannot send command to '%s': not running") % self.name))
+        return self.proc.send_command(cmd, timeout)
+
+    def send_coalesced(self, key, cmd):
+        """
+        Send a live-management command that supersedes the previous commands
+        with the same key not yet sent. See CommandCoalescer. Like send(),
+        do nothing if the brick is not running.
+
+        :type key: str
+        :type cmd: bytes
+        """
+
+        if self.proc is not None:
+            self.coalescer.schedule(key, cmd)
+
     def get_state(self):
         """return state of the brick"""
         if self.proc is not None:
@@ -21,10 +21,14 @@ import os.path
 import errno
 import traceback
 import contextlib
+import io
+import threading
+from twisted.internet import defer, threads
 from twisted.python import filepath
 from zope.interface import implementer
 
-from virtualbricks import interfaces, settings, _configparser, log
+from virtualbricks import (interfaces, settings, _configparser, log,
+                          imagecache)
 
 
 if False:  # pyflakes
@@ -32,8 +36,8 @@ if False:  # pyflakes
 
 
 __all__ = ["BrickBuilder", "ConfigFile", "EventBuilder", "ImageBuilder",
-           "LinkBuilder", "SockBuilder", "log_events", "restore", "safe_save",
-           "save"]
+           "LinkBuilder", "SockBuilder", "autosave", "log_events", "restore",
+           "safe_save", "save"]
 
 
 logger = log.Logger()
@@ -55,6 +59,9 @@ skip_image_noa = log.Event("Cannot access image file, skipping")
 config_dump = log.Event("CONFIG DUMP on {path}")
 open_project = log.Event("Open project at {path}")
 config_save_error = log.Event("Error while saving configuration file")
+snapshot_save_error = log.Event("Cannot save the project snapshot {path}")
+snapshot_load_error = log.Event("Cannot load the project snapshot {path}, "
+                                "loading the project file")
 
 log_events = [link_type_error,
               brick_not_found,
@@ -69,7 +76,9 @@ log_events = [link_type_error,
               skip_image_noa,
               config_dump,
               open_project,
-              config_save_error]
+              config_save_error,
+              snapshot_save_error,
+              snapshot_load_error]
 
 
 @contextlib.contextmanager
@@ -296,6 +305,19 @@ interfaces.registerAdapter(compatible_brick_builder_factory,
 
 
 class ConfigFile:
+    """
+    @ivar sections: the text of the sections of the bricks and the events
+        written by the last save, keyed by object, with the revisions they
+        were generated from and their records in the snapshot. Only the
+        sections of the objects changed since then are generated again. The
+        images, the socks and the links are always generated but their
+        records are reused if their text did not change.
+    """
+
+    def __init__(self):
+        self.sections = {}
+        # the project files are written by the autosave thread too
+        self.lock = threading.Lock()
 
     def save(self, factory, str_or_obj):
         """Save the current project.
@@ -312,35 +334,138 @@ class ConfigFile:
             else:
                 fp = str_or_obj
             logger.debug(config_dump, path=fp.path)
+            self.write(*self.dump(factory, settings.get("projectsnapshot")),
+                       fp=fp)
+        else:
+            self.save_to(factory, str_or_obj)
+
+    def write(self, text, records, fp):
+        """
+        Write the project in the file, keeping a backup of the old one
+        until it is written, and its snapshot. The project is not touched,
+        this can be called from a thread; the writes are serialized.
+
+        :param text: the project, as returned by dump().
+        :type text: str
+        :param records: the records of the snapshot, as returned by dump(),
+            if None the snapshot is removed.
+        :type records: Optional[List[str]]
+        :type fp: twisted.python.filepath.FilePath
+        """
+
+        with self.lock:
             with backup(fp, fp.sibling(fp.basename() + "~")):
                 tmpfile = fp.sibling("." + fp.basename() + ".sav")
                 with open(tmpfile.path, "wt") as fd:
-                    self.save_to(factory, fd)
+                    fd.write(text)
                 tmpfile.moveTo(fp)
+            path = snapshot_path(fp)
+            if records is not None:
+                self.save_snapshot(records, path)
+            elif path.exists():
+                path.remove()
+
+    def save_snapshot(self, records, snapshot):
+        """
+        Save the snapshot of the project, written after the project file so
+        it is newer. The errors are logged, the snapshot is only a cache.
+
+        :type records: List[str]
+        :type snapshot: twisted.python.filepath.FilePath
+        """
+
+        tmpfile = snapshot.sibling(snapshot.basename() + ".sav")
+        try:
+            with open(tmpfile.path, "wt") as fd:
+                _configparser.write_snapshot(records, fd)
+            tmpfile.moveTo(snapshot)
+        except OSError:
+            logger.failure(snapshot_save_error, path=snapshot.path)
+
+    def _cache(self, obj, sections, revision, text, snapshot):
+        cached = self.sections.get(obj)
+        if cached is not None and cached[1] == text and cached[2] is not None:
+            records = cached[2]
+        elif snapshot:
+            records = [_configparser.snapshot_record(item) for item in
+                       _configparser.Parser(io.StringIO(text))]
         else:
-            self.save_to(factory, str_or_obj)
+            records = None
+        sections[obj] = revision, text, records
+        return text
+
+    def _section(self, obj, sections, images_revision, snapshot):
+        # read the revision before the serialization, if the object changes
+        # in the meanwhile its section is generated again the next time
+        revision = obj.revision, images_revision
+        cached = self.sections.get(obj)
+        if cached is not None and cached[0] == revision:
+            text = cached[1]
+        else:
+            buf = io.StringIO()
+            obj.save_to(buf)
+            text = buf.getvalue()
+        return self._cache(obj, sections, revision, text, snapshot)
+
+    def _line(self, obj, sections, text, snapshot):
+        return self._cache(obj, sections, None, text, snapshot)
 
     def save_to(self, factory, fileobj):
+        fileobj.write(self.dumps(factory))
+
+    def dumps(self, factory):
+        return self.dump(factory)[0]
+
+    def dump(self, factory, snapshot=False):
+        """
+        Return the text of the project and, if snapshot is true, the records
+        of its snapshot.
+
+        :type snapshot: bool
+        :rtype: Tuple[str, Optional[List[str]]]
+        """
+
+        # The images, the socks and the links are one line each and are
+        # always generated. All the text is written at once.
+        sections = {}
+        texts = []
         for img in factory.iter_disk_images():
-            img.save_to(fileobj)
+            buf = io.StringIO()
+            img.save_to(buf)
+            texts.append(self._line(img, sections, buf.getvalue(), snapshot))
 
+        images_revision = factory.images_revision
         for event in factory.iter_events():
-            event.save_to(fileobj)
+            texts.append(self._section(event, sections, images_revision,
+                                       snapshot))
 
         socks = []
         plugs = []
         for brick in iter(factory.bricks):
-            brick.save_to(fileobj)
+            texts.append(self._section(brick, sections, images_revision,
+                                       snapshot))
             if brick.get_type() == "Qemu":
                 socks.extend(brick.socks)
             plugs.extend(brick.plugs)
 
         for sock in socks:
             t = "sock|{s.brick.name}|{s.nickname}|{s.model}|{s.mac}\n"
-            fileobj.write(t.format(s=sock))
+            texts.append(self._line(sock, sections, t.format(s=sock),
+                                    snapshot))
 
         for plug in plugs:
-            plug.save_to(fileobj)
+            buf = io.StringIO()
+            plug.save_to(buf)
+            texts.append(self._line(plug, sections, buf.getvalue(),
+                                    snapshot))
+
+        # the sections of the deleted objects are dropped
+        self.sections = sections
+        records = None
+        if snapshot:
+            records = [record for obj in sections
+                       for record in sections[obj][2]]
+        return "".join(texts), records
 
     def restore(self, factory, str_or_obj):
         if isinstance(str_or_obj, (str, filepath.FilePath)):
@@ -348,28 +473,89 @@ class ConfigFile:
                 fp = filepath.FilePath(str_or_obj)
             else:
                 fp = str_or_obj
-            restore_backup(fp, fp.sibling(fp.basename() + "~"))
+            fbackup = fp.sibling(fp.basename() + "~")
+            # the snapshot could be newer than the restored backup
+            use_snapshot = not fbackup.exists()
+            restore_backup(fp, fbackup)
             logger.info(open_project, path=fp.path)
-            with open(fp.path,"rt") as fd:
-                self.restore_from(factory, fd)
+            items = None
+            if use_snapshot:
+                items = self.load_snapshot(fp)
+            if items is not None:
+                self.restore_items(factory, items)
+            else:
+                with open(fp.path,"rt") as fd:
+                    self.restore_from(factory, fd)
         else:
             self.restore_from(factory, str_or_obj)
 
+    def load_snapshot(self, fp):
+        """
+        Return the sections and the links saved in the snapshot of the
+        project if it is newer than the project file, None otherwise.
+
+        :type fp: twisted.python.filepath.FilePath
+        :rtype: Optional[List[Union[_configparser.Section,
+                                    _configparser.Link]]]
+        """
+
+        snapshot = snapshot_path(fp)
+        try:
+            if os.stat(snapshot.path).st_mtime_ns < \
+                    os.stat(fp.path).st_mtime_ns:
+                return None
+            with open(snapshot.path, "rt") as fd:
+                return _configparser.load_snapshot(fd)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.failure(snapshot_load_error, path=snapshot.path)
+            return None
+
     def restore_from(self, factory, fileobj):
-        with freeze_notify(factory):
-            for item in _configparser.Parser(fileobj):
-                interfaces.IBuilder(item).load_from(factory, item)
+        self.restore_items(factory, _configparser.Parser(fileobj))
+
+    def restore_items(self, factory, items):
+        # the links are made after all the bricks and their socks are
+        # created
+        links = []
+        with factory.bulk_load():
+            for item in items:
+                if isinstance(item, _configparser.Link) and \
+                        item.type == "link":
+                    links.append(item)
+                else:
+                    interfaces.IBuilder(item).load_from(factory, item)
+            for link in links:
+                interfaces.IBuilder(link).load_from(factory, link)
+
+
+def snapshot_path(fp):
+    """
+    Return the path of the snapshot of the given project file.
+
+    :type fp: twisted.python.filepath.FilePath
+    :rtype: twisted.python.filepath.FilePath
+    """
+
+    return fp.sibling(fp.basename() + ".snapshot")
 
 
 _config = ConfigFile()
 
 
-def save(factory, filename=None):
+def _project_file(filename):
     if filename is None:
         workspace = settings.get("workspace")
         project = settings.get("current_project")
         filename = os.path.join(workspace, project, ".project")
-    _config.save(factory, filename)
+    return filename
+
+
+def save(factory, filename=None):
+    generation = factory.generation
+    _config.save(factory, _project_file(filename))
+    factory.saved_generation = generation
 
 
 def safe_save(factory, filename=None):
@@ -379,9 +565,59 @@ def safe_save(factory, filename=None):
         logger.exception(config_save_error)
 
 
+def autosave(factory, filename=None):
+    """
+    Save the project only if it changed since the last save. The project is
+    serialized here and written in a thread, together with the image cache.
+    A change made while the thread is running leaves the project dirty, so
+    it is saved again the next time.
+
+    Return a deferred that fires with True if the project was saved. The
+    errors are logged.
+
+    :rtype: twisted.internet.defer.Deferred[bool]
+    """
+
+    if not factory.is_dirty():
+        return defer.succeed(False)
+    generation = factory.generation
+    fp = filepath.FilePath(_project_file(filename))
+    logger.debug(config_dump, path=fp.path)
+    try:
+        text, records = _config.dump(factory,
+                                     settings.get("projectsnapshot"))
+    except Exception:
+        logger.failure(config_save_error)
+        return defer.succeed(False)
+    images = None
+    if imagecache.cache.dirty:
+        images = imagecache.cache.dumps()
+        imagecache.cache.dirty = False
+
+    def write():
+        _config.write(text, records, fp)
+        if images is not None:
+            return imagecache.cache.write(images,
+                                          fp.sibling(".imagecache").path)
+        return True
+
+    def saved(images_saved):
+        factory.saved_generation = generation
+        if not images_saved:
+            imagecache.cache.dirty = True
+        return True
+
+    def error(fail):
+        if images is not None:
+            imagecache.cache.dirty = True
+        logger.failure(config_save_error, fail)
+        return False
+
+    d = threads.deferToThread(write)
+    d.addCallbacks(saved, error)
+    return d
+
+
 def restore(factory, filename=None):
-    if filename is None:
-        workspace = settings.get("workspace")
-        project = settings.get("current_project")
-        filename = os.path.join(workspace, project, ".project")
-    _config.restore(factory, filename)
+    _config.restore(factory, _project_file(filename))
+    factory.saved_generation = factory.generation
@@ -23,7 +23,8 @@ import textwrap
 from twisted.internet import interfaces, utils
 from twisted.protocols import basic
 from zope.interface import implementer
-from virtualbricks import __version__, bricks, errors, log, settings
+from virtualbricks import (__version__, bricks, errors, log, observable,
+                           settings, supervisor, tools)
 
 logger = log.Logger()
 socket_error = log.Event("Error on socket")
@@ -81,6 +82,18 @@ def parse(factory, command, console=None):
     protocol.lineReceived(command)
 
 
+def _format_sample(sample):
+    if sample is None:
+        return "-\t-\t-\t-"
+    if sample.cpu_percent is None:
+        cpu = "-"
+    else:
+        cpu = "%.1f" % sample.cpu_percent
+    io = ["-" if value is None else tools.fmtsize(value)
+          for value in (sample.read_bytes, sample.write_bytes)]
+    return "\t".join([cpu, tools.fmtsize(sample.rss)] + io)
+
+
 class Protocol(basic.LineOnlyReceiver):
 
     def __init__(self, factory):
@@ -94,15 +107,17 @@ class Protocol(basic.LineOnlyReceiver):
         parts = line.split()
         if parts:
             handler = getattr(self, "do_" + parts[0], None)
-            if handler is not None:
-                try:
-                    handler(*parts[1:])
-                except TypeError:
-                    self.sendLine("invalid number of arguments")
-                except Exception as e:
-                    self.sendLine(str(e))
-            else:
-                self.default(line)
+            # a command can change many objects, refresh the views once
+            with observable.batch():
+                if handler is not None:
+                    try:
+                        handler(*parts[1:])
+                    except TypeError:
+                        self.sendLine("invalid number of arguments")
+                    except Exception as e:
+                        self.sendLine(str(e))
+                else:
+                    self.default(line)
 
     def sendLine(self, line):
         if isinstance(line, str):
@@ -131,6 +146,10 @@ class VBProtocol(Protocol):
     socks                   List of connections available for bricks
     conn[ections]           List of connections for each bricks
     reset                   Remove all the bricks and events
+    prepare [NAME...]       Create the private disks of the virtual
+                            machines before starting them
+    supervise [NAME POLICY] List the restart policies or set the policy
+                            of NAME (never, on-failure, always)
     quit                    Stop virtualbricks
     event *args             TODO
     brick *args             TODO
@@ -246,10 +265,75 @@ class VBProtocol(Protocol):
         if not procs:
             self.sendLine("No process running")
         else:
-            self.sendLine("PID\tType\tName")
-            self.sendLine("-" * 24)
+            self.sendLine("PID\tType\tName\tCPU%\tRSS\tRead\tWrite")
+            self.sendLine("-" * 56)
             for b in procs:
-                self.sendLine("%d\t%s\t%s" % (b.pid, b.get_type(), b.name))
+                self.sendLine("%d\t%s\t%s\t%s" % (
+                    b.pid, b.get_type(), b.name,
+                    _format_sample(self.factory.resources.latest(b))))
+
+    def do_prepare(self, *names):
+        """Create the private disks of the virtual machines"""
+
+        bricks = None
+        if names:
+            bricks = []
+            for name in names:
+                brick = self.factory.get_brick_by_name(name)
+                if brick is None:
+                    self.sendLine("No such brick '%s'" % name)
+                    return
+                bricks.append(brick)
+
+        def progress(done, total, report):
+            disk = report.disk
+            if report.success:
+                self.sendLine("[%d/%d] %s %s: %s" % (
+                    done, total, disk.vm.name, disk.device, report.path))
+            else:
+                self.sendLine("[%d/%d] %s %s: %s" % (
+                    done, total, disk.vm.name, disk.device,
+                    report.failure.getErrorMessage()))
+
+        def summary(reports):
+            ok = sum(1 for report in reports if report.success)
+            self.sendLine("%d of %d disks prepared" % (ok, len(reports)))
+
+        d = self.factory.prepare_all(bricks, progress=progress)
+        d.addCallback(summary)
+
+    def do_supervise(self, name=None, policy=None):
+        """List or set the restart policies"""
+
+        sup = self.factory.supervisor
+        if name is None:
+            self.sendLine("Name\tPolicy\tRestarts\tState")
+            self.sendLine("-" * 40)
+            for brick in self.factory.bricks:
+                state = sup.state(brick)
+                if state is not None and state.crash_loop:
+                    status = "crash loop"
+                elif state is not None and state.call is not None:
+                    status = "restarting in %ds" % (
+                        state.call.getTime() - sup.clock.seconds())
+                elif brick.proc is not None:
+                    status = "running"
+                else:
+                    status = "stopped"
+                restarts = state.restarts if state is not None else 0
+                self.sendLine("%s\t%s\t%d\t%s" % (
+                    brick.name, sup.policy(brick), restarts, status))
+            return
+        brick = self.factory.get_brick_by_name(name)
+        if brick is None:
+            self.sendLine("No such brick '%s'" % name)
+        elif policy not in supervisor.POLICIES:
+            self.sendLine("Invalid policy '%s', use one of: %s" % (
+                policy, ", ".join(supervisor.POLICIES)))
+        else:
+            brick.set({"restart": policy})
+            if policy == supervisor.NEVER:
+                sup.forget(brick)
 
     def do_reset(self):
         self.factory.reset()
@@ -100,6 +100,38 @@ class NoOptionError(Error):
     '''The config file has no such option.'''
 
 
+class ManagementError(Error):
+    """A command sent to the management console of a brick failed."""
+
+
+class ManagementCommandError(ManagementError):
+    """The management console answered with an error code."""
+
+    def __init__(self, code, message):
+        ManagementError.__init__(self, code, message)
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return "{0} {1}".format(self.code, self.message)
+
+
+class ManagementTimeoutError(ManagementError):
+    """The management console did not answer in time."""
+
+
+class QMPError(ManagementError):
+    """A QMP command failed."""
+
+    def __init__(self, error_class, desc):
+        ManagementError.__init__(self, error_class, desc)
+        self.error_class = error_class
+        self.desc = desc
+
+    def __str__(self):
+        return "{0}: {1}".format(self.error_class, self.desc)
+
+
 class WidgetNotFound(Error):
     """
     A Gtk.Builder resource does not define a specific widget.
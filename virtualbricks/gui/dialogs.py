@@ -661,6 +661,8 @@ class DisksLibraryWindow(_Window):
             self.on_disk_image_changed, tree_model)
         brickfactory.image_removed.connect(
             self.on_disk_image_removed, tree_model)
+        brickfactory.project_loaded.connect(
+            self.on_project_loaded, tree_model)
 
     def _show_edit_screen(self, disk_image):
         """
@@ -696,6 +698,16 @@ class DisksLibraryWindow(_Window):
 
         tree_model.append([disk_image])
 
+    def on_project_loaded(self, brickfactory, tree_model):
+        """
+        :type brickfactory: virtualbricks.brickfactory.BrickFactory
+        :type tree_model: Gtk.TreeModel
+        """
+
+        tree_model.clear()
+        for disk_image in brickfactory.iter_disk_images():
+            tree_model.append([disk_image])
+
     def on_disk_image_changed(self, disk_image, tree_model):
         """
         :type disk_image: virtualbricks.virtualmachines.Image
@@ -776,6 +788,8 @@ class DisksLibraryWindow(_Window):
             self.on_disk_image_changed, self._tree_model)
         self._brickfactory.image_removed.disconnect(
             self.on_disk_image_removed, self._tree_model)
+        self._brickfactory.project_loaded.disconnect(
+            self.on_project_loaded, self._tree_model)
         return True
 
 
@@ -18,6 +18,7 @@
 
 # This module is ported to new GTK3 using PyGObject
 
+import collections
 import os
 import os.path
 import re
@@ -58,41 +59,99 @@ def brick_icon(brick):
         return get_data_filename(brick.get_type().lower() + ".png")
 
 
-def saturate_if_stopped(brick, pixbuf):
-    if not is_running(brick):
-        pixbuf.saturate_and_pixelate(pixbuf, 0.0, True)
-    return pixbuf
+class PixbufCache:
+    """
+    Cache the icons of the bricks, already desaturated if the brick is
+    stopped. The least recently used icons are evicted when the cache is
+    full. The custom icons are loaded again if they change on disk.
+
+    The pixbufs are shared, they must not be modified.
+
+    @ivar max_size: how many pixbufs are kept.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._cache = collections.OrderedDict()
+
+    def _load(self, filename, width, height):
+        if width is None:
+            return GdkPixbuf.Pixbuf.new_from_file(filename)
+        return GdkPixbuf.Pixbuf.new_from_file_at_size(filename, width, height)
+
+    def get(self, filename, width=None, height=None, running=True,
+            check_mtime=False):
+        """
+        Return the icon at the given size, or at its own size if width is
+        None.
+
+        :param check_mtime: if the file can change on disk.
+        :type check_mtime: bool
+        :rtype: GdkPixbuf.Pixbuf
+        """
+
+        mtime = None
+        if check_mtime:
+            try:
+                mtime = os.stat(filename).st_mtime_ns
+            except OSError:
+                pass
+        key = (filename, width, height, running)
+        try:
+            cached_mtime, pixbuf = self._cache[key]
+        except KeyError:
+            pass
+        else:
+            if cached_mtime == mtime:
+                self._cache.move_to_end(key)
+                return pixbuf
+        pixbuf = self._load(filename, width, height)
+        if not running:
+            pixbuf.saturate_and_pixelate(pixbuf, 0.0, True)
+        self._cache[key] = (mtime, pixbuf)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return pixbuf
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+icon_cache = PixbufCache()
+
+
+def _brick_pixbuf(brick, width=None, height=None, running=None):
+    if running is None:
+        running = is_running(brick)
+    return icon_cache.get(brick_icon(brick), width, height, running,
+                          bool(has_custom_icon(brick)))
 
 
 def pixbuf_for_brick_at_size(brick, width, height):
-    filename = brick_icon(brick)
-    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(filename, width, height)
-    return saturate_if_stopped(brick, pixbuf)
+    return _brick_pixbuf(brick, width, height)
 
 
 def pixbuf_for_brick(brick):
-    filename = brick_icon(brick)
-    pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
-    return saturate_if_stopped(brick, pixbuf)
+    return _brick_pixbuf(brick)
 
 
 def pixbuf_for_brick_type(type):
     filename = get_data_filename("%s.png" % type.lower())
     if filename is None:
         return None
-    return GdkPixbuf.Pixbuf.new_from_file(filename)
+    return icon_cache.get(filename)
 
 
 def pixbuf_for_running_brick(brick):
-    return GdkPixbuf.Pixbuf.new_from_file(brick_icon(brick))
+    return _brick_pixbuf(brick, running=True)
 
 
 def pixbuf_for_running_brick_at_size(brick, witdh, height):
-    return GdkPixbuf.Pixbuf.new_from_file_at_size(
-        brick_icon(brick),
-        witdh,
-        height
-    )
+    return _brick_pixbuf(brick, witdh, height, running=True)
 
 
 class Node:
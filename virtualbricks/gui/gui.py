@@ -18,17 +18,20 @@
 
 # This module is ported to new GTK3 using PyGObject
 
+import collections
+import itertools
 import os
 import sys
 import string
+import threading
 
 from gi.repository import GObject, Gdk, Gtk
-from twisted.internet import error, defer, task, protocol, reactor
+from twisted.internet import error, task, protocol, reactor
 from twisted.python import filepath
 from zope.interface import implementer
 
 from virtualbricks import tools, settings, project, log, brickfactory, qemu
-from virtualbricks.spawn import getQemuOutput, qemu_img
+from virtualbricks.spawn import getQemuOutput
 from virtualbricks.bricks import Brick
 from virtualbricks.events import Event
 from virtualbricks.gui import graphics, dialogs, widgets, help
@@ -63,7 +66,7 @@ if False:  # pyflakes
     _ = str
 
 logger = log.Logger()
-sync_error = log.Event("Sync terminated unexpectedly")
+sync_error = log.Event("Cannot flush the new image to disk")
 create_image_error = log.Event("Create image terminated unexpectedly")
 drawing_topology = log.Event("drawing topology")
 top_invalid_format = log.Event("Error saving topology: Invalid image format")
@@ -85,12 +88,12 @@ dnd_source_brick_not_found = log.Event("Cannot find source brick {name}")
 dnd_no_dest = log.Event("No destination brick")
 dnd_same_brick = log.Event("Source and destination bricks are the same.")
 cannot_rename = log.Event("Cannot rename Brick: it is in use.")
-s_r_not_supported = log.Event("Suspend/Resume not supported on this disk.")
 snap_error = log.Event("Error on snapshot")
 resume_vm = log.Event("Resuming virtual machine {name}")
 event_in_use = log.Event("Cannot rename event: it is in use.")
 proc_signal = log.Event("Sending to process signal {signame}!")
 send_acpi = log.Event("send ACPI {acpievent}")
+acpi_error = log.Event("Error sending ACPI {acpievent}")
 proc_restart = log.Event("Restarting process!")
 savevm = log.Event("Save snapshot on virtual machine {name}")
 qemu_version_parsing_error = log.Event("Error while parsing qemu version")
@@ -190,31 +193,7 @@ class VMPopupMenu(BrickPopupMenu):
         return menu
 
     def resume(self, factory):
-
-        def grep(out, pattern):
-            if out.find(pattern) == -1:
-                raise RuntimeError(_("Cannot find suspend point."))
-
-        def loadvm(_):
-            if self.original.proc is not None:
-                self.original.send(b"loadvm virtualbricks\n")
-            else:
-                return self.original.poweron("virtualbricks")
-
-        img = self.original.get("hda")
-        if img.is_cow():
-            path = img.get_cow_path()
-        elif img.image:
-            path = img.image.path
-        else:
-            logger.error(s_r_not_supported)
-            return defer.fail(RuntimeError(_("Suspend/Resume not supported on "
-                                             "this disk.")))
-        output = qemu_img(['snapshot', '-l', path])
-        output.addCallback(grep, "virtualbricks")
-        output.addCallback(loadvm)
-        logger.log_failure(output, snap_error)
-        return output
+        return logger.log_failure(self.original.resume(), snap_error)
 
     def on_resume_activate(self, menuitem, gui):
         logger.debug(resume_vm, name=self.original.get_name())
@@ -383,23 +362,7 @@ class VMJobMenu(JobMenu):
         return menu
 
     def suspend(self, factory):
-        img = self.original.get("hda")
-        if img.is_cow():
-            path = img.get_cow_path()
-        elif img.image:
-            path = img.image.path
-        else:
-            logger.error(s_r_not_supported)
-            return defer.fail(RuntimeError(_("Suspend/Resume not supported on "
-                                             "this disk.")))
-        image_type = tools.image_type_from_file(path)
-        if image_type in (tools.ImageFormat.QCOW2, tools.ImageFormat.QCOW3):
-            self.original.send(b'savevm virtualbricks\n')
-            return self.original.poweroff()
-        else:
-            logger.error(s_r_not_supported)
-            return defer.fail(RuntimeError(_("Suspend/Resume not supported on "
-                                             "this disk.")))
+        return logger.log_failure(self.original.suspend(), snap_error)
 
     def on_suspend_activate(self, menuitem, gui):
         logger.debug(savevm, name=self.original.get_name())
@@ -407,12 +370,15 @@ class VMJobMenu(JobMenu):
         ProgressBar(gui).wait_for(self.suspend(gui.brickfactory))
 
     def on_powerdown_activate(self, menuitem):
-        logger.info(send_acpi, acpievent="powerdown")
-        self.original.send(b"system_powerdown\n")
+        # poweroff() sends the ACPI powerdown and marks the stop as
+        # requested, so the supervisor does not restart the virtual machine
+        self.original.poweroff()
 
     def on_reset_activate(self, menuitem):
         logger.info(send_acpi, acpievent="reset")
-        self.original.send(b"system_reset\n")
+        d = self.original.get_qmp()
+        d.addCallback(lambda client: client.system_reset())
+        logger.log_failure(d, acpi_error, acpievent="reset")
 
     def on_term_activate(self, menuitem, gui):
         logger.debug(proc_signal, signame="SIGTERM")
@@ -1438,35 +1404,20 @@ def config_panel_factory(context):
 registerAdapter(config_panel_factory, Brick, IConfigController)
 
 
-class SyncProtocol(protocol.ProcessProtocol):
-
-    def __init__(self, done):
-        self.done = done
-
-    def processEnded(self, status):
-        if isinstance(status.value, error.ProcessTerminated):
-            logger.failure(sync_error, status)
-            self.done.errback(None)
-        else:
-            self.done.callback(None)
-
-
 class QemuImgCreateProtocol(protocol.ProcessProtocol):
 
-    def __init__(self, done):
+    def __init__(self, done, filename):
         self.done = done
+        self.filename = filename
 
     def processEnded(self, status):
         if isinstance(status.value, error.ProcessTerminated):
             logger.failure(create_image_error, status)
             self.done.errback(None)
         else:
-            reactor.spawnProcess(
-                SyncProtocol(self.done),
-                "sync",
-                ["sync"],
-                os.environ
-            )
+            d = tools.fsync(self.filename)
+            d.addErrback(logger.failure_eb, sync_error, reraise=True)
+            d.chainDeferred(self.done)
 
 
 def state_add_selection(manager, treeview, prerequisite, tooltip, *widgets):
@@ -1733,6 +1684,7 @@ class BricksBindingList(widgets.AbstractBindingList):
         factory.connect("brick-changed", self._on_changed)
 
     def __dispose__(self):
+        widgets.AbstractBindingList.__dispose__(self)
         self._factory.disconnect("brick-added", self._on_added)
         self._factory.disconnect("brick-removed", self._on_removed)
         self._factory.disconnect("brick-changed", self._on_changed)
@@ -1750,6 +1702,7 @@ class EventsBindingList(widgets.AbstractBindingList):
         factory.connect("event-changed", self._on_changed)
 
     def __dispose__(self):
+        widgets.AbstractBindingList.__dispose__(self)
         self._factory.disconnect("event-added", self._on_added)
         self._factory.disconnect("event-removed", self._on_removed)
         self._factory.disconnect("event-changed", self._on_changed)
@@ -1784,6 +1737,7 @@ class VBGUI(TopologyMixin, ReadmeMixin, _Root):
         factory.connect("brick-changed", self.on_brick_changed)
         factory.connect("brick-added", self.on_brick_changed)
         factory.connect("brick-removed", self.on_brick_changed)
+        factory.connect("project-loaded", self.on_brick_changed)
         if settings.get("systray"):
             self.start_systray()
         self.builder.connect_signals(self)
@@ -1861,6 +1815,7 @@ class VBGUI(TopologyMixin, ReadmeMixin, _Root):
         self.factory.disconnect("brick-changed", self.on_brick_changed)
         self.factory.disconnect("brick-added", self.on_brick_changed)
         self.factory.disconnect("brick-removed", self.on_brick_changed)
+        self.factory.disconnect("project-loaded", self.on_brick_changed)
         if self.__bricks_binding_list is not None:
             dispose(self.__bricks_binding_list)
             self.__bricks_binding_list = None
@@ -2100,18 +2055,24 @@ class VBGUI(TopologyMixin, ReadmeMixin, _Root):
 
     def on_btnStartAll_clicked(self, toolbutton):
 
-        def started_all(results):
-            for success, value in results:
-                if not success:
-                    logger.failure(not_started, value)
+        def started_all(reports):
+            for report in reports:
+                if not report.success:
+                    logger.failure(not_started, report.failure)
 
-        l = [brick.poweron() for brick in self.brickfactory.bricks]
-        defer.DeferredList(l, consumeErrors=True).addCallback(started_all)
+        deferred = self.brickfactory.start_all()
+        deferred.addCallbacks(started_all, logger.failure_eb,
+                              errbackArgs=(not_started, ))
         return True
 
     def on_btnStopAll_clicked(self, toolbutton):
-        for brick in self.brickfactory.bricks:
-            brick.poweroff()
+
+        def stopped_all(reports):
+            for report in reports:
+                if not report.success:
+                    logger.failure(stop_error, report.failure)
+
+        self.brickfactory.shutdown_all().addCallback(stopped_all)
         return True
 
     def __show_config_if_selected(self, treeview):
@@ -2317,25 +2278,70 @@ class VisualFactory(brickfactory.BrickFactory):
 
 @implementer(log.ILogObserver)
 class TextBufferObserver:
+    """
+    Show the log events in a text buffer.
+
+    The events are queued and written all together by a single idle
+    callback, the consecutive entries with the same tag are inserted at
+    once. Only the last max_lines lines are kept in the buffer.
 
-    def __init__(self, textbuffer):
+    @ivar max_lines: the lines kept in the buffer, 0 means no limit.
+    """
+
+    entry = "{iso8601_time} [{log_namespace}] {msg}\n{traceback}"
+
+    def __init__(self, textbuffer, max_lines=None):
+        if max_lines is None:
+            max_lines = int(settings.get("loglines"))
         self.textbuffer = textbuffer
+        self.max_lines = max_lines
+        # every event is at least one line, the older ones would be removed
+        # from the buffer anyway
+        self._queue = collections.deque(maxlen=max_lines or None)
+        self._idle = None
+        # the events can be logged by other threads
+        self._lock = threading.Lock()
 
     def __call__(self, event):
-        GObject.idle_add(self.emit, event)
+        with self._lock:
+            self._queue.append(event)
+            if self._idle is None:
+                self._idle = GObject.idle_add(self.drain)
 
-    def emit(self, event):
-        entry = "{iso8601_time} [{log_namespace}] {msg}\n{traceback}"
+    def format(self, event):
         if "log_failure" in event:
-            event["traceback"] = event["log_failure"].getTraceback()
+            traceback = event["log_failure"].getTraceback()
         else:
-            event["traceback"] = ""
-        event["iso8601_time"] = log.format_time(event["log_time"])
-        self.textbuffer.insert_with_tags_by_name(
-            self.textbuffer.get_iter_at_mark(self.textbuffer.get_mark('end')),
-            entry.format(msg=log.formatEvent(event), **event),
-            event["log_level"].name
-        )
+            traceback = ""
+        return self.entry.format(
+            msg=log.formatEvent(event), traceback=traceback,
+            iso8601_time=log.format_time(event["log_time"]),
+            log_namespace=event["log_namespace"])
+
+    def drain(self):
+        """Write the queued events in the buffer."""
+
+        with self._lock:
+            self._idle = None
+            events = self._queue
+            self._queue = collections.deque(maxlen=events.maxlen)
+        end = self.textbuffer.get_mark("end")
+        for tag, run in itertools.groupby(
+                events, lambda event: event["log_level"].name):
+            self.textbuffer.insert_with_tags_by_name(
+                self.textbuffer.get_iter_at_mark(end),
+                "".join(self.format(event) for event in run), tag)
+        self.trim()
+        # remove the idle callback
+        return False
+
+    def trim(self):
+        if self.max_lines:
+            # the last line is the empty one after the last newline
+            excess = self.textbuffer.get_line_count() - 1 - self.max_lines
+            if excess > 0:
+                self.textbuffer.delete(self.textbuffer.get_start_iter(),
+                                       self.textbuffer.get_iter_at_line(excess))
 
 
 class MessageDialogObserver:
@@ -126,6 +126,7 @@ class IBindingList(Interface):
     changed = Attribute("IEvent, emitted when an item is changed")
     added = Attribute("IEvent, emitted when an item is added")
     removed = Attribute("IEvent, emitted when an item is removed")
+    reset = Attribute("IEvent, emitted when all the items are replaced")
 
 
 class IWidgetGetter(Interface):
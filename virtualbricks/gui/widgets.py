@@ -175,6 +175,12 @@ class List(Gtk.ListStore):
             lst.added.connect(self.on_add)
             lst.removed.connect(self.on_remove)
             lst.changed.connect(self.on_changed)
+            lst.reset.connect(self.on_reset)
+
+    def on_reset(self, lst):
+        self.clear()
+        for item in lst:
+            self.append((item, ))
 
     def on_add(self, value):
         self.append((value, ))
@@ -209,10 +215,16 @@ class AbstractBindingList:
 
     def __init__(self, factory):
         self._factory = factory
-        self._observable = observable.Observable("added", "removed", "changed")
+        self._observable = observable.Observable("added", "removed", "changed",
+                                                 "reset")
         self.added = observable.Event(self._observable, "added")
         self.removed = observable.Event(self._observable, "removed")
         self.changed = observable.Event(self._observable, "changed")
+        self.reset = observable.Event(self._observable, "reset")
+        factory.connect("project-loaded", self._on_reset)
+
+    def __dispose__(self):
+        self._factory.disconnect("project-loaded", self._on_reset)
 
     def _on_added(self, obj):
         self._observable.notify("added", obj)
@@ -223,6 +235,9 @@ class AbstractBindingList:
     def _on_changed(self, obj):
         self._observable.notify("changed", obj)
 
+    def _on_reset(self, factory):
+        self._observable.notify("reset", self)
+
 
 class ImagesBindingList(AbstractBindingList):
 
@@ -233,6 +248,7 @@ class ImagesBindingList(AbstractBindingList):
         factory.connect("image-changed", self._on_changed)
 
     def __dispose__(self):
+        AbstractBindingList.__dispose__(self)
         self._factory.disconnect("image-added", self._on_added)
         self._factory.disconnect("image-removed", self._on_removed)
         self._factory.disconnect("image-changed", self._on_changed)
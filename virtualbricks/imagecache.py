@@ -0,0 +1,287 @@
+# -*- test-case-name: virtualbricks.tests.test_imagecache -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Cache of the disk images metadata.
+
+The metadata are read from the image headers and are keyed by the
+(device, inode, mtime, size) of the file, so a changed file is a different
+key and the stale entry is never used. The cache can be saved and loaded
+from a file inside the project.
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from twisted.internet import defer
+
+from virtualbricks import log, tools
+from virtualbricks.spawn import qemu_img_info
+from virtualbricks.tools import ImageFormat, NotCowFileError
+
+
+__all__ = ["ImageInfo", "ImageCache", "cache", "get_info",
+           "get_backing_file", "cached_qemu_img_info"]
+
+logger = log.Logger()
+cache_load_error = log.Event("Cannot load the image cache {path}")
+cache_save_error = log.Event("Cannot save the image cache {path}")
+
+VERSION = 1
+# offset of the virtual size in the headers
+_SIZE_OFFSETS = {
+    ImageFormat.QCOW: 24,
+    ImageFormat.QCOW2: 24,
+    ImageFormat.QCOW3: 24,
+    ImageFormat.COW: 8 + tools.COW_BACKING_FILENAME_SIZE + 4,
+}
+_COW_FORMATS = (ImageFormat.COW, ImageFormat.QCOW, ImageFormat.QCOW2,
+                ImageFormat.QCOW3)
+
+
+@dataclass
+class ImageInfo:
+
+    format: str
+    backing_file: Optional[str]
+    virtual_size: Optional[int]
+    allocated_size: int
+    size: int
+
+    def get_format(self):
+        """:rtype: tools.ImageFormat"""
+
+        return ImageFormat.lookupByName(self.format)
+
+
+def stat_key(st):
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def read_info(path, st):
+    """
+    Read the metadata from the image header.
+
+    :type path: str
+    :type st: os.stat_result
+    :rtype: ImageInfo
+    """
+
+    with open(path, "rb") as fp:
+        header = fp.read(tools.MAX_HEADER_LENGTH)
+    if len(header) < tools.GENERIC_HEADER_LEN:
+        fmt = ImageFormat.RAW
+    else:
+        fmt = tools.image_type(header.ljust(tools.MAX_HEADER_LENGTH, b"\0"))
+        if fmt is ImageFormat.UNKNOWN:
+            fmt = ImageFormat.RAW
+    backing_file = None
+    if fmt in _COW_FORMATS:
+        backing_file = tools.get_backing_file(path)
+    if fmt in _SIZE_OFFSETS:
+        with open(path, "rb") as fp:
+            fp.seek(_SIZE_OFFSETS[fmt])
+            data = fp.read(8)
+        virtual_size = struct.unpack(">Q", data)[0] if len(data) == 8 \
+            else None
+    elif fmt is ImageFormat.RAW:
+        virtual_size = st.st_size
+    else:
+        virtual_size = None
+    return ImageInfo(fmt.name, backing_file, virtual_size,
+                     st.st_blocks * 512, st.st_size)
+
+
+class ImageCache:
+    """
+    @ivar max_entries: how many entries are kept, the least recently used
+        are dropped.
+    """
+
+    max_entries = 4096
+
+    def __init__(self):
+        self.entries = {}
+        self._by_path = {}
+        self._chains = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def clear(self):
+        self.entries.clear()
+        self._by_path.clear()
+        self._chains.clear()
+        self.dirty = False
+
+    def get(self, path, max_age=None):
+        """
+        Return the metadata of the image. If max_age is given and the file
+        was checked less than max_age seconds ago, the file is not even
+        stat'ed, useful when rendering a view.
+
+        :type path: str
+        :type max_age: Optional[float]
+        :rtype: ImageInfo
+        :raises OSError: if the file cannot be read.
+        :raises FileNotFoundError: if the file does not exist.
+        """
+
+        if max_age is not None and path in self._by_path:
+            checked, key = self._by_path[path]
+            if time.monotonic() - checked < max_age and key in self.entries:
+                self.hits += 1
+                return self.entries[key]
+        st = os.stat(path)
+        key = stat_key(st)
+        self._by_path[path] = time.monotonic(), key
+        info = self.entries.pop(key, None)
+        if info is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            info = read_info(path, st)
+            self.dirty = True
+            while len(self.entries) >= self.max_entries:
+                del self.entries[next(iter(self.entries))]
+        # keep the recently used entries at the end
+        self.entries[key] = info
+        return info
+
+    def get_backing_file(self, path):
+        """
+        Like tools.get_backing_file() but cached.
+
+        :type path: str
+        :rtype: Optional[str]
+        :raises NotCowFileError: if the file is not a COW image.
+        """
+
+        info = self.get(path)
+        if info.get_format() not in _COW_FORMATS:
+            raise NotCowFileError()
+        return info.backing_file
+
+    def qemu_img_info(self, path):
+        """
+        Like spawn.qemu_img_info() but qemu-img is run only if a file of the
+        backing chain changed.
+
+        :type path: str
+        :rtype: twisted.internet.defer.Deferred[List[Dict[str, Any]]]
+        """
+
+        if path in self._chains:
+            keys, chain = self._chains[path]
+            try:
+                current = [stat_key(os.stat(image["filename"]))
+                           for image in chain]
+            except (OSError, KeyError):
+                current = None
+            if current == keys:
+                self.hits += 1
+                return defer.succeed(chain)
+        self.misses += 1
+
+        def store(chain):
+            try:
+                keys = [stat_key(os.stat(image["filename"]))
+                        for image in chain]
+            except (OSError, KeyError):
+                pass
+            else:
+                self._chains[path] = keys, chain
+            return chain
+
+        return qemu_img_info(path).addCallback(store)
+
+    def load(self, path):
+        """
+        Add the entries saved in the given file. The errors are logged.
+
+        :type path: str
+        """
+
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+            if data.get("version") != VERSION:
+                return
+            for entry in data["images"]:
+                key = tuple(entry.pop("key"))
+                self.entries.setdefault(key, ImageInfo(**entry))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.failure(cache_load_error, path=path)
+
+    def dumps(self):
+        """
+        Return the entries as text, to be written with write().
+
+        :rtype: str
+        """
+
+        images = [dict(asdict(info), key=list(key))
+                  for key, info in self.entries.items()]
+        return json.dumps({"version": VERSION, "images": images})
+
+    def write(self, text, path):
+        """
+        Write the text returned by dumps() in the given file. This can be
+        called from a thread, the writes are serialized. The errors are
+        logged.
+
+        :type text: str
+        :type path: str
+        :return: if the file was written.
+        :rtype: bool
+        """
+
+        tmp = path + ".tmp"
+        with self._lock:
+            try:
+                with open(tmp, "w") as fp:
+                    fp.write(text)
+                os.replace(tmp, path)
+            except OSError:
+                logger.failure(cache_save_error, path=path)
+                return False
+        return True
+
+    def save(self, path):
+        """
+        Save the entries in the given file. The errors are logged.
+
+        :type path: str
+        """
+
+        if self.write(self.dumps(), path):
+            self.dirty = False
+
+
+cache = ImageCache()
+get_info = cache.get
+get_backing_file = cache.get_backing_file
+cached_qemu_img_info = cache.qemu_img_info
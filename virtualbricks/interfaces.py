@@ -141,3 +141,14 @@ class IProcess(Interface):
 
         @type data: C{bytes}
         """
+
+    def send_command(cmd, timeout=None):
+        """Send a command to the process.
+
+        Return a deferred that fires with the response of the process, if
+        the process does not answer to commands the deferred fires with
+        C{None} once the command is written.
+
+        @type cmd: C{bytes}
+        @type timeout: C{float} or C{None}
+        """
@@ -79,6 +79,7 @@ class Plug:
         assert sock is not None, "Cannot connect a plug to nothing"
         sock.plugs.append(self)
         self.sock = sock
+        self.brick.factory.touch()
 
     def disconnect(self):
         assert self.sock is not None, "Plug not connected"
@@ -86,6 +87,7 @@ class Plug:
                 "sock %r has not reference to %r" % (self.sock, self)
         self.sock.plugs.remove(self)
         self.sock = None
+        self.brick.factory.touch()
 
     def save_to(self, fileobj):
         tmp = "link|{0.brick.name}|{1}|{0.model}|{0.mac}\n"
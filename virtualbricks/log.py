@@ -16,9 +16,12 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import queue
+import threading
 import time
 from datetime import datetime
 import inspect
+import json
 import urllib
 import uuid
 import functools
@@ -44,6 +47,13 @@ __all__ = ["Event", "Logger", "InvalidLogLevelError", "LogLevel",
 def make_id(log_format, module=None):
     if module is None:
         module = inspect.currentframe().f_back.f_back.f_globals["__name__"]
+    return _make_id(log_format, module)
+
+
+# the events created on the fly, from the strings passed to the logger, have
+# the same id every time they are logged, don't compute it again
+@functools.lru_cache(maxsize=4096)
+def _make_id(log_format, module):
     params = urllib.parse.urlencode(dict(format=log_format, module=module))
     uri = "http://virtualbricks.eu/ns/log/?" + params
     return uuid.uuid5(uuid.NAMESPACE_URL, uri)
@@ -203,7 +213,7 @@ class FileLogObserver:
             return time.strftime(self.timeFormat, time.localtime(when))
         return format_time(when)
 
-    def __call__(self, event):
+    def format_event(self, event):
         text = formatEvent(event)
         timeStr = self.format_time(event["log_time"])
         fmtDict = {"system": event["log_namespace"],
@@ -212,11 +222,233 @@ class FileLogObserver:
         msgStr = formatEvent(fmtDict)
         if "log_failure" in event:
             msgStr += event["log_failure"].getTraceback()
+        return timeStr + " " + msgStr
 
-        util.untilConcludes(self.write, timeStr + " " + msgStr)
+    def __call__(self, event):
+        util.untilConcludes(self.write, self.format_event(event))
         util.untilConcludes(self.flush)  # Hoorj!
 
 
+class AsyncWriter:
+    """
+    Write text to a file in a separate thread.
+
+    The text is passed to the writer thread through a bounded queue. The
+    writer writes all the queued text at once and flushes the file when the
+    queue is empty or every flush_interval seconds. When the queue is full
+    the text is dropped, after waiting at most timeout seconds, and the
+    notice returned by drop_notice is written in its place.
+
+    @ivar dropped: how many writes were dropped.
+    @ivar poll_interval: how often, in seconds, the writer thread checks if
+        it was stopped while the queue was full.
+    """
+
+    poll_interval = 0.5
+
+    def __init__(self, f, max_queue=1000, batch_size=100,
+                 flush_interval=1.0, timeout=0, drop_notice=None,
+                 on_error=None, name="virtualbricks-writer"):
+        """
+        :param f: the file-like object or a callable that opens it, called
+            in the writer thread. The files opened by the writer are closed
+            when it stops.
+        :param drop_notice: called in the writer thread with the number of
+            writes dropped, returns the text written in their place.
+        :type drop_notice: Optional[Callable[[int], str]]
+        :param on_error: called in the writer thread with the failure if the
+            file cannot be opened or written.
+        :type on_error: Optional[Callable[[failure.Failure], None]]
+        """
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.drop_notice = drop_notice
+        self.on_error = on_error
+        self.dropped = 0
+        self._file = f
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(max_queue)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name,
+                                        daemon=True)
+        self._thread.start()
+
+    def write(self, text):
+        try:
+            if self.timeout:
+                self._queue.put(text, timeout=self.timeout)
+            else:
+                self._queue.put_nowait(text)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._dropped += 1
+
+    def _notice(self):
+        with self._lock:
+            dropped, self._dropped = self._dropped, 0
+        if dropped and self.drop_notice is not None:
+            return self.drop_notice(dropped)
+        return ""
+
+    def _error(self):
+        if self.on_error is not None:
+            self.on_error(failure.Failure())
+
+    def _run(self):
+        fp = self._file
+        if callable(fp):
+            try:
+                fp = fp()
+            except Exception:
+                self._error()
+                fp = None
+        last_flush = time.monotonic()
+        stopped = False
+        while not stopped:
+            try:
+                records = [self._queue.get(timeout=self.poll_interval)]
+            except queue.Empty:
+                if self._stopping.is_set():
+                    break
+                continue
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                records = [record for record in records if record is not None]
+                stopped = True
+            elif self._stopping.is_set() and self._queue.empty():
+                stopped = True
+            if fp is None:
+                continue
+            data = self._notice() + "".join(records)
+            try:
+                if data:
+                    util.untilConcludes(fp.write, data)
+                now = time.monotonic()
+                if (stopped or self._queue.empty() or
+                        now - last_flush >= self.flush_interval):
+                    util.untilConcludes(fp.flush)
+                    last_flush = now
+            except Exception:
+                self._error()
+        if fp is not None and fp is not self._file:
+            try:
+                fp.close()
+            except Exception:
+                self._error()
+
+    def stop(self, wait=True):
+        """
+        Write the queued text and stop the writer thread.
+
+        The call never blocks if wait is false: when the queue is full the
+        writer thread is stopped once it has written the queued text.
+
+        :param wait: if the caller waits for the thread to stop.
+        :type wait: bool
+        """
+
+        if self._thread.is_alive():
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                self._stopping.set()
+            if wait:
+                self._thread.join()
+
+
+class AsyncFileLogObserver(FileLogObserver):
+    """
+    Log observer that writes to a file-like object in a separate thread.
+
+    The events are formatted in the thread that logs them and the records
+    are written by an L{AsyncWriter}. The number of records dropped when its
+    queue is full is logged in the file.
+
+    If the file is a L{twisted.python.logfile.LogFile}, it is rotated by the
+    writer thread too.
+    """
+
+    def __init__(self, f, max_queue=1000, batch_size=100,
+                 flush_interval=1.0, timeout=0):
+        FileLogObserver.__init__(self, f)
+        # the errors of the log file cannot be logged
+        self.writer = AsyncWriter(f, max_queue, batch_size, flush_interval,
+                                  timeout, self.drop_notice,
+                                  name="virtualbricks-log-writer")
+
+    @property
+    def dropped(self):
+        return self.writer.dropped
+
+    def drop_notice(self, count):
+        return self.format_event({
+            "log_format": "{count} log messages dropped", "count": count,
+            "log_time": time.time(), "log_level": LogLevel.warn,
+            "log_namespace": __name__})
+
+    def __call__(self, event):
+        self.writer.write(self.format_event(event))
+
+    def stop(self):
+        """Write the queued records and stop the writer thread."""
+
+        self.writer.stop()
+
+
+def format_json(event):
+    """
+    Format the event as a JSON object in a single line.
+
+    The brick is the one the event refers to or the one of the process
+    that logged it.
+
+    :rtype: str
+    """
+
+    brick = event.get("brick")
+    if brick is None:
+        brick = getattr(event.get("log_source"), "brick", None)
+    brick = getattr(brick, "name", brick)
+    level = event.get("log_level")
+    log_id = event.get("log_id")
+    record = {
+        "time": event.get("log_time"),
+        "level": level.name if level is not None else None,
+        "namespace": event.get("log_namespace"),
+        "brick": brick,
+        "pid": event.get("pid"),
+        "event_id": str(log_id) if log_id is not None else None,
+        "message": formatEvent(event),
+    }
+    if "log_failure" in event:
+        record["traceback"] = event["log_failure"].getTraceback()
+    return json.dumps(record, default=str) + "\n"
+
+
+class JSONLogObserver(FileLogObserver):
+    """
+    Log observer that writes the events to a file-like object as JSON
+    lines.
+    """
+
+    def format_event(self, event):
+        return format_json(event)
+
+
+class AsyncJSONLogObserver(JSONLogObserver, AsyncFileLogObserver):
+    """
+    Log observer that writes the events as JSON lines in a separate thread.
+    """
+
+
 def format_traceback(event):
     if "log_failure" in event:
         return event["log_failure"].getTraceback()
@@ -15,6 +15,66 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+"""
+Observables and signals.
+
+The notifications are delivered synchronously, unless they are sent inside
+a batch() block. In that case they are queued and every (observable, event,
+emitter) triple is delivered once, in order, when the outermost block ends.
+"""
+
+import contextlib
+
+
+__all__ = ["Event", "Observable", "Signal", "ThawingSignalContextManager",
+           "batch"]
+
+
+class _Batch:
+
+    def __init__(self):
+        self.depth = 0
+        self.pending = {}
+
+    def queue(self, observable, name, emitter):
+        key = id(observable), name, id(emitter)
+        if key not in self.pending:
+            self.pending[key] = observable, name, emitter
+
+    def flush(self):
+        # the observers can send new notifications, deliver them too
+        error = None
+        while self.pending:
+            pending, self.pending = self.pending, {}
+            for observable, name, emitter in pending.values():
+                try:
+                    observable._deliver(name, emitter)
+                except Exception as e:
+                    if error is None:
+                        error = e
+        if error is not None:
+            raise error
+
+
+_batch = _Batch()
+
+
+@contextlib.contextmanager
+def batch():
+    """
+    Queue the notifications sent inside the block and deliver them at the
+    end, once for every observable, event and emitter. Blocks can be nested,
+    the notifications are delivered when the outermost block ends.
+    """
+
+    _batch.depth += 1
+    try:
+        yield
+    finally:
+        _batch.depth -= 1
+        if _batch.depth == 0:
+            _batch.flush()
+
 
 class Observable:
     # TODO: investigate if weakref.WeakValueDictionary can be used to ease the
@@ -48,8 +108,15 @@ class Observable:
     def notify(self, name, emitter):
         assert name in self.__events, f'Event {name} not present'
         if not self._thawed:
-            for callback, args, kwds in self.__events[name]:
-                callback(emitter, *args, **kwds)
+            if _batch.depth:
+                _batch.queue(self, name, emitter)
+            else:
+                self._deliver(name, emitter)
+
+    def _deliver(self, name, emitter):
+        # the observers can disconnect themselves while being notified
+        for callback, args, kwds in list(self.__events[name]):
+            callback(emitter, *args, **kwds)
 
     def __len__(self):
         return len(self.__events)
@@ -63,7 +130,7 @@ class Signal:
     def __init__(self, observable, name):
         self.__observable = observable
         self.__name = name
-        self.__thawed = False
+        self._thawed = False
         try:
             observable.add_event(name)
         except ValueError:
@@ -78,7 +145,7 @@ class Signal:
         self.__observable.remove_observer(self.__name, callback, args, kwds)
 
     def notify(self, emitter):
-        if not self.__thawed:
+        if not self._thawed:
             self.__observable.notify(self.__name, emitter)
 
     def thaw(self):
@@ -89,14 +156,20 @@ Event = Signal
 
 
 class ThawingSignalContextManager:
+    """
+    Suppress, and discard, the notifications of a signal or of an observable
+    inside the block. The same context manager can be entered more than
+    once.
+    """
 
     def __init__(self, signal_or_observer):
         self.context = signal_or_observer
-        self.count = 0
+        self.counter = 0
 
     def __enter__(self):
         self.counter += 1
         self.context._thawed = True
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         if self.counter > 0:
@@ -0,0 +1,187 @@
+# -*- test-case-name: virtualbricks.tests.test_output -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Capture the output of the processes of the bricks.
+
+The output is split in lines and the lines are logged in batches, at most
+one event per stream every interval (half a second), instead of one event
+for every chunk read from the process. Every brick can log at most a number
+of lines per second, the others are dropped and counted. The last lines are
+always kept in memory and all of them can be written in a file, by a
+separate thread.
+"""
+
+import collections
+import locale
+
+from virtualbricks import log
+
+
+__all__ = ["ProcessOutput"]
+
+logger = log.Logger()
+output_lines = log.Event("{lines}")
+output_dropped = log.Event("{brick}: {count} lines of output dropped, "
+                           "{total} in total")
+sink_error = log.Event("Cannot write the output of {brick} in {path}")
+
+OUT = "out"
+ERR = "err"
+
+
+class ProcessOutput:
+    """
+    @ivar interval: seconds between two flushes.
+    @ivar rate: lines per second logged, with bursts up to the same number
+        of lines; 0 means no limit.
+    @ivar lines: the last lines, as (stream, line) pairs.
+    @ivar dropped: how many lines were not logged because of the rate limit.
+    """
+
+    interval = 0.5
+    max_lines = 1000
+    encoding = locale.getpreferredencoding(False)
+
+    def __init__(self, process, rate=0, sink=None):
+        """
+        :param process: the process whose logger and clock are used.
+        :type process: virtualbricks.bricks.Process
+        :param sink: the path of a file where all the lines are appended.
+        :type sink: Optional[str]
+        """
+
+        self.process = process
+        self.rate = rate
+        self.lines = collections.deque(maxlen=self.max_lines)
+        self.dropped = 0
+        self._dropped = 0
+        self._partial = {OUT: "", ERR: ""}
+        self._pending = {OUT: [], ERR: []}
+        self._tokens = rate
+        self._refilled = None
+        self._call = None
+        self._sink = None
+        self._sink_path = sink
+        self._sink_failed = False
+        if sink:
+            self._sink = log.AsyncWriter(
+                lambda: open(sink, "a"), drop_notice=self._sink_dropped,
+                on_error=self._sink_error, name="virtualbricks-output-sink")
+
+    def _brick_name(self):
+        return self.process.brick.name
+
+    def out_received(self, data):
+        self._received(OUT, data)
+
+    def err_received(self, data):
+        self._received(ERR, data)
+
+    def _received(self, stream, data):
+        if isinstance(data, bytes):
+            data = data.decode(self.encoding, "replace")
+        lines = (self._partial[stream] + data).split("\n")
+        self._partial[stream] = lines.pop()
+        if lines:
+            self._add_lines(stream, lines)
+
+    def _allowed(self, count):
+        if not self.rate:
+            return count
+        now = self.process.clock.seconds()
+        if self._refilled is not None:
+            self._tokens = min(self.rate, self._tokens +
+                               (now - self._refilled) * self.rate)
+        self._refilled = now
+        allowed = min(count, int(self._tokens))
+        self._tokens -= allowed
+        return allowed
+
+    def _add_lines(self, stream, lines):
+        self.lines.extend((stream, line) for line in lines)
+        self._write_sink("".join(line + "\n" for line in lines))
+        allowed = self._allowed(len(lines))
+        self._pending[stream].extend(lines[:allowed])
+        self._dropped += len(lines) - allowed
+        if self._call is None:
+            self._call = self.process.clock.callLater(self.interval,
+                                                      self.flush)
+
+    def _write_sink(self, data):
+        if self._sink is not None:
+            self._sink.write(data)
+
+    def _sink_dropped(self, count):
+        return "[{0} writes of output dropped]\n".format(count)
+
+    def _sink_error(self, fail):
+        # called by the writer thread, log only the first error
+        if not self._sink_failed:
+            self._sink_failed = True
+            logger.failure(sink_error, fail, brick=self._brick_name(),
+                           path=self._sink_path)
+
+    def flush(self):
+        """Log the pending lines, one event for every stream."""
+
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        out, err = self._pending[OUT], self._pending[ERR]
+        self._pending = {OUT: [], ERR: []}
+        if out:
+            self.process.logger.info(output_lines, lines="\n".join(out))
+        if err:
+            self.process.logger.error(output_lines, lines="\n".join(err),
+                                      hide_to_user=True)
+        if self._dropped:
+            self.dropped += self._dropped
+            self.process.logger.warn(output_dropped,
+                                     brick=self._brick_name(),
+                                     count=self._dropped, total=self.dropped)
+            self._dropped = 0
+
+    def close(self):
+        """Flush the incomplete lines too and close the sink."""
+
+        for stream, partial in self._partial.items():
+            if partial:
+                self._partial[stream] = ""
+                self._add_lines(stream, [partial])
+        self.flush()
+        self._close_sink()
+
+    def _close_sink(self):
+        sink, self._sink = self._sink, None
+        if sink is not None:
+            # do not wait for the pending writes
+            sink.stop(wait=False)
+
+    def tail(self, count=None):
+        """
+        Return the last lines of output.
+
+        :type count: Optional[int]
+        :rtype: List[str]
+        """
+
+        lines = [line for stream, line in self.lines]
+        if count is not None:
+            lines = lines[-count:] if count else []
+        return lines
@@ -25,7 +25,7 @@ from twisted.internet import utils, error, defer
 from twisted.python import filepath
 
 from virtualbricks import (settings, configfile, log, errors, _configparser,
-                           tools)
+                           tools, imagecache)
 
 
 logger = log.Logger()
@@ -211,6 +211,10 @@ class Project:
     def _project(self):
         return self._path.child(".project")
 
+    @property
+    def _imagecache(self):
+        return self._path.child(".imagecache")
+
     def delete(self):
         try:
             self._path.remove()
@@ -248,6 +252,7 @@ class Project:
             if e.errno in (errno.ENOENT, errno.ENOTDIR):
                 raise errors.ProjectNotExistsError(self.name)
             raise
+        imagecache.cache.load(self._imagecache.path)
         # if an exception is raised, this value is not changed, i.e. it
         # is the default
         self._manager.current = self
@@ -289,6 +294,8 @@ class Project:
                     self.create()
                     return self.save(factory, True)
             raise
+        if imagecache.cache.dirty:
+            imagecache.cache.save(self._imagecache.path)
         if self._description_modified:
             text = self._description
             with open(self._path.child('README').path, 'wt') as fp:
@@ -0,0 +1,365 @@
+# -*- test-case-name: virtualbricks.tests.test_qmp -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Asynchronous client for the QEMU Machine Protocol (QMP).
+
+QMP speaks JSON, one message per line, over a ``-chardev socket`` of the
+virtual machine. The server greets the client, the client negotiates the
+capabilities and then every command is sent with an ``id`` that is used to
+match its answer. The asynchronous events (SHUTDOWN, STOP, RESUME, ...) are
+dispatched to the listeners.
+"""
+
+import itertools
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.protocols import basic
+
+from virtualbricks import errors, log
+
+
+if False:  # pyflakes
+    _ = str
+
+
+__all__ = ["BlockDevice", "BlockStats", "QMPEvent", "QMPProtocol", "Status",
+           "connect"]
+
+logger = log.Logger()
+invalid_message = log.Event("Invalid QMP message: {line!r}")
+unexpected_answer = log.Event("QMP answer to unknown command: {message}")
+event_received = log.Event("QMP event {name}: {data}")
+listener_failed = log.Event("QMP event listener failed")
+connect_retry = log.Event("Cannot connect to QMP socket, retrying in "
+                          "{delay} seconds")
+
+
+@dataclass
+class Status:
+    """The answer of query-status."""
+
+    status: str
+    running: bool
+    singlestep: bool = False
+
+
+@dataclass
+class QMPEvent:
+
+    name: str
+    data: Dict[str, Any] = field(default_factory=dict)
+    timestamp: Optional[float] = None
+
+
+@dataclass
+class BlockDevice:
+    """A block device, as returned by query-block."""
+
+    device: str
+    file: Optional[str] = None
+    format: Optional[str] = None
+    backing_file: Optional[str] = None
+    read_only: bool = False
+    snapshots: List[str] = field(default_factory=list)
+
+    @classmethod
+    def from_qmp(cls, info):
+        inserted = info.get("inserted")
+        if not inserted:
+            return cls(info["device"])
+        image = inserted.get("image", {})
+        snapshots = [s["name"] for s in image.get("snapshots", ())]
+        return cls(info["device"], inserted.get("file"), inserted.get("drv"),
+                   inserted.get("backing_file"), inserted.get("ro", False),
+                   snapshots)
+
+
+@dataclass
+class BlockStats:
+    """The I/O statistics of a block device, as returned by
+    query-blockstats."""
+
+    device: str
+    rd_bytes: int = 0
+    wr_bytes: int = 0
+    rd_operations: int = 0
+    wr_operations: int = 0
+    flush_operations: int = 0
+
+    @classmethod
+    def from_qmp(cls, info):
+        stats = info.get("stats", {})
+        return cls(info.get("device") or info.get("qdev", ""),
+                   stats.get("rd_bytes", 0), stats.get("wr_bytes", 0),
+                   stats.get("rd_operations", 0),
+                   stats.get("wr_operations", 0),
+                   stats.get("flush_operations", 0))
+
+
+def _timestamp(message):
+    stamp = message.get("timestamp")
+    if stamp is None:
+        return None
+    return stamp["seconds"] + stamp["microseconds"] / 1e6
+
+
+class QMPProtocol(basic.LineOnlyReceiver):
+    """
+    The client side of QMP.
+
+    @ivar ready: a deferred that fires with the protocol when the
+        capabilities are negotiated.
+    @ivar greeting: the greeting of the server.
+    @cvar COMMAND_TIMEOUT: default seconds to wait for an answer, None to
+        wait forever.
+    """
+
+    delimiter = b"\n"
+    MAX_LENGTH = 1 << 20
+    COMMAND_TIMEOUT = 30.0
+    clock = reactor
+    greeting = None
+
+    def __init__(self):
+        self.ready = defer.Deferred()
+        self._ids = itertools.count()
+        self._pending = {}
+        self._listeners = []
+        self._waiters = []
+        self.connected = False
+
+    def connectionMade(self):
+        self.connected = True
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            logger.warn(invalid_message, line=line)
+            return
+        if "QMP" in message:
+            self.greeting = message["QMP"]
+            d = self.execute("qmp_capabilities")
+            d.addCallbacks(lambda _: self.ready.callback(self),
+                           self.ready.errback)
+        elif "event" in message:
+            self._event_received(QMPEvent(message["event"],
+                                          message.get("data", {}),
+                                          _timestamp(message)))
+        elif message.get("id") in self._pending:
+            deferred, call = self._pending.pop(message["id"])
+            if call.active():
+                call.cancel()
+            if "error" in message:
+                err = message["error"]
+                deferred.errback(errors.QMPError(err.get("class"),
+                                                 err.get("desc", "")))
+            else:
+                deferred.callback(message.get("return"))
+        else:
+            logger.debug(unexpected_answer, message=message)
+
+    def connectionLost(self, reason=error.ConnectionDone):
+        self.connected = False
+        exc = errors.ManagementError(_("QMP connection lost"))
+        pending, self._pending = self._pending, {}
+        for deferred, call in pending.values():
+            if call.active():
+                call.cancel()
+            deferred.errback(exc)
+        waiters, self._waiters = self._waiters, []
+        for name, deferred in waiters:
+            deferred.errback(exc)
+        if not self.ready.called:
+            self.ready.errback(exc)
+
+    def _event_received(self, event):
+        logger.debug(event_received, name=event.name, data=event.data)
+        for listener in list(self._listeners):
+            try:
+                listener(event)
+            except Exception:
+                logger.failure(listener_failed)
+        waiters = [w for w in self._waiters if w[0] == event.name]
+        self._waiters = [w for w in self._waiters if w[0] != event.name]
+        for name, deferred in waiters:
+            deferred.callback(event)
+
+    def _timeout(self, command_id, command):
+        deferred, call = self._pending.pop(command_id)
+        deferred.errback(errors.ManagementTimeoutError(command))
+
+    # events
+
+    def add_listener(self, callback):
+        """
+        Call callback with every QMPEvent received.
+
+        :type callback: Callable[[QMPEvent], None]
+        """
+
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def wait_for_event(self, name):
+        """
+        Return a deferred that fires with the next event with the given
+        name.
+
+        :type name: str
+        :rtype: twisted.internet.defer.Deferred[QMPEvent]
+        """
+
+        if not self.connected:
+            return defer.fail(errors.ManagementError(
+                _("QMP not connected")))
+        deferred = defer.Deferred()
+        self._waiters.append((name, deferred))
+        return deferred
+
+    # commands
+
+    def execute(self, command, arguments=None, timeout=None):
+        """
+        Execute a QMP command. Return a deferred that fires with the value
+        returned by the command or fails with QMPError if the command fails
+        or with ManagementTimeoutError if the answer does not arrive in time.
+
+        :type command: str
+        :type arguments: Optional[Dict[str, Any]]
+        :param timeout: seconds to wait for the answer, COMMAND_TIMEOUT if
+            None.
+        :type timeout: Optional[float]
+        :rtype: twisted.internet.defer.Deferred[Any]
+        """
+
+        if not self.connected:
+            return defer.fail(errors.ManagementError(
+                _("QMP not connected")))
+        if timeout is None:
+            timeout = self.COMMAND_TIMEOUT
+        command_id = next(self._ids)
+        message = {"execute": command, "id": command_id}
+        if arguments:
+            message["arguments"] = arguments
+        deferred = defer.Deferred()
+        call = self.clock.callLater(timeout, self._timeout, command_id,
+                                    command)
+        self._pending[command_id] = deferred, call
+        self.sendLine(json.dumps(message).encode("utf-8"))
+        return deferred
+
+    def query_status(self):
+        """:rtype: twisted.internet.defer.Deferred[Status]"""
+
+        return self.execute("query-status").addCallback(
+            lambda r: Status(r["status"], r["running"],
+                             r.get("singlestep", False)))
+
+    def stop(self):
+        return self.execute("stop")
+
+    def cont(self):
+        return self.execute("cont")
+
+    def system_powerdown(self):
+        return self.execute("system_powerdown")
+
+    def system_reset(self):
+        return self.execute("system_reset")
+
+    def quit(self):
+        return self.execute("quit")
+
+    def query_block(self):
+        """:rtype: twisted.internet.defer.Deferred[List[BlockDevice]]"""
+
+        return self.execute("query-block").addCallback(
+            lambda r: [BlockDevice.from_qmp(info) for info in r])
+
+    def query_blockstats(self):
+        """:rtype: twisted.internet.defer.Deferred[List[BlockStats]]"""
+
+        return self.execute("query-blockstats").addCallback(
+            lambda r: [BlockStats.from_qmp(info) for info in r])
+
+    def human_monitor_command(self, command_line, timeout=None):
+        """
+        Execute a command of the human monitor, for the commands that have
+        no QMP counterpart in all the supported versions of qemu. The
+        human monitor reports the errors as text, any output is considered
+        an error.
+
+        :type command_line: str
+        :rtype: twisted.internet.defer.Deferred[None]
+        """
+
+        def check(output):
+            if output and output.strip():
+                raise errors.QMPError("GenericError", output.strip())
+
+        d = self.execute("human-monitor-command",
+                         {"command-line": command_line}, timeout)
+        return d.addCallback(check)
+
+    def savevm(self, name, timeout=None):
+        return self.human_monitor_command("savevm %s" % name, timeout)
+
+    def loadvm(self, name, timeout=None):
+        return self.human_monitor_command("loadvm %s" % name, timeout)
+
+    def commit(self, device="all", timeout=None):
+        return self.human_monitor_command("commit %s" % device, timeout)
+
+
+def connect(endpoint, retries=10, delay=0.2, clock=None):
+    """
+    Connect to the QMP socket and negotiate the capabilities. qemu creates
+    the socket some time after the process is started so the connection is
+    retried a few times.
+
+    :type endpoint: twisted.internet.interfaces.IStreamClientEndpoint
+    :type retries: int
+    :type delay: float
+    :type clock: Optional[twisted.internet.interfaces.IReactorTime]
+    :rtype: twisted.internet.defer.Deferred[QMPProtocol]
+    """
+
+    if clock is None:
+        clock = reactor
+
+    def retry(failure, retries):
+        failure.trap(error.ConnectError)
+        if retries <= 0:
+            return failure
+        logger.debug(connect_retry, delay=delay)
+        d = task.deferLater(clock, delay, endpoint.connect, factory)
+        d.addErrback(retry, retries - 1)
+        return d
+
+    factory = protocol.Factory.forProtocol(QMPProtocol)
+    d = endpoint.connect(factory)
+    d.addErrback(retry, retries)
+    d.addCallback(lambda protocol: protocol.ready)
+    return d
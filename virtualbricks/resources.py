@@ -0,0 +1,247 @@
+# -*- test-case-name: virtualbricks.tests.test_resources -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+CPU, memory and I/O used by the processes of the bricks.
+
+The resources are read from /proc/<pid>/stat, status and io of all the
+running bricks at once, every few seconds, and the last samples of every
+brick are kept.
+"""
+
+import collections
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from twisted.internet import task
+
+from virtualbricks import log, settings
+
+
+__all__ = ["ResourceSampler", "Sample", "read_sample"]
+
+logger = log.Logger()
+sample_error = log.Event("Cannot sample the resources of {brick} "
+                         "(pid: {pid})")
+sampler_stopped = log.Event("Resource sampler stopped")
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+@dataclass
+class Sample:
+    """
+    @ivar time: when the sample was taken, in seconds.
+    @ivar cpu_time: user and system time of the process, in seconds.
+    @ivar cpu_percent: the cpu used since the previous sample, None for the
+        first sample of a process.
+    @ivar rss, rss_peak, swap: the memory of the process, in bytes.
+    @ivar read_bytes, write_bytes: the bytes read and written on storage,
+        None if /proc/<pid>/io is not readable, i.e. the process runs as
+        another user.
+    """
+
+    time: float
+    cpu_time: float
+    cpu_percent: Optional[float]
+    rss: int
+    rss_peak: int
+    swap: int
+    threads: int
+    read_bytes: Optional[int] = None
+    write_bytes: Optional[int] = None
+
+
+def _read(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, 4096)
+    finally:
+        os.close(fd)
+
+
+def _fields(data, names):
+    values = {}
+    for line in data.splitlines():
+        name, sep, value = line.partition(b":")
+        if name in names:
+            values[name] = int(value.split()[0])
+    return values
+
+
+def read_sample(pid, now, previous=None, proc="/proc"):
+    """
+    Read the resources used by the process.
+
+    :type pid: int
+    :param now: the time of the sample.
+    :type now: float
+    :param previous: the previous sample of the same process.
+    :type previous: Optional[Sample]
+    :type proc: str
+    :rtype: Sample
+    :raises OSError: if the process does not exist anymore.
+    """
+
+    base = "%s/%d/" % (proc, pid)
+    stat = _read(base + "stat")
+    # the command name can contain spaces and parenthesis
+    fields = stat[stat.rindex(b")") + 2:].split()
+    cpu_time = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    status = _fields(_read(base + "status"), (b"VmHWM", b"VmSwap"))
+    cpu_percent = None
+    if previous is not None and now > previous.time:
+        cpu_percent = (100.0 * (cpu_time - previous.cpu_time) /
+                       (now - previous.time))
+    sample = Sample(now, cpu_time, cpu_percent,
+                    rss=int(fields[21]) * PAGE_SIZE,
+                    rss_peak=status.get(b"VmHWM", 0) * 1024,
+                    swap=status.get(b"VmSwap", 0) * 1024,
+                    threads=int(fields[17]))
+    try:
+        io = _fields(_read(base + "io"), (b"read_bytes", b"write_bytes"))
+    except OSError:
+        # owned by another user or no I/O accounting in the kernel
+        pass
+    else:
+        sample.read_bytes = io.get(b"read_bytes")
+        sample.write_bytes = io.get(b"write_bytes")
+    return sample
+
+
+class ResourceSampler:
+    """
+    Sample the resources of the running bricks of a factory.
+
+    @ivar interval: seconds between two samples, from the "sampleinterval"
+        setting if not given.
+    @ivar history_size: how many samples are kept for every brick, from
+        the "samplehistory" setting if not given.
+    """
+
+    def __init__(self, factory, interval=None, history=None, clock=None,
+                 proc="/proc"):
+        self.factory = factory
+        self.interval = interval
+        self.history_size = history
+        self.clock = clock
+        self.proc = proc
+        # brick -> (pid, deque of samples)
+        self._samples = {}
+        self._loop = None
+
+    @property
+    def running(self):
+        return self._loop is not None and self._loop.running
+
+    def start(self):
+        """Sample the bricks every interval seconds."""
+
+        if self.running:
+            return
+        if self.interval is None:
+            self.interval = float(settings.get("sampleinterval"))
+        self._loop = task.LoopingCall(self.sample)
+        if self.clock is not None:
+            self._loop.clock = self.clock
+        self._loop.start(self.interval).addErrback(logger.failure_eb,
+                                                   sampler_stopped)
+
+    def stop(self):
+        if self.running:
+            self._loop.stop()
+        self._loop = None
+
+    def _now(self):
+        if self.clock is None:
+            from twisted.internet import reactor
+            return reactor.seconds()
+        return self.clock.seconds()
+
+    def sample(self):
+        """
+        Sample all the running bricks at once. The history of the bricks
+        that are not running anymore is dropped.
+        """
+
+        if self.history_size is None:
+            self.history_size = int(settings.get("samplehistory"))
+        now = self._now()
+        samples = {}
+        for brick in self.factory.bricks:
+            pid = brick.pid
+            if pid <= 0:
+                continue
+            last_pid, history = self._samples.get(brick, (None, None))
+            if last_pid != pid:
+                history = collections.deque(maxlen=self.history_size)
+            previous = history[-1] if history else None
+            try:
+                history.append(read_sample(pid, now, previous, self.proc))
+            except FileNotFoundError:
+                # the process just ended
+                continue
+            except (OSError, ValueError, IndexError):
+                logger.failure(sample_error, brick=brick.name, pid=pid)
+                continue
+            samples[brick] = pid, history
+        self._samples = samples
+
+    def latest(self, brick):
+        """
+        Return the last sample of the brick, None if it was never sampled.
+
+        :type brick: virtualbricks.bricks.Brick
+        :rtype: Optional[Sample]
+        """
+
+        try:
+            return self._samples[brick][1][-1]
+        except (KeyError, IndexError):
+            return None
+
+    def history(self, brick):
+        """
+        Return the samples of the brick, the oldest first.
+
+        :type brick: virtualbricks.bricks.Brick
+        :rtype: List[Sample]
+        """
+
+        try:
+            return list(self._samples[brick][1])
+        except KeyError:
+            return []
+
+    def top(self, key="cpu_percent", count=None):
+        """
+        Return the (brick, sample) pairs sorted by the given sample
+        attribute, the highest first, i.e. to find the guests that use more
+        cpu or memory.
+
+        :type key: str
+        :type count: Optional[int]
+        :rtype: List[Tuple[virtualbricks.bricks.Brick, Sample]]
+        """
+
+        pairs = [(brick, history[-1])
+                 for brick, (pid, history) in self._samples.items()]
+        pairs.sort(key=lambda pair: getattr(pair[1], key) or 0, reverse=True)
+        return pairs[:count]
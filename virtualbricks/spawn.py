@@ -130,7 +130,7 @@ def qemu_img_info(path):
     :rtype: twisted.internet.defer.Deferred[List[Dict[str, Any]]]
     """
 
-    args = ['info', '--format=json', '--backing-chain', str(path)]
+    args = ['info', '--output=json', '--backing-chain', str(path)]
     deferred = qemu_img(args)
     deferred.addCallback(json.loads)
     deferred.addErrback(logger.failure_eb, qemu_info_failed, reraise=True)
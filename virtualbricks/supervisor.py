@@ -0,0 +1,240 @@
+# -*- test-case-name: virtualbricks.tests.test_supervisor -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Restart the bricks whose process ended unexpectedly.
+
+Every brick has a "restart" policy in its configuration: "never", the
+default, "on-failure", to restart it only if the process exited with an
+error or was killed by a signal, and "always". A process stopped with
+poweroff() is never restarted.
+
+The restarts are delayed, the delay doubles after every crash. A brick that
+crashes too many times in a short period is in a crash loop and it is not
+restarted anymore, until it is started again by hand. When a brick comes
+back, the supervised bricks plugged into it are restarted too, because their
+connection to it is lost. A suspended virtual machine is not restarted
+either.
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, List
+
+from twisted.internet import error
+from twisted.python import failure
+
+from virtualbricks import log, topology
+from virtualbricks.tools import is_running
+
+
+__all__ = ["ALWAYS", "NEVER", "ON_FAILURE", "POLICIES", "RestartState",
+           "Supervisor"]
+
+NEVER = "never"
+ON_FAILURE = "on-failure"
+ALWAYS = "always"
+POLICIES = (NEVER, ON_FAILURE, ALWAYS)
+
+logger = log.Logger()
+restart_scheduled = log.Event("{brick} ended unexpectedly, restarting in "
+                              "{delay} seconds")
+restarting = log.Event("Restarting {brick}")
+restart_failed = log.Event("Cannot restart {brick}")
+crash_loop = log.Event("{brick} crashed {count} times in {window} seconds, "
+                       "it will not be restarted")
+restarting_dependents = log.Event("{brick} restarted, restarting "
+                                  "{dependents}")
+invalid_policy = log.Event("Invalid restart policy {policy} for {brick}")
+
+
+@dataclass
+class RestartState:
+
+    restarts: int = 0
+    # when the last crashes happened
+    crashes: List[float] = field(default_factory=list)
+    call: Any = None
+    crash_loop: bool = False
+
+
+class Supervisor:
+    """
+    @ivar delay: seconds before the first restart, doubled after every
+        crash up to max_delay.
+    @ivar crash_limit: how many crashes in crash_window seconds are allowed
+        before giving up.
+    @ivar states: the RestartState of the supervised bricks that crashed.
+    """
+
+    delay = 1.0
+    max_delay = 60.0
+    crash_limit = 5
+    crash_window = 60.0
+
+    def __init__(self, factory, clock=None):
+        self.factory = factory
+        self.states = {}
+        self._clock = clock
+
+    @property
+    def clock(self):
+        if self._clock is None:
+            from twisted.internet import reactor
+            self._clock = reactor
+        return self._clock
+
+    def policy(self, brick):
+        """
+        :type brick: virtualbricks.bricks.Brick
+        :rtype: str
+        """
+
+        policy = brick.config.get("restart", NEVER)
+        if policy not in POLICIES:
+            logger.warn(invalid_policy, policy=policy, brick=brick.name)
+            return NEVER
+        return policy
+
+    def state(self, brick):
+        """
+        Return the RestartState of the brick, None if it never crashed.
+
+        :type brick: virtualbricks.bricks.Brick
+        :rtype: Optional[RestartState]
+        """
+
+        return self.states.get(brick)
+
+    def forget(self, brick):
+        """
+        Cancel the pending restart of the brick and clear its crashes.
+
+        :type brick: virtualbricks.bricks.Brick
+        """
+
+        state = self.states.pop(brick, None)
+        if state is not None and state.call is not None:
+            if state.call.active():
+                state.call.cancel()
+            state.call = None
+
+    def process_started(self, brick):
+        """
+        Called when the process of the brick started. A brick in a crash
+        loop is started only by hand, it is supervised again.
+
+        :type brick: virtualbricks.bricks.Brick
+        """
+
+        state = self.states.get(brick)
+        if state is not None and state.crash_loop:
+            state.crash_loop = False
+            state.crashes = []
+
+    def process_ended(self, brick, status, requested=False):
+        """
+        Called when the process of the brick ended. If the brick was not
+        stopped on request, restart it according to its policy.
+
+        :type brick: virtualbricks.bricks.Brick
+        :param status: the reason the process ended, Process passes the
+            description instead of the failure if the process was
+            terminated.
+        :type status: Union[twisted.python.failure.Failure, str, None]
+        :param requested: if the brick was stopped with poweroff().
+        :type requested: bool
+        """
+
+        if requested:
+            self.forget(brick)
+            return
+        policy = self.policy(brick)
+        failed = not (status is None or
+                      isinstance(status, failure.Failure) and
+                      status.check(error.ProcessDone))
+        if policy == ALWAYS or (policy == ON_FAILURE and failed):
+            self._schedule(brick)
+
+    def _schedule(self, brick):
+        state = self.states.setdefault(brick, RestartState())
+        if state.call is not None:
+            return
+        now = self.clock.seconds()
+        state.crashes = [t for t in state.crashes
+                         if now - t < self.crash_window]
+        state.crashes.append(now)
+        if len(state.crashes) > self.crash_limit:
+            state.crash_loop = True
+            logger.error(crash_loop, brick=brick.name,
+                         count=len(state.crashes), window=self.crash_window)
+            return
+        delay = min(self.delay * 2 ** (len(state.crashes) - 1),
+                    self.max_delay)
+        logger.warn(restart_scheduled, brick=brick.name, delay=delay)
+        state.call = self.clock.callLater(delay, self._restart, brick)
+
+    def _restart(self, brick):
+        self.states[brick].call = None
+        if (brick not in self.factory.bricks or is_running(brick) or
+                self.policy(brick) == NEVER):
+            return
+        logger.info(restarting, brick=brick.name)
+        d = brick.poweron()
+        d.addCallbacks(self._restarted, self._restart_failed,
+                       errbackArgs=(brick, ))
+        return d
+
+    def _restart_failed(self, fail, brick):
+        logger.failure(restart_failed, fail, brick=brick.name)
+        self._schedule(brick)
+
+    def _restarted(self, brick):
+        self.states[brick].restarts += 1
+        dependents = self.dependents(brick)
+        if dependents:
+            logger.info(restarting_dependents, brick=brick.name,
+                        dependents=", ".join(b.name for b in dependents))
+            for dependent in dependents:
+                state = self.states.get(dependent)
+                if state is not None and state.call is not None:
+                    state.call.cancel()
+                    state.call = None
+            d = topology.stop(dependents, clock=self.clock)
+            d.addCallback(lambda _: topology.start(dependents,
+                                                   clock=self.clock))
+            d.addErrback(logger.failure_eb, restart_failed,
+                         brick=", ".join(b.name for b in dependents))
+
+    def dependents(self, brick):
+        """
+        Return the supervised bricks plugged into the given brick that are
+        running or waiting to be restarted.
+
+        :type brick: virtualbricks.bricks.Brick
+        :rtype: List[virtualbricks.bricks.Brick]
+        """
+
+        dependents = []
+        for other, upstream in topology.dependencies(
+                self.factory.bricks).items():
+            if brick in upstream and self.policy(other) != NEVER:
+                state = self.states.get(other)
+                if is_running(other) or (state is not None and
+                                         state.call is not None):
+                    dependents.append(other)
+        return dependents
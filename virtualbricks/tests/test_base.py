@@ -121,6 +121,20 @@ class TestConfig(unittest.TestCase):
         self.assertIsNot(cfg, self.config2)
         self.assertIs(cfg["obj"], self.config2["obj"])
 
+    def test_shared_parameters(self):
+        """The parameters are merged once per class."""
+
+        self.assertIs(Config2().parameters, self.config2.parameters)
+        self.assertIsNot(self.config1.parameters, self.config2.parameters)
+        self.assertIsInstance(self.config1.parameters["int"], base.String)
+        self.assertIsInstance(self.config2.parameters["int"], base.Integer)
+        self.assertIs(copy.deepcopy(self.config2).parameters,
+                      self.config2.parameters)
+
+    def test_defaults_not_shared(self):
+        self.config2["int"] = 1
+        self.assertEqual(Config2()["int"], 42)
+
 
 class TestTypes(unittest.TestCase):
 
@@ -157,6 +171,15 @@ class TestTypes(unittest.TestCase):
         self.assertRaises(ValueError, spinfloat.to_string, 0.1)
         self.assertRaises(ValueError, spinfloat.from_string, "0.1")
 
+    def test_listof(self):
+        """ListOf reads back only literals, the string is not evaluated."""
+
+        listof = base.ListOf(base.String(""))
+        string = listof.to_string(["a", "b'c"])
+        self.assertEqual(listof.from_string(string), ["a", "b'c"])
+        self.assertRaises(ValueError, listof.from_string,
+                          "[__import__('os').getcwd()]")
+
 
 class TestBase(unittest.TestCase):
 
@@ -20,11 +20,12 @@ import errno
 import signal
 
 from twisted.trial import unittest
-from twisted.internet import error, defer
+from twisted.internet import error, defer, task
+from twisted.python import failure
 from twisted.test import proto_helpers
 
 from virtualbricks import errors, link, bricks
-from virtualbricks.tests import stubs, successResultOf
+from virtualbricks.tests import stubs, successResultOf, failureResultOf
 
 
 def kill(passthru, brick):
@@ -168,6 +169,38 @@ class TestBricks(unittest.TestCase):
     def test_signal_process(self):
         pass
 
+    def test_command_plan_shared(self):
+        """The plan of a class command_builder is shared by the bricks."""
+
+        other = stubs.BrickStub(self.factory, "other")
+        self.assertIs(self.brick.command_plan(), other.command_plan())
+        self.assertEqual([step[0] for step in other.command_plan().steps],
+                         ["-a", "-c", "-d"])
+
+    def test_command_plan_instance(self):
+        self.brick.command_builder = {"*a": "a", "-b": "nothere",
+                                      "-d": lambda: "*"}
+        self.assertEqual(self.brick.build_cmd_line(), ["arg1", "-d"])
+
+    def test_cmd_line_cached(self):
+        """The configuration options are converted again only if the
+        configuration changed."""
+
+        calls = []
+        config_args = bricks.CommandPlan.config_args
+
+        def record(plan, config):
+            calls.append(config)
+            return config_args(plan, config)
+
+        self.patch(bricks.CommandPlan, "config_args", record)
+        first = self.brick.build_cmd_line()
+        self.assertEqual(self.brick.build_cmd_line(), first)
+        self.assertEqual(len(calls), 1)
+        self.brick.set({"a": "new"})
+        self.assertEqual(self.brick.build_cmd_line()[:2], ["-a", "new"])
+        self.assertEqual(len(calls), 2)
+
 
 class TestVDEProcessProtocol(unittest.TestCase):
 
@@ -180,6 +213,7 @@ class TestVDEProcessProtocol(unittest.TestCase):
         brick._started_d = defer.Deferred()
         brick._exited_d = defer.Deferred()
         self.proto = bricks.VDEProcessProtocol(brick)
+        self.proto.clock = self.clock = task.Clock()
         self.transport = proto_helpers.StringTransport()
         self.transport.pid = -1
         self.proto.makeConnection(self.transport)
@@ -209,3 +243,123 @@ class TestVDEProcessProtocol(unittest.TestCase):
         self.assertEqual(len(self.proto.queue), 0)
         self.proto.data_received(self.PROMPT)
         self.assertTrue(self.transport.disconnecting)
+
+    def test_pipeline(self):
+        """
+        Up to PIPELINE_SIZE commands are sent without waiting for the ACKs.
+        """
+
+        self.proto.PIPELINE_SIZE = 2
+        for cmd in self.CMD1, self.CMD2, self.CMD1:
+            self.proto.send_command(cmd)
+        self.assertEqual(self.transport.value(),
+                         self.CMD1 + b"\n" + self.CMD2 + b"\n")
+        self.assertEqual((self.proto.in_flight, self.proto.pending), (2, 1))
+        self.proto.data_received(self.PROMPT)
+        self.assertEqual(self.proto.in_flight, 2)
+        self.assertEqual(self.proto.stats.sent, 3)
+        self.assertEqual(self.proto.stats.max_queue_len, 3)
+
+    def test_response(self):
+        """The deferred fires with the parsed response."""
+
+        d1 = self.proto.send_command(self.CMD1)
+        d2 = self.proto.send_command(self.CMD2)
+        self.proto.data_received(b"0000 DATA END WITH '.'\nline1\n.\n"
+                                 b"1000 Success\n\n" + self.PROMPT +
+                                 b"1000 Success\n\n" + self.PROMPT)
+        response = successResultOf(self, d1)
+        self.assertEqual(response, bricks.Response(1000, "Success",
+                                                   ["line1"]))
+        self.assertEqual(successResultOf(self, d2).code, 1000)
+        self.assertEqual(self.proto.stats.completed, 2)
+
+    def test_response_error(self):
+        d = self.proto.send_command(self.CMD1)
+        self.proto.data_received(b"1022 Invalid argument\n\n" + self.PROMPT)
+        fail = failureResultOf(self, d, errors.ManagementCommandError)
+        self.assertEqual(fail.value.code, 1022)
+        self.assertEqual(fail.value.message, "Invalid argument")
+
+    def test_timeout(self):
+        """
+        If the ACK is not received in time, the deferred fails but the command
+        is still waiting for its ACK.
+        """
+
+        d1 = self.proto.send_command(self.CMD1, timeout=2)
+        d2 = self.proto.send_command(self.CMD2, timeout=5)
+        self.clock.advance(2)
+        failureResultOf(self, d1, errors.ManagementTimeoutError)
+        self.assertEqual(self.proto.stats.timed_out, 1)
+        self.proto.data_received(self.PROMPT + b"\n" + self.PROMPT)
+        successResultOf(self, d2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_process_ended(self):
+        """When the process ends, the waiting commands fail."""
+
+        self.proto.PIPELINE_SIZE = 1
+        d1 = self.proto.send_command(self.CMD1)
+        d2 = self.proto.send_command(self.CMD2)
+        self.proto.processEnded(failure.Failure(error.ProcessDone(0)))
+        failureResultOf(self, d1, errors.ManagementError)
+        failureResultOf(self, d2, errors.ManagementError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class RecordingProcess(bricks.FakeProcess):
+
+    def __init__(self, brick):
+        bricks.FakeProcess.__init__(self, brick)
+        self.commands = []
+
+    def send_command(self, cmd, timeout=None):
+        self.commands.append(cmd)
+        return defer.succeed(None)
+
+
+class TestCommandCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.brick = stubs.BrickStub(stubs.FactoryStub(), "test")
+        self.brick.proc = RecordingProcess(self.brick)
+        self.clock = self.brick.coalescer.clock = task.Clock()
+
+    def test_coalesce(self):
+        """
+        Only the last command for every key is sent when the window expires.
+        """
+
+        for value in range(10):
+            self.brick.send_coalesced("delay", b"delay %d\n" % value)
+        self.brick.send_coalesced("loss", b"loss 1.0\n")
+        self.brick.send_coalesced("delay", b"delay 42\n")
+        self.assertEqual(self.brick.proc.commands, [])
+        self.clock.advance(self.brick.coalescer.WINDOW)
+        self.assertEqual(self.brick.proc.commands,
+                         [b"loss 1.0\n", b"delay 42\n"])
+        self.assertEqual(self.brick.coalescer.superseded, 10)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_flush(self):
+        self.brick.send_coalesced("delay", b"delay 1\n")
+        successResultOf(self, self.brick.coalescer.flush())
+        self.assertEqual(self.brick.proc.commands, [b"delay 1\n"])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_not_running(self):
+        """If the brick is stopped, the pending commands are dropped."""
+
+        self.brick.send_coalesced("delay", b"delay 1\n")
+        proc, self.brick.proc = self.brick.proc, None
+        self.clock.advance(self.brick.coalescer.WINDOW)
+        self.assertEqual(proc.commands, [])
+
+    def test_command_failed(self):
+        """The failures are logged, not propagated."""
+
+        self.brick.proc.send_command = lambda cmd, timeout: defer.fail(
+            errors.ManagementCommandError(1022, "Invalid argument"))
+        self.brick.send_coalesced("delay", b"delay 1\n")
+        successResultOf(self, self.brick.coalescer.flush())
@@ -20,8 +20,9 @@ import io
 
 from twisted.python import log, filepath
 
-from virtualbricks import configfile, _configparser
-from virtualbricks.tests import unittest, stubs, LoggingObserver, Skip
+from virtualbricks import configfile, imagecache, _configparser
+from virtualbricks.tests import (unittest, stubs, LoggingObserver, Skip,
+                                 patch_settings)
 
 def file_text_from_bytes(filepath):
     return filepath.getContent().decode('utf8')
@@ -68,8 +69,8 @@ class TestConfigFile(unittest.TestCase):
 
         self.assertEqual(configfile.__all__,
             ["BrickBuilder", "ConfigFile", "EventBuilder", "ImageBuilder",
-             "LinkBuilder", "SockBuilder", "log_events", "restore",
-             "safe_save", "save"])
+             "LinkBuilder", "SockBuilder", "autosave", "log_events",
+             "restore", "safe_save", "save"])
 
     def test_exported_log_events(self):
         """
@@ -83,7 +84,8 @@ class TestConfigFile(unittest.TestCase):
              configfile.cannot_restore_backup, configfile.backup_restored,
              configfile.image_found, configfile.skip_image,
              configfile.skip_image_noa, configfile.config_dump,
-             configfile.open_project, configfile.config_save_error])
+             configfile.open_project, configfile.config_save_error,
+             configfile.snapshot_save_error, configfile.snapshot_load_error])
 
     def test_restore_backup_does_not_exists(self):
         """Try to restore a backup that does not exists."""
@@ -139,6 +141,128 @@ class TestConfigFile(unittest.TestCase):
         config.restore(factory, fp)
         self.assertIsNotNone(factory.get_brick_by_name("sender"))
 
+    def test_save_incremental(self):
+        """Only the sections of the changed bricks are generated again."""
+
+        factory = stubs.Factory()
+        sw1 = factory.new_brick("switch", "sw1")
+        sw2 = factory.new_brick("switch", "sw2")
+        config = configfile.ConfigFile()
+        config.save_to(factory, io.StringIO())
+        saved = []
+        self.patch(sw1, "save_to", saved.append)
+        sw2.set({"numports": 64})
+        out = io.StringIO()
+        config.save_to(factory, out)
+        self.assertEqual(saved, [])
+        self.assertEqual(out.getvalue(),
+                         "[Switch:sw1]\n\n[Switch:sw2]\nnumports=64\n\n")
+
+    def test_save_image_renamed(self):
+        """The virtual machines refer to the images by name."""
+
+        factory = stubs.Factory()
+        image = factory.new_disk_image("test", "/test.img")
+        vm = factory.new_brick("vm", "vm")
+        vm.set_image("hda", image)
+        config = configfile.ConfigFile()
+        config.save_to(factory, io.StringIO())
+        image.set_name("renamed")
+        out = io.StringIO()
+        config.save_to(factory, out)
+        self.assertIn("hda=renamed\n", out.getvalue())
+
+    def test_save_deleted(self):
+        """The sections of the deleted bricks are dropped."""
+
+        factory = stubs.Factory()
+        sw = factory.new_brick("switch", "sw")
+        config = configfile.ConfigFile()
+        config.save_to(factory, io.StringIO())
+        factory.del_brick(sw)
+        config.save_to(factory, io.StringIO())
+        self.assertEqual(config.sections, {})
+
+    def test_autosave(self):
+        """The project is written only if it changed."""
+
+        factory = stubs.Factory()
+        factory.new_brick("switch", "sw")
+        filename = self.mktemp()
+
+        def saved(result):
+            self.assertTrue(result)
+            self.assertFalse(factory.is_dirty())
+            os.remove(filename)
+            return configfile.autosave(factory, filename)
+
+        def not_saved(result):
+            self.assertFalse(result)
+            self.assertFalse(os.path.exists(filename))
+
+        d = configfile.autosave(factory, filename)
+        d.addCallback(saved)
+        d.addCallback(not_saved)
+        return d
+
+    def test_autosave_changed_while_saving(self):
+        """A change made while the project is written is saved later."""
+
+        factory = stubs.Factory()
+        brick = factory.new_brick("switch", "sw")
+        d = configfile.autosave(factory, self.mktemp())
+        brick.set({"numports": 64})
+        d.addCallback(lambda _: self.assertTrue(factory.is_dirty()))
+        return d
+
+    def test_autosave_serialized(self):
+        """The autosave waits for the project files being written."""
+
+        factory = stubs.Factory()
+        factory.new_brick("switch", "sw")
+        filename = self.mktemp()
+        configfile._config.lock.acquire()
+        try:
+            d = configfile.autosave(factory, filename)
+            self.assertFalse(os.path.exists(filename))
+        finally:
+            configfile._config.lock.release()
+        d.addCallback(lambda _: self.assertTrue(os.path.exists(filename)))
+        return d
+
+    def test_autosave_imagecache(self):
+        """The image cache is saved with the project."""
+
+        self.patch(imagecache, "cache", imagecache.ImageCache())
+        imagecache.cache.dirty = True
+        factory = stubs.Factory()
+        factory.new_brick("switch", "sw")
+        filename = os.path.join(self.mktemp(), ".project")
+        os.mkdir(os.path.dirname(filename))
+        d = configfile.autosave(factory, filename)
+        self.assertFalse(imagecache.cache.dirty)
+
+        def saved(_):
+            path = os.path.join(os.path.dirname(filename), ".imagecache")
+            self.assertTrue(os.path.exists(path))
+            self.assertFalse(imagecache.cache.dirty)
+
+        return d.addCallback(saved)
+
+    def test_touch(self):
+        """Links and images changes make the project dirty."""
+
+        factory = stubs.Factory()
+        sw = factory.new_brick("switch", "sw")
+        vm = factory.new_brick("vm", "vm")
+        factory.saved_generation = factory.generation
+        plug = factory.new_plug(vm)
+        plug.connect(sw.socks[0])
+        self.assertTrue(factory.is_dirty())
+        factory.saved_generation = factory.generation
+        factory.new_disk_image("test", "/test.img")
+        self.assertTrue(factory.is_dirty())
+
     def _add_observer(self, event=None):
         observer = LoggingObserver()
         if event:
@@ -214,6 +338,106 @@ class TestConfigFile(unittest.TestCase):
         self.assertEqual(len(brick.plugs), 1)
 
 
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.fp = filepath.FilePath(self.mktemp())
+        self.snapshot = configfile.snapshot_path(self.fp)
+        factory = stubs.Factory()
+        sw = factory.new_brick("switch", "sw")
+        vm = factory.new_brick("vm", "vm")
+        vm.connect(sw.socks[0])
+        configfile.ConfigFile().save(factory, self.fp)
+
+    def restore(self):
+        factory = stubs.Factory()
+        configfile.ConfigFile().restore(factory, self.fp)
+        return factory
+
+    def set_numports(self, numports):
+        items = _configparser.load_snapshot(io.StringIO(
+            self.snapshot.getContent().decode()))
+        items[0].items = [("numports", numports)]
+        sio = io.StringIO()
+        _configparser.dump_snapshot(items, sio)
+        self.snapshot.setContent(sio.getvalue().encode())
+
+    def test_save(self):
+        """The snapshot has the same content of the project file."""
+
+        with open(self.fp.path) as fp:
+            expected = list(_configparser.Parser(fp))
+        with open(self.snapshot.path) as fp:
+            items = _configparser.load_snapshot(fp)
+        self.assertEqual([(i.type, i.name, i.items) for i in items[:2]],
+                         [(i.type, i.name, i.items) for i in expected[:2]])
+        self.assertEqual(items[2:], expected[2:])
+
+    def test_save_unchanged(self):
+        """The records of the unchanged objects are not parsed again."""
+
+        factory = stubs.Factory()
+        sw = factory.new_brick("switch", "sw")
+        vm = factory.new_brick("vm", "vm")
+        vm.connect(sw.socks[0])
+        factory.new_disk_image("test", "/test.img")
+        config = configfile.ConfigFile()
+        config.save(factory, self.fp)
+        expected = self.snapshot.getContent()
+        parsed = []
+        parser = _configparser.Parser
+        self.patch(_configparser, "Parser",
+                   lambda fileobj: parsed.append(fileobj) or parser(fileobj))
+        config.save(factory, self.fp)
+        self.assertEqual(parsed, [])
+        self.assertEqual(self.snapshot.getContent(), expected)
+        sw.set({"numports": 64})
+        config.save(factory, self.fp)
+        self.assertEqual(len(parsed), 1)
+        items = _configparser.load_snapshot(io.StringIO(
+            self.snapshot.getContent().decode()))
+        self.assertIn(("numports", "64"), items[1].items)
+
+    def test_save_disabled(self):
+        patch_settings(self, projectsnapshot=False)
+        configfile.ConfigFile().save(stubs.Factory(), self.fp)
+        self.assertFalse(self.snapshot.exists())
+
+    def test_restore(self):
+        """The snapshot is preferred to the project file."""
+
+        self.set_numports("64")
+        factory = self.restore()
+        self.assertEqual(factory.get_brick_by_name("sw").config["numports"],
+                         64)
+        vm = factory.get_brick_by_name("vm")
+        self.assertEqual(vm.plugs[0].sock.nickname, "sw_port")
+
+    def test_restore_older(self):
+        """If the project file was changed, the snapshot is ignored."""
+
+        self.set_numports("64")
+        st = os.stat(self.snapshot.path)
+        os.utime(self.fp.path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        factory = self.restore()
+        self.assertEqual(factory.get_brick_by_name("sw").config["numports"],
+                         32)
+
+    def test_restore_corrupted(self):
+        self.snapshot.setContent(b'{"version": 1}\n{"type": ')
+        factory = self.restore()
+        self.assertIsNot(factory.get_brick_by_name("sw"), None)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_restore_version(self):
+        """A snapshot of another version is ignored."""
+
+        self.snapshot.setContent(b'{"version": 0}\n')
+        factory = self.restore()
+        self.assertIsNot(factory.get_brick_by_name("sw"), None)
+        self.flushLoggedErrors(ValueError)
+
+
 class TestParser(unittest.TestCase):
 
     def test_iter(self):
@@ -273,6 +497,33 @@ class TestParser(unittest.TestCase):
         expected = tuple(line[:-1].split("|"))
         self.assertEqual(list(parser), [expected])
 
+    def test_no_seek(self):
+        """The file is read once, it can be a pipe."""
+
+        lines = io.StringIO(CONFIG1).readlines()
+        items = list(_configparser.Parser(iter(lines)))
+        self.assertEqual([getattr(i, "name", None) for i in items],
+                         ["martin", "sender", "wf", "sw1", None])
+        self.assertEqual(dict(items[0]),
+                         {"path": "/vimages/vtatpa.martin.qcow2"})
+
+    def test_lineno(self):
+        sio = io.StringIO("# comment\n[Switch:sw]\nnumports=32\n\n"
+                          "link|vm|sw_port|rtl8139|00:11:22:33:44:55\n")
+        section, link = _configparser.Parser(sio)
+        self.assertEqual(section.lineno, 2)
+        self.assertEqual(link.lineno, 5)
+
+    def test_invalid_line(self):
+        """An invalid line ends the section, the parameters that follow are
+        ignored."""
+
+        sio = io.StringIO("[Switch:sw]\nnumports=32\ninvalid\npath=/a\n"
+                          "[Switch:sw2]\n")
+        sw, sw2 = _configparser.Parser(sio)
+        self.assertEqual(dict(sw), {"numports": "32"})
+        self.assertEqual(dict(sw2), {})
+
 
 OLD_CONFIG_FILE = """
 [Project:/home/user/.virtualbricks.vbl]
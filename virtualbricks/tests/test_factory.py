@@ -15,8 +15,12 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import io
+import os
+
 from twisted.trial import unittest
 
+from virtualbricks import configfile
 from virtualbricks.tools import is_running
 from virtualbricks.tests import stubs, successResultOf
 from virtualbricks.errors import BrickRunningError
@@ -79,3 +83,104 @@ class TestFactory(unittest.TestCase):
         self.assertRaises(BrickRunningError, factory.del_brick, brick)
         self.assertEqual(factory.bricks, [brick])
         self.assertTrue(is_running(brick))
+
+    def test_get_brick_by_name(self):
+        factory = stubs.Factory()
+        brick = factory.new_brick("stub", "test_brick")
+        self.assertIs(factory.get_brick_by_name("test_brick"), brick)
+        factory.del_brick(brick)
+        self.assertIs(factory.get_brick_by_name("test_brick"), None)
+
+    def test_rename_brick(self):
+        """After a rename the brick is found only with the new name."""
+
+        factory = stubs.Factory()
+        brick = factory.new_brick("stub", "test_brick")
+        factory.rename(brick, "new_name")
+        self.assertIs(factory.get_brick_by_name("test_brick"), None)
+        self.assertIs(factory.get_brick_by_name("new_name"), brick)
+        self.assertTrue(factory.is_in_use("new_name"))
+        self.assertFalse(factory.is_in_use("test_brick"))
+
+    def test_get_event_by_name(self):
+        factory = stubs.Factory()
+        event = factory.new_event("test_event")
+        self.assertIs(factory.get_event_by_name("test_event"), event)
+        self.assertTrue(factory.is_in_use("test_event"))
+
+    def test_rename_switch_socks(self):
+        """The socks of a switch follow the name of the switch."""
+
+        factory = stubs.Factory()
+        switch = factory.new_brick("switch", "sw")
+        sock = switch.socks[0]
+        self.assertIs(factory.get_sock_by_name("sw_port"), sock)
+        factory.rename(switch, "sw2")
+        self.assertIs(factory.get_sock_by_name("sw_port"), None)
+        self.assertIs(factory.get_sock_by_name("sw2_port"), sock)
+
+    def test_del_brick_disconnect_plugs(self):
+        """Deleting a brick disconnects the plugs connected to its socks."""
+
+        factory = stubs.Factory()
+        switch = factory.new_brick("switch", "sw")
+        vm = factory.new_brick("vm", "vm")
+        plug = vm.add_plug(factory.get_sock_by_name("sw_port"))
+        factory.del_brick(switch)
+        self.assertIs(factory.get_sock_by_name("sw_port"), None)
+        self.assertEqual(factory.socks, [])
+        self.assertFalse(plug.configured())
+
+    def test_reset_socks(self):
+        factory = stubs.Factory()
+        factory.new_brick("switch", "sw")
+        factory.reset()
+        self.assertIs(factory.get_sock_by_name("sw_port"), None)
+        self.assertEqual(factory.socks, [])
+
+    def test_get_image_by_path(self):
+        factory = stubs.Factory()
+        path = os.path.abspath(self.mktemp())
+        image = factory.new_disk_image("test_image", path)
+        self.assertIs(factory.get_image_by_path(path), image)
+        image.set_path(path + ".new")
+        self.assertIs(factory.get_image_by_path(path), None)
+        self.assertIs(factory.get_image_by_path(path + ".new"), image)
+        factory.remove_disk_image(image)
+        self.assertIs(factory.get_image_by_path(path + ".new"), None)
+        self.assertIs(factory.get_image_by_name("test_image"), None)
+
+    def test_set_name_image(self):
+        factory = stubs.Factory()
+        image = factory.new_disk_image("test_image", self.mktemp())
+        image.set_name("new_image")
+        self.assertIs(factory.get_image_by_name("test_image"), None)
+        self.assertIs(factory.get_image_by_name("new_image"), image)
+
+    def test_bulk_load(self):
+        """While loading, a single project-loaded signal is emitted."""
+
+        factory = stubs.Factory()
+        signals = []
+        factory.connect("brick-added", signals.append)
+        factory.connect("project-loaded", signals.append)
+        with factory.bulk_load():
+            with factory.bulk_load():
+                factory.new_brick("switch", "sw1")
+            factory.new_brick("switch", "sw2")
+            self.assertEqual(signals, [])
+        self.assertEqual(signals, [factory])
+        factory.new_brick("switch", "sw3")
+        self.assertEqual(len(signals), 2)
+
+    def test_restore_links_after_bricks(self):
+        """The links are made after all the bricks are created, whatever
+        their order in the project."""
+
+        factory = stubs.Factory()
+        config = configfile.ConfigFile()
+        config.restore_from(factory, io.StringIO(
+            "link|vm|sw_port|rtl8139|00:11:22:33:44:55\n"
+            "[Qemu:vm]\n\n[Switch:sw]\n"))
+        vm = factory.get_brick_by_name("vm")
+        self.assertEqual(vm.plugs[0].sock.nickname, "sw_port")
@@ -41,3 +41,83 @@ class TestGraphics(unittest.TestCase):
     def test_brick_icon(self):
         self.assertEqual(graphics.brick_icon(self.brick),
                          GUI_PATH + "/data/stub.png")
+
+
+class Pixbuf:
+
+    def __init__(self, filename, width, height):
+        self.args = (filename, width, height)
+        self.saturation = 1.0
+
+    def saturate_and_pixelate(self, dest, saturation, pixelate):
+        dest.saturation = saturation
+
+
+class PixbufCache(graphics.PixbufCache):
+
+    def __init__(self, max_size=256):
+        graphics.PixbufCache.__init__(self, max_size)
+        self.loaded = []
+
+    def _load(self, filename, width, height):
+        self.loaded.append((filename, width, height))
+        return Pixbuf(filename, width, height)
+
+
+class TestPixbufCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = PixbufCache(max_size=2)
+        self.filename = graphics.get_data_filename("stub.png")
+
+    def test_cached(self):
+        """The icon is loaded only once."""
+
+        pixbuf = self.cache.get(self.filename, 48, 48)
+        self.assertIs(self.cache.get(self.filename, 48, 48), pixbuf)
+        self.assertEqual(len(self.cache.loaded), 1)
+
+    def test_running(self):
+        """The icon of the stopped bricks is desaturated, the running one
+        is not touched."""
+
+        running = self.cache.get(self.filename, 48, 48)
+        stopped = self.cache.get(self.filename, 48, 48, running=False)
+        self.assertEqual((running.saturation, stopped.saturation), (1.0, 0.0))
+
+    def test_lru(self):
+        """The least recently used icon is evicted."""
+
+        self.cache.get(self.filename, 16, 16)
+        self.cache.get(self.filename, 32, 32)
+        self.cache.get(self.filename, 16, 16)
+        self.cache.get(self.filename, 48, 48)
+        self.assertEqual(len(self.cache), 2)
+        self.cache.get(self.filename, 16, 16)
+        self.cache.get(self.filename, 32, 32)
+        self.assertEqual([args[1] for args in self.cache.loaded],
+                         [16, 32, 48, 32])
+
+    def test_mtime(self):
+        """The custom icons are loaded again if they change."""
+
+        filename = self.mktemp()
+        with open(filename, "w"):
+            pass
+        os.utime(filename, (0, 0))
+        self.cache.get(filename, check_mtime=True)
+        self.cache.get(filename, check_mtime=True)
+        os.utime(filename, (0, 1))
+        self.cache.get(filename, check_mtime=True)
+        self.assertEqual(len(self.cache.loaded), 2)
+
+    def test_brick(self):
+        self.patch(graphics, "icon_cache", self.cache)
+        pixbuf = graphics.pixbuf_for_brick_at_size(self.brick(), 48, 48)
+        self.assertEqual(pixbuf.args, (self.filename, 48, 48))
+        self.assertEqual(pixbuf.saturation, 0.0)
+        self.assertIs(graphics.pixbuf_for_brick_at_size(self.brick(), 48, 48),
+                      pixbuf)
+
+    def brick(self):
+        return stubs.BrickStub(stubs.FactoryStub(), "Test")
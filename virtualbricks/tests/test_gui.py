@@ -15,12 +15,14 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import threading
+
 from twisted.trial import unittest
 
 import gi
 from gi.repository import Gtk
 
-from virtualbricks import project, _settings
+from virtualbricks import project, log, _settings
 from virtualbricks.gui import gui, interfaces
 from virtualbricks.tests import stubs
 
@@ -391,3 +393,77 @@ class TestCaptureController(TestController):
         self.assert_parameter_equal("iface", "")
         self.fail("TODO")
     test_config.todo = "Implement test utility for the plugmixin"
+
+
+class TestTextBufferObserver(unittest.TestCase):
+
+    def setUp(self):
+        self.idle = []
+        self.patch(gui.GObject, "idle_add",
+                   lambda func: self.idle.append(func) or len(self.idle))
+        self.textbuffer = Gtk.TextBuffer()
+        self.textbuffer.create_mark(
+            mark_name="end",
+            where=self.textbuffer.get_end_iter(),
+            left_gravity=False
+        )
+        for name, attrs in gui.TEXT_TAGS:
+            self.textbuffer.create_tag(name, **attrs)
+        self.observer = gui.TextBufferObserver(self.textbuffer, 3)
+
+    def log(self, msg, level=log.LogLevel.info, observer=None):
+        (observer or self.observer)({
+            "log_format": msg, "log_level": level, "log_time": 0,
+            "log_namespace": "test"})
+
+    def lines(self):
+        start, end = self.textbuffer.get_bounds()
+        text = self.textbuffer.get_text(start, end, False)
+        return [line.split("] ", 1)[1] for line in text.splitlines()]
+
+    def test_batch(self):
+        """Many events are written by a single idle callback."""
+
+        self.log("first")
+        self.log("second", log.LogLevel.error)
+        self.assertEqual(len(self.idle), 1)
+        self.assertEqual(self.lines(), [])
+        self.assertFalse(self.idle.pop()())
+        self.assertEqual(self.lines(), ["first", "second"])
+        self.log("third")
+        self.assertEqual(len(self.idle), 1)
+
+    def test_tags(self):
+        self.log("first", log.LogLevel.error)
+        self.idle.pop()()
+        tag = self.textbuffer.get_tag_table().lookup("error")
+        self.assertTrue(self.textbuffer.get_start_iter().has_tag(tag))
+
+    def test_max_lines(self):
+        """Only the last lines are kept."""
+
+        for i in range(5):
+            self.log(str(i))
+        self.idle.pop()()
+        self.assertEqual(self.lines(), ["2", "3", "4"])
+        self.log("5")
+        self.idle.pop()()
+        self.assertEqual(self.lines(), ["3", "4", "5"])
+
+    def test_threads(self):
+        """The events logged by other threads are not lost."""
+
+        observer = gui.TextBufferObserver(self.textbuffer, 0)
+
+        def log_many():
+            for i in range(100):
+                self.log(str(i), observer=observer)
+
+        threads = [threading.Thread(target=log_many) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.idle), 1)
+        self.idle.pop()()
+        self.assertEqual(len(self.lines()), 400)
@@ -0,0 +1,118 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import struct
+
+from twisted.trial import unittest
+
+from virtualbricks import imagecache, tools
+
+
+BACKING_FILE = b"/var/images/base.img"
+VIRTUAL_SIZE = 10 * 1024 ** 3
+# magic, version, backing file offset and size, cluster bits, virtual size
+QCOW2_HEADER = (b"QFI\xfb" + struct.pack(">IQIIQ", 2, 32, len(BACKING_FILE),
+                                         16, VIRTUAL_SIZE) + BACKING_FILE)
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = imagecache.ImageCache()
+
+    def _create(self, data):
+        path = self.mktemp()
+        with open(path, "wb") as fp:
+            fp.write(data)
+        return path
+
+    def test_qcow2(self):
+        info = self.cache.get(self._create(QCOW2_HEADER))
+        self.assertEqual(info.get_format(), tools.ImageFormat.QCOW2)
+        self.assertEqual(info.backing_file, BACKING_FILE.decode())
+        self.assertEqual(info.virtual_size, VIRTUAL_SIZE)
+        self.assertEqual(info.size, len(QCOW2_HEADER))
+
+    def test_raw(self):
+        path = self._create(b"\x00" * 2048)
+        info = self.cache.get(path)
+        self.assertEqual(info.get_format(), tools.ImageFormat.RAW)
+        self.assertEqual(info.virtual_size, 2048)
+        self.assertRaises(tools.NotCowFileError, self.cache.get_backing_file,
+                          path)
+
+    def test_not_found(self):
+        self.assertRaises(FileNotFoundError, self.cache.get, self.mktemp())
+
+    def test_hit(self):
+        """The header is read only the first time."""
+
+        path = self._create(QCOW2_HEADER)
+        self.cache.get(path)
+        self.patch(imagecache, "read_info", None)
+        self.assertEqual(self.cache.get_backing_file(path),
+                         BACKING_FILE.decode())
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_invalidate(self):
+        """If the file changes, the metadata are read again."""
+
+        path = self._create(QCOW2_HEADER)
+        self.cache.get(path)
+        with open(path, "ab") as fp:
+            fp.write(b"\x00" * 10)
+        self.assertEqual(self.cache.get(path).size, len(QCOW2_HEADER) + 10)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_max_age(self):
+        """If the file was just checked, it is not stat'ed again."""
+
+        path = self._create(QCOW2_HEADER)
+        self.cache.get(path)
+        os.remove(path)
+        self.assertEqual(self.cache.get(path, max_age=60).virtual_size,
+                         VIRTUAL_SIZE)
+        self.assertRaises(FileNotFoundError, self.cache.get, path)
+
+    def test_eviction(self):
+        self.cache.max_entries = 1
+        self.cache.get(self._create(QCOW2_HEADER))
+        path = self._create(b"\x00" * 10)
+        self.cache.get(path)
+        self.assertEqual(len(self.cache.entries), 1)
+        self.assertEqual(list(self.cache.entries.values())[0],
+                         self.cache.get(path))
+
+    def test_save_load(self):
+        path = self._create(QCOW2_HEADER)
+        info = self.cache.get(path)
+        self.assertTrue(self.cache.dirty)
+        cachefile = self.mktemp()
+        self.cache.save(cachefile)
+        self.assertFalse(self.cache.dirty)
+        cache = imagecache.ImageCache()
+        cache.load(cachefile)
+        self.patch(imagecache, "read_info", None)
+        self.assertEqual(cache.get(path), info)
+
+    def test_load_corrupted(self):
+        """A corrupted cache file is ignored."""
+
+        self.cache.load(self._create(b"{not json"))
+        self.assertEqual(self.cache.entries, {})
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
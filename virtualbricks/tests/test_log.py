@@ -15,14 +15,21 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import io
+import json
 import logging
+import os
+import threading
+import time
+import uuid
 
 import twisted
 from twisted.trial import unittest
-from twisted.python import log as legacylog
+from twisted.python import failure, log as legacylog
+from twisted.python.logfile import LogFile
 
-from virtualbricks import log
-from virtualbricks.tests import skipUnless
+from virtualbricks import app, log
+from virtualbricks.tests import skipUnless, stubs
 
 
 logger = log.Logger()
@@ -185,3 +192,224 @@ class TestStdLogging(unittest.TestCase):
         logging.warn("test")
         self.assertEqual(len(self.observer), 1)
         self.assertIn("log_id", self.observer[0])
+
+
+class BlockingFile(io.StringIO):
+
+    def __init__(self):
+        io.StringIO.__init__(self)
+        self.writing = threading.Event()
+        self.proceed = threading.Event()
+        self.writes = []
+
+    def write(self, data):
+        self.writing.set()
+        self.proceed.wait(10)
+        self.writes.append(data)
+        return io.StringIO.write(self, data)
+
+
+class TestAsyncFileLogObserver(unittest.TestCase):
+
+    def event(self, msg):
+        return {"log_format": msg, "log_time": 0, "log_namespace": "test"}
+
+    def observer(self, fp, **kwds):
+        observer = log.AsyncFileLogObserver(fp, **kwds)
+        self.addCleanup(observer.stop)
+        return observer
+
+    def test_write(self):
+        fp = io.StringIO()
+        observer = self.observer(fp)
+        observer(self.event("first"))
+        observer(self.event("second"))
+        observer.stop()
+        lines = fp.getvalue().splitlines()
+        self.assertEqual([line.split(" ", 2)[2] for line in lines],
+                         ["[test] first", "[test] second"])
+        self.assertFalse(observer.writer._thread.is_alive())
+
+    def test_batch(self):
+        """The records queued while writing are written all together."""
+
+        fp = BlockingFile()
+        observer = self.observer(fp)
+        observer(self.event("first"))
+        fp.writing.wait(10)
+        for i in range(10):
+            observer(self.event(str(i)))
+        fp.proceed.set()
+        observer.stop()
+        self.assertEqual([data.count("\n") for data in fp.writes], [1, 10])
+
+    def test_drop(self):
+        """When the queue is full the records are dropped and counted."""
+
+        fp = BlockingFile()
+        observer = self.observer(fp, max_queue=1)
+        observer(self.event("first"))
+        fp.writing.wait(10)
+        observer(self.event("second"))
+        observer(self.event("third"))
+        self.assertEqual(observer.dropped, 1)
+        fp.proceed.set()
+        observer.stop()
+        lines = fp.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].endswith(" 1 log messages dropped"))
+        self.assertTrue(lines[2].endswith("[test] second"))
+
+    def test_rotate(self):
+        path = self.mktemp()
+        logfile = LogFile.fromFullPath(path, rotateLength=50)
+        observer = self.observer(logfile, batch_size=1)
+        for i in range(3):
+            observer(self.event("a log message of thirty bytes"))
+        observer.stop()
+        logfile.close()
+        self.assertTrue(os.path.exists(path + ".1"))
+
+
+class TestAsyncWriter(unittest.TestCase):
+
+    def test_open(self):
+        """The file opened by the writer is closed when it stops."""
+
+        files = []
+
+        def open_file():
+            files.append(io.StringIO())
+            files[0].close = lambda: files.append("closed")
+            return files[0]
+
+        writer = log.AsyncWriter(open_file)
+        writer.write("text")
+        writer.stop()
+        self.assertEqual(files[0].getvalue(), "text")
+        self.assertEqual(files[1], "closed")
+
+    def test_error(self):
+        errors = []
+        writer = log.AsyncWriter(lambda: open(self.mktemp() + "/not/exists"),
+                                 on_error=errors.append)
+        writer.write("text")
+        writer.stop()
+        errors[0].trap(FileNotFoundError)
+
+    def test_no_wait(self):
+        fp = BlockingFile()
+        writer = log.AsyncWriter(fp)
+        writer.write("text")
+        fp.writing.wait(10)
+        writer.stop(wait=False)
+        self.assertTrue(writer._thread.is_alive())
+        fp.proceed.set()
+        writer._thread.join()
+        self.assertEqual(fp.getvalue(), "text")
+
+    def test_no_wait_full(self):
+        """Stop does not block if the queue is full."""
+
+        fp = BlockingFile()
+        writer = log.AsyncWriter(fp, max_queue=1)
+        writer.poll_interval = 0.01
+        writer.write("first")
+        fp.writing.wait(10)
+        writer.write("second")
+        start = time.monotonic()
+        writer.stop(wait=False)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(writer._thread.is_alive())
+        fp.proceed.set()
+        writer._thread.join(10)
+        self.assertFalse(writer._thread.is_alive())
+        self.assertEqual(fp.getvalue(), "firstsecond")
+
+
+class Source:
+
+    def __init__(self, brick):
+        self.brick = brick
+
+
+class TestJSONLogObserver(unittest.TestCase):
+
+    def test_record(self):
+        fp = io.StringIO()
+        observer = log.JSONLogObserver(fp)
+        observer({"log_format": "{brick} {what}", "log_time": 10.5,
+                  "log_level": log.LogLevel.warn, "log_namespace": "test",
+                  "log_id": test_event.log_id, "brick": "sw1",
+                  "what": "started"})
+        self.assertEqual(json.loads(fp.getvalue()), {
+            "time": 10.5, "level": "warn", "namespace": "test",
+            "brick": "sw1", "pid": None, "event_id": str(test_event.log_id),
+            "message": "sw1 started"})
+
+    def test_process(self):
+        """The brick of the process is used if the event has none."""
+
+        fp = io.StringIO()
+        observer = log.JSONLogObserver(fp)
+        observer({"log_format": "{lines}", "lines": "out\nput",
+                  "log_level": log.LogLevel.info, "log_time": 0,
+                  "log_source": Source(stubs.StubBrick(stubs.Factory(),
+                                                       "vm")),
+                  "log_namespace": "test", "pid": 42})
+        self.assertEqual(fp.getvalue().count("\n"), 1)
+        record = json.loads(fp.getvalue())
+        self.assertEqual((record["brick"], record["pid"], record["message"]),
+                         ("vm", 42, "out\nput"))
+
+    def test_failure(self):
+        fp = io.StringIO()
+        observer = log.JSONLogObserver(fp)
+        observer({"log_format": "error", "log_time": 0,
+                  "log_failure": failure.Failure(RuntimeError("bad"))})
+        self.assertIn("RuntimeError", json.loads(fp.getvalue())["traceback"])
+
+
+class TestEventId(unittest.TestCase):
+
+    def test_cached(self):
+        """The id of an event is computed only once."""
+
+        calls = []
+        uuid5 = uuid.uuid5
+        self.patch(uuid, "uuid5", lambda *a: calls.append(a) or uuid5(*a))
+        first = log.Event("An event logged many times", module="test")
+        second = log.Event("An event logged many times", module="test")
+        self.assertEqual(first.log_id, second.log_id)
+        self.assertLessEqual(len(calls), 1)
+        other = log.Event("An event logged many times", module="other")
+        self.assertNotEqual(first.log_id, other.log_id)
+
+
+class TestOptions(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(app, "_log_file", app._log_file)
+
+    def test_logfile(self):
+        """--logfile uses the asynchronous observer by default."""
+
+        path = self.mktemp()
+        options = app.Options()
+        options.parseOptions(["--logfile", path, "--logsize", "100",
+                              "--logrotated", "3"])
+        self.assertIs(options["logger"], app.async_file_logger)
+        self.assertEqual((app._log_file.path, app._log_file.rotateLength,
+                          app._log_file.maxRotatedFiles),
+                         (os.path.abspath(path), 100, 3))
+        app._log_file.close()
+
+    def test_logsync(self):
+        options = app.Options()
+        options.parseOptions(["--logfile", "-", "--logsync"])
+        self.assertIs(options["logger"], app.file_logger)
+
+    def test_logjson(self):
+        options = app.Options()
+        options.parseOptions(["--logfile", "-", "--logjson"])
+        self.assertIs(options["logger"], app.async_json_logger)
@@ -0,0 +1,98 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from twisted.trial import unittest
+
+from virtualbricks import observable
+from virtualbricks.tests import stubs
+
+
+class TestObservable(unittest.TestCase):
+
+    def setUp(self):
+        self.observable = observable.Observable("changed")
+        self.signal = observable.Signal(self.observable, "changed")
+        self.received = []
+        self.signal.connect(self.received.append)
+
+    def test_notify(self):
+        self.signal.notify(1)
+        self.assertEqual(self.received, [1])
+
+    def test_batch(self):
+        """The notifications are delivered once, at the end of the
+        outermost batch."""
+
+        with observable.batch():
+            with observable.batch():
+                self.signal.notify(1)
+                self.signal.notify(2)
+            self.signal.notify(1)
+            self.assertEqual(self.received, [])
+        self.assertEqual(self.received, [1, 2])
+
+    def test_batch_chained(self):
+        """The notifications sent by the observers are delivered too."""
+
+        other = observable.Signal(observable.Observable(), "other")
+        other.connect(self.signal.notify)
+        with observable.batch():
+            other.notify(1)
+        self.assertEqual(self.received, [1])
+
+    def test_batch_error(self):
+        """An observer that fails does not stop the others."""
+
+        def fail(emitter):
+            raise RuntimeError()
+
+        other = observable.Signal(observable.Observable(), "other")
+        other.connect(fail)
+        with self.assertRaises(RuntimeError):
+            with observable.batch():
+                other.notify(1)
+                self.signal.notify(2)
+        self.assertEqual(self.received, [2])
+
+    def test_thaw(self):
+        thaw = self.signal.thaw()
+        with thaw:
+            with thaw:
+                self.signal.notify(1)
+            self.signal.notify(2)
+        self.signal.notify(3)
+        self.assertEqual(self.received, [3])
+
+    def test_thaw_observable(self):
+        with self.observable.thaw():
+            self.signal.notify(1)
+        self.assertEqual(self.received, [])
+
+
+class TestBatchedSet(unittest.TestCase):
+
+    def test_set(self):
+        """A brick configured in a batch is notified once."""
+
+        factory = stubs.Factory()
+        brick = factory.new_brick("switch", "sw")
+        changed = []
+        factory.connect("brick-changed", changed.append)
+        with factory.batch():
+            for numports in range(10, 20):
+                brick.set({"numports": numports})
+        self.assertEqual(changed, [brick])
@@ -0,0 +1,130 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from twisted.trial import unittest
+from twisted.internet import error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+from virtualbricks import bricks, log, output
+from virtualbricks.tests import stubs
+from virtualbricks.tests.test_log import install_observer
+
+
+class TestProcessOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.events = install_observer(self)
+        self.brick = stubs.StubBrick(stubs.Factory(), "brick")
+        self.brick.set({"outputrate": 0})
+        self.proc = bricks.Process(self.brick)
+        self.proc.clock = self.clock = task.Clock()
+        self.transport = proto_helpers.StringTransport()
+        self.transport.pid = 42
+        self.proc.transport = self.transport
+
+    def logged(self, event=output.output_lines):
+        return [e for e in self.events if e.get("log_id") == event.log_id]
+
+    def test_lines(self):
+        """The chunks are split in lines and logged together."""
+
+        self.proc.outReceived(b"first\nsec")
+        self.proc.outReceived(b"ond\nthi")
+        self.assertEqual(self.logged(), [])
+        self.clock.advance(self.proc.output.interval)
+        event, = self.logged()
+        self.assertEqual(event["lines"], "first\nsecond")
+        self.assertEqual(event["pid"], 42)
+        self.assertEqual(self.proc.output.tail(), ["first", "second"])
+
+    def test_streams(self):
+        self.proc.outReceived(b"out\n")
+        self.proc.errReceived(b"err\n")
+        self.clock.advance(self.proc.output.interval)
+        out, err = self.logged()
+        self.assertEqual(out["log_level"], log.LogLevel.info)
+        self.assertEqual((err["lines"], err["log_level"]),
+                         ("err", log.LogLevel.error))
+        self.assertTrue(err["hide_to_user"])
+
+    def test_braces(self):
+        """The output is not used as a format string."""
+
+        self.proc.outReceived(b"{not a field}\n")
+        self.clock.advance(self.proc.output.interval)
+        self.assertEqual(log.formatEvent(self.logged()[0]), "{not a field}")
+
+    def test_rate_limit(self):
+        self.proc.output.rate = 2
+        self.proc.output._tokens = 2
+        self.proc.outReceived(b"1\n2\n3\n4\n")
+        self.clock.advance(self.proc.output.interval)
+        self.assertEqual(self.logged()[0]["lines"], "1\n2")
+        dropped, = self.logged(output.output_dropped)
+        self.assertEqual(dropped["count"], 2)
+        self.assertEqual(self.proc.output.dropped, 2)
+        # the tokens are refilled
+        self.proc.outReceived(b"5\n")
+        self.clock.advance(self.proc.output.interval)
+        self.assertEqual(self.logged()[1]["lines"], "5")
+        # all the lines are kept
+        self.assertEqual(self.proc.output.tail(2), ["4", "5"])
+
+    def test_ring_buffer(self):
+        self.patch(output.ProcessOutput, "max_lines", 2)
+        self.proc = bricks.Process(self.brick)
+        self.proc.clock = self.clock
+        self.proc.transport = self.transport
+        self.proc.outReceived(b"1\n2\n3\n")
+        self.assertEqual(self.proc.output.tail(), ["2", "3"])
+        self.proc.output.flush()
+
+    def test_process_ended(self):
+        """The incomplete lines are logged when the process ends."""
+
+        self.brick._exited_d = self.brick._started_d = None
+        self.brick.process_ended = lambda proc, status: None
+        self.proc.outReceived(b"no newline")
+        self.proc.processEnded(failure.Failure(error.ProcessDone(0)))
+        self.assertEqual(self.logged()[0]["lines"], "no newline")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def sink(self, path):
+        self.brick.set({"outputlog": path})
+        proc = bricks.Process(self.brick)
+        proc.clock = self.clock
+        proc.transport = self.transport
+        return proc, proc.output._sink
+
+    def test_sink(self):
+        path = self.mktemp()
+        proc, sink = self.sink(path)
+        proc.outReceived(b"out\n")
+        proc.errReceived(b"err\npartial")
+        proc.output.close()
+        sink.stop()
+        with open(path) as fp:
+            self.assertEqual(fp.read(), "out\nerr\npartial\n")
+
+    def test_sink_error(self):
+        proc, sink = self.sink(self.mktemp() + "/not/exists")
+        proc.outReceived(b"out\n")
+        proc.output.close()
+        sink.stop()
+        self.assertEqual(len(self.flushLoggedErrors(FileNotFoundError)), 1)
+        self.assertEqual(len(self.logged()), 1)
@@ -0,0 +1,301 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+
+from twisted.trial import unittest
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+from virtualbricks import (bricks, errors, imagecache, qmp, supervisor,
+                          virtualmachines)
+from virtualbricks.tests import stubs, successResultOf, failureResultOf
+
+
+GREETING = {"QMP": {"version": {"qemu": {"major": 2, "minor": 0,
+                                         "micro": 0}},
+                    "capabilities": []}}
+
+
+class QMPTestMixin:
+
+    def connect(self):
+        self.clock = task.Clock()
+        self.proto = qmp.QMPProtocol()
+        self.proto.clock = self.clock
+        self.transport = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.transport)
+        self.receive(GREETING)
+        self.assertEqual(self.sent(), [{"execute": "qmp_capabilities",
+                                        "id": 0}])
+        self.receive({"return": {}, "id": 0})
+        self.assertTrue(self.proto.ready.called)
+        return self.proto
+
+    def receive(self, message):
+        self.proto.dataReceived(json.dumps(message).encode() + b"\r\n")
+
+    def sent(self):
+        data, = [self.transport.value()]
+        self.transport.clear()
+        return [json.loads(line) for line in data.splitlines()]
+
+
+class TestQMPProtocol(QMPTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.connect()
+
+    def test_greeting(self):
+        self.assertEqual(self.proto.greeting, GREETING["QMP"])
+
+    def test_query_status(self):
+        d = self.proto.query_status()
+        self.assertEqual(self.sent(), [{"execute": "query-status", "id": 1}])
+        self.receive({"return": {"status": "paused", "running": False,
+                                 "singlestep": False}, "id": 1})
+        self.assertEqual(successResultOf(self, d),
+                         qmp.Status("paused", False, False))
+
+    def test_answers_by_id(self):
+        """The answers are matched with the commands by id."""
+
+        d1 = self.proto.stop()
+        d2 = self.proto.cont()
+        self.receive({"return": "second", "id": 2})
+        self.receive({"return": "first", "id": 1})
+        self.assertEqual(successResultOf(self, d1), "first")
+        self.assertEqual(successResultOf(self, d2), "second")
+
+    def test_error(self):
+        d = self.proto.execute("cont")
+        self.receive({"error": {"class": "DeviceNotActive",
+                                "desc": "No VM"}, "id": 1})
+        fail = failureResultOf(self, d, errors.QMPError)
+        self.assertEqual(fail.value.error_class, "DeviceNotActive")
+
+    def test_timeout(self):
+        d = self.proto.execute("stop", timeout=5)
+        self.clock.advance(5)
+        failureResultOf(self, d, errors.ManagementTimeoutError)
+        # a late answer is ignored
+        self.receive({"return": {}, "id": 1})
+
+    def test_human_monitor_command(self):
+        d = self.proto.savevm("virtualbricks")
+        self.assertEqual(self.sent(), [{
+            "execute": "human-monitor-command",
+            "arguments": {"command-line": "savevm virtualbricks"},
+            "id": 1}])
+        self.receive({"return": "", "id": 1})
+        successResultOf(self, d)
+
+    def test_human_monitor_command_error(self):
+        """The human monitor reports errors as output."""
+
+        d = self.proto.loadvm("virtualbricks")
+        self.receive({"return": "Snapshot 'virtualbricks' does not exist\r\n",
+                      "id": 1})
+        failureResultOf(self, d, errors.QMPError)
+
+    def test_query_block(self):
+        d = self.proto.query_block()
+        self.receive({"return": [
+            {"device": "ide0-hd0", "inserted": {
+                "file": "/vm_hda.cow", "drv": "qcow2", "ro": False,
+                "backing_file": "/base.img",
+                "image": {"snapshots": [{"name": "virtualbricks"}]}}},
+            {"device": "ide1-cd0"}], "id": 1})
+        self.assertEqual(successResultOf(self, d), [
+            qmp.BlockDevice("ide0-hd0", "/vm_hda.cow", "qcow2", "/base.img",
+                            False, ["virtualbricks"]),
+            qmp.BlockDevice("ide1-cd0")])
+
+    def test_query_blockstats(self):
+        d = self.proto.query_blockstats()
+        self.receive({"return": [{"device": "ide0-hd0", "stats": {
+            "rd_bytes": 10, "wr_bytes": 20, "rd_operations": 1,
+            "wr_operations": 2, "flush_operations": 3}}], "id": 1})
+        self.assertEqual(successResultOf(self, d),
+                         [qmp.BlockStats("ide0-hd0", 10, 20, 1, 2, 3)])
+
+    def test_events(self):
+        events = []
+        self.proto.add_listener(events.append)
+        d = self.proto.wait_for_event("SHUTDOWN")
+        self.receive({"event": "STOP",
+                      "timestamp": {"seconds": 1, "microseconds": 500000}})
+        self.assertNoResult(d)
+        self.receive({"event": "SHUTDOWN", "data": {"guest": True}})
+        self.assertEqual(successResultOf(self, d),
+                         qmp.QMPEvent("SHUTDOWN", {"guest": True}))
+        self.assertEqual(events, [qmp.QMPEvent("STOP", {}, 1.5),
+                                  qmp.QMPEvent("SHUTDOWN", {"guest": True})])
+
+    def test_connection_lost(self):
+        """The commands and the waiters fail when the connection is lost."""
+
+        d1 = self.proto.stop()
+        d2 = self.proto.wait_for_event("SHUTDOWN")
+        self.proto.connectionLost(failure.Failure(error.ConnectionDone()))
+        failureResultOf(self, d1, errors.ManagementError)
+        failureResultOf(self, d2, errors.ManagementError)
+        failureResultOf(self, self.proto.execute("cont"),
+                        errors.ManagementError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class Endpoint:
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.protocol = None
+
+    def connect(self, factory):
+        if self.failures:
+            self.failures -= 1
+            return defer.fail(error.ConnectError())
+        self.protocol = factory.buildProtocol(None)
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        return defer.succeed(self.protocol)
+
+
+class TestConnect(unittest.TestCase):
+
+    def test_retry(self):
+        """The connection is retried while qemu creates the socket."""
+
+        clock = task.Clock()
+        endpoint = Endpoint(failures=2)
+        d = qmp.connect(endpoint, retries=2, delay=1, clock=clock)
+        clock.advance(1)
+        clock.advance(1)
+        self.assertNoResult(d)
+        endpoint.protocol.dataReceived(json.dumps(GREETING).encode() + b"\n")
+        endpoint.protocol.dataReceived(b'{"return": {}, "id": 0}\n')
+        self.assertIs(successResultOf(self, d), endpoint.protocol)
+
+    def test_give_up(self):
+        clock = task.Clock()
+        d = qmp.connect(Endpoint(failures=2), retries=1, delay=1, clock=clock)
+        clock.advance(1)
+        failureResultOf(self, d, error.ConnectError)
+
+
+class TestVirtualMachineQMP(QMPTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.vm = stubs.VirtualMachineStub(stubs.Factory(), "vm")
+        self.vm.proc = bricks.FakeProcess(self.vm)
+        self.vm._exited_d = defer.Deferred()
+        self.vm.qmp_endpoint = lambda: self
+
+    def connect(self, factory=None):
+        return defer.succeed(QMPTestMixin.connect(self))
+
+    def test_get_qmp(self):
+        """The connection is reused."""
+
+        client = successResultOf(self, self.vm.get_qmp())
+        self.assertIs(client, self.proto)
+        self.assertIs(successResultOf(self, self.vm.get_qmp()), client)
+
+    def test_get_qmp_not_running(self):
+        self.vm.proc = None
+        failureResultOf(self, self.vm.get_qmp(), errors.ManagementError)
+
+    def test_powerdown(self):
+        d = self.vm.poweroff()
+        self.assertEqual(self.sent(), [{"execute": "system_powerdown",
+                                        "id": 1}])
+        self.assertNoResult(d)
+
+    def test_powerdown_fallback(self):
+        """If QMP is not available, the human monitor is used."""
+
+        self.vm.qmp_endpoint = lambda: Endpoint(failures=100)
+        self.patch(qmp, "reactor", task.Clock())
+        sent = []
+        self.vm.send = sent.append
+        self.vm.poweroff()
+        qmp.reactor.pump([1] * 11)
+        self.assertEqual(sent, [b"system_powerdown\n"])
+
+    def end_process(self):
+        self.vm.process_ended(None, failure.Failure(error.ProcessDone(0)))
+
+    def supervise(self):
+        self.vm.set({"restart": supervisor.ALWAYS})
+        self.vm.factory.supervisor._clock = task.Clock()
+        return self.vm.factory.supervisor._clock
+
+    def test_powerdown_not_restarted(self):
+        """The supervisor does not restart a VM powered down by hand."""
+
+        clock = self.supervise()
+        self.vm.poweroff()
+        self.end_process()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_suspend_not_restarted(self):
+        """The supervisor does not restart a suspended VM."""
+
+        clock = self.supervise()
+        self.vm._suspend_image = lambda: "/disk.qcow2"
+        self.patch(virtualmachines.imagecache, "get_info",
+                   lambda path: imagecache.ImageInfo("QCOW2", None, 0, 0, 0))
+        self.vm.suspend()
+        self.assertEqual(self.sent(), [{"execute": "stop", "id": 1}])
+        self.receive({"return": {}, "id": 1})
+        self.assertEqual(self.sent()[0]["arguments"],
+                         {"command-line": "savevm virtualbricks"})
+        self.receive({"return": "", "id": 2})
+        self.assertEqual(self.sent(), [{"execute": "quit", "id": 3}])
+        self.end_process()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_suspend_no_image(self):
+        """A VM without a disk image cannot be suspended."""
+
+        self.vm._suspend_image = lambda: None
+        self.patch(virtualmachines.imagecache, "get_info", None)
+        failureResultOf(self, self.vm.suspend(), errors.BadConfigError)
+
+    def test_resume_running(self):
+        d = self.vm.resume()
+        self.assertEqual(self.sent(), [{"execute": "query-block", "id": 1}])
+        self.receive({"return": [{"device": "ide0-hd0", "inserted": {
+            "image": {"snapshots": [{"name": "virtualbricks"}]}}}], "id": 1})
+        self.assertEqual(self.sent()[0]["arguments"],
+                         {"command-line": "loadvm virtualbricks"})
+        self.receive({"return": "", "id": 2})
+        self.assertEqual(self.sent(), [{"execute": "cont", "id": 3}])
+        self.receive({"return": {}, "id": 3})
+        self.assertIs(successResultOf(self, d), self.vm)
+
+    def test_resume_no_snapshot(self):
+        d = self.vm.resume()
+        self.receive({"return": [{"device": "ide0-hd0"}], "id": 1})
+        failureResultOf(self, d, errors.BadConfigError)
+
+    def test_commit_disks(self):
+        d = self.vm.commit_disks()
+        self.assertEqual(self.sent()[0]["arguments"],
+                         {"command-line": "commit all"})
+        self.receive({"return": "", "id": 1})
+        successResultOf(self, d)
@@ -0,0 +1,156 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from virtualbricks import bricks, resources
+from virtualbricks.tests import stubs
+
+
+STAT = ("42 (qemu (x) 1) S 1 42 42 0 -1 4194560 100 0 0 0 {utime} {stime} "
+        "0 0 20 0 3 0 100 1000000 {rss} 18446744073709551615 0 0 0 0 0 0 0 "
+        "0 0 0 0 0 17 0 0 0 0 0 0")
+STATUS = ("Name:\tqemu\nVmHWM:\t    8192 kB\nVmSwap:\t      16 kB\n"
+          "Threads:\t3\n")
+IO = "rchar: 1\nwchar: 2\nread_bytes: 4096\nwrite_bytes: 8192\n"
+
+
+class Process:
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def signal_process(self, signo):
+        pass
+
+
+class TestResources(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = self.mktemp()
+        self.factory = stubs.Factory()
+        self.clock = task.Clock()
+        self.sampler = resources.ResourceSampler(
+            self.factory, interval=5, history=3, clock=self.clock,
+            proc=self.proc)
+        self.brick = self.factory.new_brick("_stub", "vm")
+        self.brick.proc = Process(42)
+        self.write_proc(42, 0)
+
+    def write_proc(self, pid, ticks, rss=256, io=True):
+        path = os.path.join(self.proc, str(pid))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        files = {"stat": STAT.format(utime=ticks, stime=0, rss=rss),
+                 "status": STATUS}
+        if io:
+            files["io"] = IO
+        for name, data in files.items():
+            with open(os.path.join(path, name), "w") as fp:
+                fp.write(data)
+
+    def test_read_sample(self):
+        sample = resources.read_sample(42, 10, proc=self.proc)
+        self.assertEqual(sample, resources.Sample(
+            10, 0, None, 256 * resources.PAGE_SIZE, 8192 * 1024,
+            16 * 1024, 3, 4096, 8192))
+
+    def test_read_self(self):
+        sample = resources.read_sample(os.getpid(), 0)
+        self.assertGreater(sample.rss, 0)
+        self.assertGreaterEqual(sample.threads, 1)
+
+    def test_cpu_percent(self):
+        self.sampler.start()
+        self.write_proc(42, resources.CLOCK_TICKS)
+        self.clock.advance(5)
+        self.assertEqual(self.sampler.latest(self.brick).cpu_percent, 20.0)
+        self.sampler.stop()
+
+    def test_history(self):
+        """Only the last samples are kept."""
+
+        for i in range(5):
+            self.clock.advance(1)
+            self.sampler.sample()
+        self.assertEqual([s.time for s in self.sampler.history(self.brick)],
+                         [3, 4, 5])
+
+    def test_not_running(self):
+        """The history of a brick is dropped when it stops."""
+
+        self.sampler.sample()
+        self.brick.proc = None
+        self.sampler.sample()
+        self.assertIs(self.sampler.latest(self.brick), None)
+        self.assertEqual(self.sampler.history(self.brick), [])
+
+    def test_new_process(self):
+        """A new process of the same brick starts a new history."""
+
+        self.sampler.sample()
+        self.brick.proc = Process(43)
+        self.write_proc(43, 0)
+        self.sampler.sample()
+        self.assertEqual(len(self.sampler.history(self.brick)), 1)
+        self.assertIs(self.sampler.latest(self.brick).cpu_percent, None)
+
+    def test_process_ended(self):
+        self.brick.proc = Process(44)
+        self.sampler.sample()
+        self.assertEqual(self.sampler.history(self.brick), [])
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    def test_io_not_readable(self):
+        self.patch(resources, "_read", self._no_io(resources._read))
+        self.sampler.sample()
+        self.assertIs(self.sampler.latest(self.brick).read_bytes, None)
+
+    def test_no_io_accounting(self):
+        self.write_proc(42, 0, io=False)
+        os.remove(os.path.join(self.proc, "42", "io"))
+        self.sampler.sample()
+        self.assertIs(self.sampler.latest(self.brick).write_bytes, None)
+
+    def _no_io(self, read):
+
+        def _read(path):
+            if path.endswith("io"):
+                raise PermissionError(path)
+            return read(path)
+
+        return _read
+
+    def test_fake_process(self):
+        """The bricks without a real process are not sampled."""
+
+        self.brick.proc = bricks.FakeProcess(self.brick)
+        self.sampler.sample()
+        self.assertEqual(self.sampler.top(), [])
+
+    def test_top(self):
+        other = self.factory.new_brick("_stub", "wire")
+        other.proc = Process(43)
+        self.write_proc(42, 0, rss=10)
+        self.write_proc(43, 0, rss=20)
+        self.sampler.sample()
+        self.assertEqual([b for b, s in self.sampler.top("rss")],
+                         [other, self.brick])
+        self.assertEqual(len(self.sampler.top("rss", 1)), 1)
@@ -0,0 +1,164 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from twisted.trial import unittest
+from twisted.internet import defer, error, task
+from twisted.python import failure
+
+from virtualbricks import bricks, errors, supervisor
+from virtualbricks.tests import stubs
+from virtualbricks.tests.test_topology import plug_into
+
+
+def crash(brick, status=None):
+    if status is None:
+        status = error.ProcessTerminated(1)
+    brick.proc = bricks.FakeProcess(brick)
+    brick._exited_d = defer.Deferred()
+    brick.process_ended(None, failure.Failure(status))
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.Factory()
+        self.clock = task.Clock()
+        self.supervisor = self.factory.supervisor
+        self.supervisor._clock = self.clock
+        self.switch = self.factory.new_brick("_stub", "switch")
+
+    def test_never(self):
+        """By default the bricks are not restarted."""
+
+        crash(self.switch)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertIs(self.supervisor.state(self.switch), None)
+
+    def test_on_failure(self):
+        self.switch.set({"restart": supervisor.ON_FAILURE})
+        crash(self.switch, error.ProcessDone(0))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        crash(self.switch)
+        self.assertIs(self.switch.proc, None)
+        self.clock.advance(self.supervisor.delay)
+        self.assertIsNot(self.switch.proc, None)
+        self.assertEqual(self.supervisor.state(self.switch).restarts, 1)
+
+    def test_terminated_description(self):
+        """Process passes the description of the termination as status."""
+
+        self.switch.set({"restart": supervisor.ON_FAILURE})
+        self.switch.proc = bricks.FakeProcess(self.switch)
+        self.switch._exited_d = defer.Deferred()
+        self.switch.process_ended(None, "process ended by signal 9")
+        self.clock.advance(self.supervisor.delay)
+        self.assertIsNot(self.switch.proc, None)
+
+    def test_always(self):
+        self.switch.set({"restart": supervisor.ALWAYS})
+        crash(self.switch, error.ProcessDone(0))
+        self.clock.advance(self.supervisor.delay)
+        self.assertIsNot(self.switch.proc, None)
+
+    def test_requested_stop(self):
+        """A brick stopped with poweroff() is not restarted."""
+
+        brick = stubs.BrickStub(self.factory, "brick")
+        brick.set({"restart": supervisor.ALWAYS})
+        brick.proc = bricks.FakeProcess(brick)
+        brick._exited_d = defer.Deferred()
+        brick.poweroff()
+        brick.process_ended(None, failure.Failure(error.ProcessTerminated(
+            signal=15)))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_backoff(self):
+        """The delay doubles after every crash."""
+
+        self.switch.set({"restart": supervisor.ALWAYS})
+        self.switch.poweron = lambda: defer.fail(errors.BadConfigError())
+        crash(self.switch)
+        delays = []
+        for i in range(3):
+            call, = self.clock.getDelayedCalls()
+            delays.append(call.getTime() - self.clock.seconds())
+            self.clock.advance(delays[-1])
+        self.assertEqual(delays, [1, 2, 4])
+        self.assertEqual(
+            len(self.flushLoggedErrors(errors.BadConfigError)), 3)
+
+    def test_crash_loop(self):
+        self.switch.set({"restart": supervisor.ALWAYS})
+        for i in range(self.supervisor.crash_limit):
+            crash(self.switch)
+            self.clock.advance(self.supervisor.delay * 2 ** i)
+        crash(self.switch)
+        self.assertTrue(self.supervisor.state(self.switch).crash_loop)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertIs(self.switch.proc, None)
+
+    def test_crash_loop_manual_start(self):
+        """A brick in a crash loop started by hand is supervised again."""
+
+        self.switch.set({"restart": supervisor.ALWAYS})
+        for i in range(self.supervisor.crash_limit + 1):
+            crash(self.switch)
+            self.clock.advance(self.supervisor.delay * 2 ** i)
+        self.switch._started_d = defer.Deferred()
+        self.switch.process_started(None)
+        self.assertFalse(self.supervisor.state(self.switch).crash_loop)
+        crash(self.switch)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_crash_window(self):
+        """The crashes older than crash_window are forgotten."""
+
+        self.switch.set({"restart": supervisor.ALWAYS})
+        crash(self.switch)
+        self.clock.advance(self.supervisor.crash_window)
+        crash(self.switch)
+        self.assertEqual(len(self.supervisor.state(self.switch).crashes), 1)
+
+    def test_deleted(self):
+        """The pending restart is cancelled if the brick is removed."""
+
+        self.switch.set({"restart": supervisor.ALWAYS})
+        crash(self.switch)
+        self.factory.del_brick(self.switch)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_dependents(self):
+        """When a brick comes back, the bricks plugged into it are
+        restarted."""
+
+        wire = self.factory.new_brick("_stub", "wire")
+        unsupervised = self.factory.new_brick("_stub", "other")
+        plug_into(self.factory, wire, self.switch)
+        plug_into(self.factory, unsupervised, self.switch)
+        for brick in self.switch, wire:
+            brick.set({"restart": supervisor.ON_FAILURE})
+        wire.poweron()
+        unsupervised.poweron()
+        self.assertEqual(self.supervisor.dependents(self.switch), [wire])
+        restarted = []
+        poweroff = wire.poweroff
+        wire.poweroff = lambda **kw: restarted.append(wire) or poweroff()
+        crash(self.switch)
+        self.clock.advance(self.supervisor.delay)
+        self.assertEqual(restarted, [wire])
+        self.assertIsNot(wire.proc, None)
+        self.assertIsNot(self.switch.proc, None)
@@ -40,10 +40,10 @@ class TestSwitch(unittest.TestCase):
     def test_live_management_callbacks(self):
         sw = switches.Switch(stubs.FactoryStub(), "test_switch")
         output = []
-        sw.send = output.append
+        sw.send_coalesced = lambda key, cmd: output.append(cmd)
         sw.set({"numports": 33})
         self.assertEqual(len(output), 1)
-        self.assertEqual(output[0], "port/setnumports 33\n")
+        self.assertEqual(output[0], b"port/setnumports 33\n")
         sw.config["numports"] = 33
         self.assertEqual(len(output), 1)
 
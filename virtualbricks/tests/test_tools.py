@@ -19,8 +19,10 @@ import os
 import os.path
 import struct
 
+from twisted.internet import defer, task
+
 from virtualbricks import tools
-from virtualbricks.tests import unittest
+from virtualbricks.tests import unittest, patch_settings
 
 
 class MockLock(object):
@@ -102,3 +104,55 @@ class TestTools(unittest.TestCase):
         self.assertEqual("123.0 MB", tools.fmtsize(123 * 1024 ** 2))
         self.assertEqual("10.0 GB", tools.fmtsize(10200 * 1024 ** 2))
         self.assertEqual("321.0 GB", tools.fmtsize(321 * 1024 ** 3))
+
+
+class TestFsync(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.batcher = tools.FsyncBatcher(self.clock)
+        self.dir = self.mktemp()
+        os.mkdir(self.dir)
+
+    def _file(self, name):
+        path = os.path.join(self.dir, name)
+        open(path, "w").close()
+        return path
+
+    def test_fsync_paths(self):
+        missing = os.path.join(self.dir, "missing")
+        errors = tools.fsync_paths([self._file("a"), missing])
+        self.assertEqual(list(errors), [missing])
+
+    def test_batch(self):
+        """The paths requested together are flushed in one batch."""
+
+        calls = []
+
+        def fsync_paths(paths):
+            calls.append(sorted(paths))
+            return {}
+
+        self.patch(tools, "fsync_paths", fsync_paths)
+        a, b = self._file("a"), self._file("b")
+        d1 = self.batcher.fsync(a)
+        d2 = self.batcher.fsync(b)
+        self.assertEqual(calls, [])
+        self.clock.advance(self.batcher.DELAY)
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(lambda _: self.assertEqual(calls, [[a, b]]))
+        return d
+
+    def test_error(self):
+        """Only the deferreds of the paths that cannot be flushed fail."""
+
+        good = self.batcher.fsync(self._file("a"))
+        bad = self.batcher.fsync(os.path.join(self.dir, "missing"))
+        self.clock.advance(self.batcher.DELAY)
+        self.assertFailure(bad, OSError)
+        return defer.gatherResults([good, bad])
+
+    def test_opt_out(self):
+        patch_settings(self, fsync=False)
+        self.assertIs(self.successResultOf(tools.fsync("/nonexistent")),
+                      None)
@@ -0,0 +1,254 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from virtualbricks import errors, topology, virtualmachines
+from virtualbricks.tests import stubs, successResultOf, failureResultOf
+
+
+def plug_into(factory, brick, upstream):
+    sock = factory.new_sock(upstream, upstream.name + "_port")
+    plug = factory.new_plug(brick)
+    brick.plugs.append(plug)
+    plug.connect(sock)
+
+
+class TestTopology(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.Factory()
+        self.switch = self.factory.new_brick("_stub", "switch")
+        self.wire = self.factory.new_brick("_stub", "wire")
+        self.vm = self.factory.new_brick("_stub", "vm")
+        plug_into(self.factory, self.wire, self.switch)
+        plug_into(self.factory, self.vm, self.wire)
+
+    def test_dependencies(self):
+        """The upstream bricks are included in the graph."""
+
+        graph = topology.dependencies([self.vm])
+        self.assertEqual(graph, {self.vm: set([self.wire]),
+                                 self.wire: set([self.switch]),
+                                 self.switch: set()})
+
+    def test_levels(self):
+        graph = topology.dependencies(self.factory.bricks)
+        self.assertEqual(topology.levels(graph),
+                         [[self.switch], [self.wire], [self.vm]])
+
+    def test_levels_self_plug(self):
+        """A brick plugged to itself does not form a loop."""
+
+        plug_into(self.factory, self.switch, self.switch)
+        graph = topology.dependencies([self.switch])
+        self.assertEqual(topology.levels(graph), [[self.switch]])
+
+    def test_loop(self):
+        plug_into(self.factory, self.switch, self.vm)
+        graph = topology.dependencies(self.factory.bricks)
+        self.assertRaises(errors.LinkLoopError, topology.levels, graph)
+        failureResultOf(self, self.factory.start_all(concurrency=1),
+                        errors.LinkLoopError)
+
+    def test_start(self):
+        reports = successResultOf(self, topology.start([self.vm], 1,
+                                                       task.Clock()))
+        self.assertEqual([r.brick for r in reports],
+                         [self.switch, self.wire, self.vm])
+        self.assertTrue(all(r.success for r in reports))
+        self.assertTrue(all(b.proc is not None for b in self.factory.bricks))
+
+    def test_start_upstream_failed(self):
+        """If a brick fails to start, the bricks that depend on it are not
+        started."""
+
+        self.wire.poweron = lambda: defer.fail(errors.BadConfigError())
+        reports = successResultOf(self, topology.start(self.factory.bricks, 1,
+                                                       task.Clock()))
+        self.assertEqual([r.success for r in reports], [True, False, False])
+        reports[1].failure.trap(errors.BadConfigError)
+        reports[2].failure.trap(errors.NotConnectedError)
+        self.assertIs(self.vm.proc, None)
+
+    def test_concurrency(self):
+        """At most concurrency bricks are started at the same time."""
+
+        clock = task.Clock()
+        started = []
+        bricks = [self.factory.new_brick("_stub", "b%d" % i)
+                  for i in range(3)]
+
+        def poweron(brick):
+            d = task.deferLater(clock, 1, lambda: brick)
+            started.append(brick)
+            return d
+
+        for brick in bricks:
+            brick.poweron = lambda brick=brick: poweron(brick)
+        d = topology.start(bricks, 2, clock)
+        self.assertEqual(len(started), 2)
+        clock.advance(1)
+        self.assertEqual(len(started), 3)
+        clock.advance(1)
+        reports = successResultOf(self, d)
+        self.assertEqual([r.elapsed for r in reports], [1, 1, 1])
+
+
+class HangingBrick(stubs.StubBrick):
+    """A brick that ignores the gentle poweroff."""
+
+    def __init__(self, factory, name):
+        stubs.StubBrick.__init__(self, factory, name)
+        self.calls = []
+        self._exited_d = defer.Deferred()
+
+    def poweroff(self, kill=False):
+        self.calls.append(kill)
+        if kill:
+            self.proc = None
+            exited, self._exited_d = self._exited_d, None
+            exited.callback((self, None))
+            return defer.succeed((self, None))
+        return self._exited_d
+
+
+class TestStop(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.Factory()
+        self.switch = self.factory.new_brick("_stub", "switch")
+        self.vm = self.factory.new_brick("_stub", "vm")
+        plug_into(self.factory, self.vm, self.switch)
+
+    def test_stop_order(self):
+        """Consumers are stopped before the bricks they are plugged into."""
+
+        successResultOf(self, self.factory.start_all(concurrency=1))
+        reports = successResultOf(self, topology.stop(
+            self.factory.bricks, 1, clock=task.Clock()))
+        self.assertEqual([r.brick for r in reports], [self.vm, self.switch])
+        self.assertTrue(all(r.success for r in reports))
+        self.assertEqual([r.escalations for r in reports], [0, 0])
+
+    def test_stop_not_running(self):
+        """Bricks not running are not reported."""
+
+        reports = successResultOf(self, topology.stop(
+            self.factory.bricks, 1, clock=task.Clock()))
+        self.assertEqual(reports, [])
+
+    def test_escalate(self):
+        """If a brick does not stop in time, it is killed."""
+
+        clock = task.Clock()
+        brick = HangingBrick(self.factory, "hanging")
+        brick.poweron()
+        d = topology.stop([brick], 1, {"Stub2": 3}, clock)
+        self.assertEqual(brick.calls, [False])
+        clock.advance(3)
+        self.assertEqual(brick.calls, [False, True])
+        report, = successResultOf(self, d)
+        self.assertTrue(report.success)
+        self.assertEqual(report.escalations, 1)
+        self.assertEqual(report.elapsed, 3)
+
+    def test_timeout(self):
+        """If a brick does not stop at all, a failure is reported."""
+
+        clock = task.Clock()
+        brick = HangingBrick(self.factory, "hanging")
+        brick.poweron()
+        brick.poweroff_escalation = ({}, )
+        d = topology.stop([brick], 1, {"Stub2": 3}, clock)
+        clock.advance(3)
+        report, = successResultOf(self, d)
+        self.assertFalse(report.success)
+        report.failure.trap(defer.TimeoutError)
+
+
+class TestPrepare(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.Factory()
+        self.pending = {}
+        self.vms = [self.new_vm("vm1", "hda", "hdb"),
+                    self.new_vm("vm2", "hda")]
+
+    def new_vm(self, name, *devices):
+        vm = stubs.VirtualMachineStub(self.factory, name)
+        for device in devices:
+            vm.config["private" + device] = True
+            disk = vm.config[device]
+            disk.image = virtualmachines.Image("base", "/images/base.img")
+            disk._basefolder = lambda: "/project"
+            disk._ensure_private_image_cow = self.ensure
+        return vm
+
+    def ensure(self, path):
+        self.pending[path] = defer.Deferred()
+        return self.pending[path]
+
+    def test_private_disks(self):
+        """Only the private disks with an image are prepared."""
+
+        self.vms[1].config["hda"].image = None
+        switch = self.factory.new_brick("_stub", "switch")
+        disks = topology.private_disks(self.vms + [switch])
+        self.assertEqual([(d.vm.name, d.device) for d in disks],
+                         [("vm1", "hda"), ("vm1", "hdb")])
+
+    def test_bounded(self):
+        """At most concurrency qemu-img run at the same time."""
+
+        progress = []
+        d = topology.prepare(self.vms, 2, lambda *a: progress.append(a[:2]),
+                             task.Clock())
+        self.assertEqual(sorted(self.pending),
+                         ["/project/vm1_hda.cow", "/project/vm1_hdb.cow"])
+        self.pending.pop("/project/vm1_hdb.cow").callback(None)
+        self.assertEqual(sorted(self.pending), ["/project/vm1_hda.cow",
+                                                "/project/vm2_hda.cow"])
+        self.pending["/project/vm1_hda.cow"].callback(None)
+        self.pending["/project/vm2_hda.cow"].errback(RuntimeError())
+        reports = successResultOf(self, d)
+        self.assertEqual(progress, [(1, 3), (2, 3), (3, 3)])
+        self.assertEqual([r.path for r in reports],
+                         ["/project/vm1_hdb.cow", "/project/vm1_hda.cow",
+                          None])
+        self.assertEqual([r.success for r in reports], [True, True, False])
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    def test_running_skipped(self):
+        """The disks of a running virtual machine are in use."""
+
+        self.vms[0].proc = object()
+        reports = topology.prepare(self.vms[:1], 1, clock=task.Clock())
+        self.assertEqual(successResultOf(self, reports), [])
+
+    def test_shared(self):
+        """A virtual machine started while its disks are prepared waits for
+        the same qemu-img process."""
+
+        disk = self.vms[1].config["hda"]
+        d = topology.prepare(self.vms[1:], 1, clock=task.Clock())
+        path = disk.disk_image_path()
+        self.assertEqual(list(self.pending), ["/project/vm2_hda.cow"])
+        self.pending["/project/vm2_hda.cow"].callback(None)
+        self.assertEqual(successResultOf(self, path), "/project/vm2_hda.cow")
+        self.assertTrue(successResultOf(self, d)[0].success)
@@ -0,0 +1,82 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import stat
+
+from twisted.trial import unittest
+from twisted.internet import defer, error
+from twisted.python import failure
+
+from virtualbricks import tunnels, tools
+from virtualbricks.tests import stubs
+
+
+# echo password | sha1sum
+PASSWORD_KEY = b"c8fed00eb2e87f1cee8e90ebbe870c190ac3848c  -\n"
+
+
+class TestTunnelListen(unittest.TestCase):
+
+    def setUp(self):
+        self.runtime = self.mktemp()
+        self.patch(os, "environ", dict(os.environ,
+                                       XDG_RUNTIME_DIR=self.runtime))
+        self.tunnel = tunnels.TunnelListen(stubs.Factory(), "tunnel")
+        self.tunnel.config["password"] = "password"
+        self.tunnel.prog = lambda: "vde_cryptcab"
+
+    def test_write_key(self):
+        path = tunnels.write_key("project", "tunnel", "password")
+        self.assertEqual(path, os.path.join(self.runtime, "virtualbricks",
+                                            "project", "tunnel_tunnel.key"))
+        with open(path, "rb") as fp:
+            self.assertEqual(fp.read(), PASSWORD_KEY)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode), 0o700)
+
+    def test_runtime_dir_permissions(self):
+        """The permissions of an existing runtime directory are fixed."""
+
+        path = os.path.join(self.runtime, "virtualbricks", "project")
+        os.makedirs(path, 0o755)
+        os.chmod(path, 0o755)
+        self.assertEqual(tools.runtime_dir("project"), path)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o700)
+
+    def test_args(self):
+
+        def check(args):
+            self.assertEqual(args[:3], ["vde_cryptcab", "-P",
+                                        self.tunnel._key_path])
+            self.assertTrue(os.path.exists(self.tunnel._key_path))
+
+        return self.tunnel.args().addCallback(check)
+
+    def test_key_removed(self):
+        """The key is removed when the process ends."""
+
+        def process_ended(args):
+            path = self.tunnel._key_path
+            self.tunnel._exited_d = defer.Deferred()
+            self.tunnel.process_ended(None, failure.Failure(
+                error.ProcessDone(0)))
+            self.assertFalse(os.path.exists(path))
+            self.assertIs(self.tunnel._key_path, None)
+
+        return self.tunnel.args().addCallback(process_ended)
@@ -42,6 +42,8 @@ def disks(vm):
 ARGS = ["true", "-m", "64", "-smp", "1", "@@DRIVESARGS@@", "-name", "vm",
         "-net", "none", "-mon", "chardev=mon", "-chardev",
         "socket,id=mon,path=/home/marco/.virtualbricks/vm.mgmt,server,nowait",
+        "-mon", "chardev=qmp,mode=control", "-chardev",
+        "socket,id=qmp,path=/home/marco/.virtualbricks/vm.qmp,server,nowait",
         "-mon", "chardev=mon_cons", "-chardev", "stdio,id=mon_cons,signal=off"]
 
 
@@ -255,7 +257,7 @@ class TestDisk(unittest.TestCase):
         self.image = vm.Image(name='debian8', path='/var/images/debian8.img')
         self.disk.set_image(self.image)
 
-    @patch('virtualbricks.virtualmachines.sync')
+    @patch('virtualbricks.virtualmachines.fsync')
     @patch('virtualbricks.virtualmachines.getQemuOutputAndValue')
     def test_create_new_disk_image_differential(
             self, mock_getQemuOutputAndValue, mock_sync):
@@ -286,12 +288,12 @@ class TestDisk(unittest.TestCase):
             ],
             os.environ
         )
-        mock_sync.assert_called_once_with()
+        mock_sync.assert_called_once_with(NEW_DISK_IMAGE)
         result = self.successResultOf(d)
         # Whatever is the return from sync, the deferred fires None.
         self.assertIsNone(result)
 
-    @patch('virtualbricks.virtualmachines.sync')
+    @patch('virtualbricks.virtualmachines.fsync')
     @patch('virtualbricks.virtualmachines.getQemuOutputAndValue')
     def test_create_new_disk_image_differential_error_qemu_img(
             self, mock_getQemuOutputAndValue, mock_sync):
@@ -315,7 +317,7 @@ class TestDisk(unittest.TestCase):
         )
         mock_sync.assert_not_called()
 
-    @patch('virtualbricks.virtualmachines.sync')
+    @patch('virtualbricks.virtualmachines.fsync')
     @patch('virtualbricks.virtualmachines.getQemuOutputAndValue')
     def test_create_new_disk_image_differential_error_sync(
             self, mock_getQemuOutputAndValue, mock_sync):
@@ -344,7 +346,7 @@ class TestDisk(unittest.TestCase):
             ],
             os.environ
         )
-        mock_sync.assert_called_once_with()
+        mock_sync.assert_called_once_with(NEW_DISK_IMAGE)
         # The error from sync is returned unchanged
         self.failureResultOf(d).check(FAIL.type)
 
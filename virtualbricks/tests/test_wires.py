@@ -95,8 +95,9 @@ class TestNetemu(unittest.TestCase):
             side_effect=self.netemu.cbset_delay)
         self.netemu.cbset_delayr = mock.Mock(name="cbset_delayr",
             side_effect=self.netemu.cbset_delayr)
-        self.netemu.send = mock.Mock(name="send")
+        self.netemu.send_coalesced = mock.Mock(name="send_coalesced")
         self.netemu.set(config)
         self.netemu.cbset_delay.assert_called_once_with(1)
         self.netemu.cbset_delayr.assert_called_once_with(2)
-        self.netemu.send.assert_called_once_with("delay 1\n")
+        self.netemu.send_coalesced.assert_called_once_with("delay",
+                                                           b"delay 1\n")
@@ -25,10 +25,13 @@ import random
 import re
 from functools import update_wrapper, wraps
 import tempfile
+import stat
 import struct
 
 from twisted.internet import defer
+from twisted.internet import threads
 from twisted.internet import utils
+from twisted.python import failure
 import constantly as constants
 
 from virtualbricks import log
@@ -395,22 +398,179 @@ def is_running(brick):
     return brick.__isrunning__()
 
 
-def sync():
+def _fsync(path, directory=False):
+    flags = os.O_RDONLY
+    if directory:
+        flags |= os.O_DIRECTORY
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_paths(paths):
+    """
+    Flush to disk the given files and, once each, their directories, so
+    that both the content and the directory entries are durable. Return a
+    dict mapping the paths that cannot be flushed to the exception.
+
+    This function does I/O, do not call it from the reactor thread.
+
+    :type paths: Iterable[str]
+    :rtype: Dict[str, Exception]
+    """
+
+    errors = {}
+    directories = {}
+    for path in paths:
+        try:
+            _fsync(path)
+        except OSError as e:
+            errors[path] = e
+        else:
+            directories.setdefault(os.path.dirname(os.path.abspath(path)),
+                                   []).append(path)
+    for directory, children in directories.items():
+        try:
+            _fsync(directory, directory=True)
+        except OSError as e:
+            for path in children:
+                errors[path] = e
+    return errors
+
+
+class FsyncBatcher:
+    """
+    Flush files to disk in batches, instead of calling the global sync.
+
+    The paths requested inside DELAY seconds from the first one, for
+    example the private COW images created while starting a group of
+    virtual machines, are flushed together in a thread and their common
+    directories are flushed only once.
+    """
+
+    DELAY = 0.05
+
+    def __init__(self, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.pending = {}
+        self.call = None
+
+    def fsync(self, path):
+        """
+        Flush the file and its directory to disk. Return a deferred that
+        fires with None when done or fails with OSError.
+
+        :type path: str
+        :rtype: twisted.internet.defer.Deferred[None]
+        """
+
+        deferred = defer.Deferred()
+        self.pending.setdefault(path, []).append(deferred)
+        if self.call is None:
+            self.call = self.clock.callLater(self.DELAY, self.flush)
+        return deferred
+
+    def flush(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        pending, self.pending = self.pending, {}
+        d = threads.deferToThread(fsync_paths, list(pending))
+
+        def fire(result):
+            for path, deferreds in pending.items():
+                for deferred in deferreds:
+                    if isinstance(result, failure.Failure):
+                        deferred.errback(result)
+                    elif path in result:
+                        deferred.errback(result[path])
+                    else:
+                        deferred.callback(None)
+
+        return d.addBoth(fire)
+
+
+_fsync_batcher = None
+
+
+def fsync(path):
     """
-    Run the sync command wrapped in a deferred. Raise RuntimeError if the
-    command fails.
+    Make durable a newly created file with a batched fsync of the file and
+    its directory, see FsyncBatcher. Do nothing if the "fsync" setting is
+    disabled.
 
+    :type path: str
     :rtype: twisted.internet.defer.Deferred[None]
     """
 
-    def complain_on_error(command_info):
-        stdout, stderr, exit_status = command_info
-        if exit_status != 0:
-            raise RuntimeError(f'sync failed\n{stderr}')
+    global _fsync_batcher
+
+    if not settings.get("fsync"):
+        return defer.succeed(None)
+    if _fsync_batcher is None:
+        _fsync_batcher = FsyncBatcher()
+    return _fsync_batcher.fsync(path)
+
+
+def runtime_dir(project_name):
+    """
+    Return the private directory for the runtime files of a project, i.e.
+    ${XDG_RUNTIME_DIR}/virtualbricks/<project> or, if XDG_RUNTIME_DIR is not
+    set, a directory in the temporary directory private to the user. The
+    directories are created if needed and are accessible only by the user.
+
+    This function does I/O, do not call it from the reactor thread.
 
-    deferred = utils.getProcessOutputAndValue('sync', env=os.environ)
-    deferred.addCallback(complain_on_error)
-    return deferred
+    :type project_name: str
+    :rtype: str
+    :raises PermissionError: if the directory is owned by another user.
+    """
+
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if base:
+        base = os.path.join(base, "virtualbricks")
+    else:
+        base = os.path.join(tempfile.gettempdir(),
+                            "virtualbricks-%d" % os.getuid())
+    path = os.path.join(base, project_name)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    # makedirs is subject to the umask and ignores the existing directories
+    for directory in base, path:
+        st = os.lstat(directory)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+            raise PermissionError(errno.EPERM, os.strerror(errno.EPERM),
+                                  directory)
+        if stat.S_IMODE(st.st_mode) != 0o700:
+            os.chmod(directory, 0o700)
+    return path
+
+
+def write_private_file(path, data):
+    """
+    Atomically replace path with data. The file is readable only by the
+    user and it is flushed to disk, alone, before being renamed.
+
+    This function does I/O, do not call it from the reactor thread.
+
+    :type path: str
+    :type data: bytes
+    """
+
+    tmp = path + ".tmp"
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW
+    fd = os.open(tmp, flags, 0o600)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
 
 
 def discard_first_arg(func, *args, **kwds):
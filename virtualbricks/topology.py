@@ -0,0 +1,417 @@
+# -*- test-case-name: virtualbricks.tests.test_topology -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Start and stop a set of bricks following the plug -> sock dependencies.
+
+A brick depends on the bricks that own the socks its plugs are connected to,
+so switches are started before the bricks plugged into them and are stopped
+after them.
+
+The private disks of the virtual machines can be prepared ahead of the start
+so that starting them only spawns qemu.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from virtualbricks import errors, log, settings
+from virtualbricks.bricks import Brick
+from virtualbricks.tools import is_running
+from virtualbricks.virtualmachines import is_virtualmachine
+
+
+if False:  # pyflakes
+    _ = str
+
+
+__all__ = ["BrickReport", "DEFAULT_STOP_TIMEOUT", "DiskReport",
+           "STOP_TIMEOUTS", "dependencies", "levels", "prepare",
+           "private_disks", "start", "stop"]
+
+# Seconds given to a brick to stop before escalating to the next step
+DEFAULT_STOP_TIMEOUT = 5.0
+STOP_TIMEOUTS = {
+    "Qemu": 30.0,
+}
+
+logger = log.Logger()
+level_starting = log.Event("Starting {count} bricks at level {depth}")
+upstream_failed = log.Event("Skipping {brick}: upstream brick {upstream} "
+                            "failed to start")
+level_stopping = log.Event("Stopping {count} bricks at level {depth}")
+escalate_stop = log.Event("{brick} did not stop in {timeout} seconds, "
+                          "escalating")
+loop_on_stop = log.Event("Loop link detected, stopping all bricks together")
+preparing_disks = log.Event("Preparing {count} private disks")
+disk_prepared = log.Event("[{done}/{total}] {vm} {device} ready in "
+                          "{elapsed:.2f} seconds")
+disk_prepare_failed = log.Event("[{done}/{total}] Cannot prepare {vm} "
+                                "{device}")
+
+
+@dataclass
+class BrickReport:
+
+    brick: Any
+    success: bool
+    elapsed: float
+    failure: Optional[Any] = None
+    escalations: int = 0
+
+
+@dataclass
+class DiskReport:
+
+    disk: Any
+    success: bool
+    elapsed: float
+    path: Optional[str] = None
+    failure: Optional[Any] = None
+
+
+def _upstream(brick):
+    for plug in brick.plugs:
+        if plug.configured():
+            upstream = plug.sock.brick
+            # a brick can be plugged to itself, i.e. a vm connected to one of
+            # its socks, and the hostonly sock has a fake brick.
+            if upstream is not brick and isinstance(upstream, Brick):
+                yield upstream
+
+
+def dependencies(bricks):
+    """
+    Return the dependency graph of the given bricks as a dict mapping every
+    brick to the set of bricks it depends on. The bricks that the given
+    bricks depend on are included in the graph too.
+
+    :type bricks: Iterable[virtualbricks.bricks.Brick]
+    :rtype: Dict[virtualbricks.bricks.Brick,
+                 Set[virtualbricks.bricks.Brick]]
+    """
+
+    graph = {}
+    pending = list(bricks)
+    while pending:
+        brick = pending.pop()
+        if brick not in graph:
+            graph[brick] = set(_upstream(brick))
+            pending.extend(graph[brick])
+    return graph
+
+
+def levels(graph):
+    """
+    Sort topologically the dependency graph. Return a list of levels, every
+    brick of a level depends only on bricks of the previous levels.
+
+    :type graph: Dict[virtualbricks.bricks.Brick,
+                      Set[virtualbricks.bricks.Brick]]
+    :rtype: List[List[virtualbricks.bricks.Brick]]
+    :raises LinkLoopError: if the graph contains a cycle.
+    """
+
+    indegree = dict((brick, len(deps)) for brick, deps in graph.items())
+    dependents = dict((brick, []) for brick in graph)
+    for brick, deps in graph.items():
+        for dep in deps:
+            dependents[dep].append(brick)
+    current = [brick for brick, degree in indegree.items() if degree == 0]
+    result = []
+    while current:
+        result.append(current)
+        following = []
+        for brick in current:
+            for dependent in dependents[brick]:
+                indegree[dependent] -= 1
+                if indegree[dependent] == 0:
+                    following.append(dependent)
+        current = following
+    looped = sorted(b.name for b, degree in indegree.items() if degree > 0)
+    if looped:
+        raise errors.LinkLoopError(
+            _("Loop link detected between: %s") % ", ".join(looped))
+    return result
+
+
+def _start_brick(brick, clock):
+    started = clock.seconds()
+
+    def report(result):
+        elapsed = clock.seconds() - started
+        if isinstance(result, failure.Failure):
+            return BrickReport(brick, False, elapsed, result)
+        return BrickReport(brick, True, elapsed)
+
+    return defer.maybeDeferred(brick.poweron).addBoth(report)
+
+
+def _start_level(level, graph, failed, semaphore, clock):
+    deferreds = []
+    for brick in level:
+        broken = [dep for dep in graph[brick] if dep in failed]
+        if broken:
+            logger.warn(upstream_failed, brick=brick.name,
+                        upstream=broken[0].name)
+            error = errors.NotConnectedError(
+                _("Cannot start '%s': upstream brick '%s' not started") %
+                (brick.name, broken[0].name))
+            report = BrickReport(brick, False, 0.0, failure.Failure(
+                error))
+            deferreds.append(defer.succeed(report))
+        else:
+            deferreds.append(semaphore.run(_start_brick, brick, clock))
+    return defer.gatherResults(deferreds)
+
+
+def start(bricks, concurrency=None, clock=None):
+    """
+    Start the bricks, and the bricks they depend on, level by level. The
+    bricks of the same level are started in parallel but at most concurrency
+    bricks are started at the same time. The bricks whose dependencies
+    failed are not started.
+
+    Return a deferred that fires with a list of BrickReport, one for each
+    brick, in starting order or fails with LinkLoopError if the bricks are
+    connected in a loop.
+
+    :type bricks: Iterable[virtualbricks.bricks.Brick]
+    :type concurrency: Optional[int]
+    :type clock: Optional[twisted.internet.interfaces.IReactorTime]
+    :rtype: twisted.internet.defer.Deferred[List[BrickReport]]
+    """
+
+    if concurrency is None:
+        concurrency = int(settings.get("startconcurrency"))
+    if clock is None:
+        from twisted.internet import reactor as clock
+    graph = dependencies(bricks)
+    try:
+        plan = levels(graph)
+    except errors.LinkLoopError:
+        return defer.fail()
+    semaphore = defer.DeferredSemaphore(max(concurrency, 1))
+    reports = []
+    failed = set()
+
+    def next_level(_, i, level):
+        logger.debug(level_starting, count=len(level), depth=i)
+        return _start_level(level, graph, failed, semaphore, clock)
+
+    def collect(level_reports):
+        reports.extend(level_reports)
+        failed.update(r.brick for r in level_reports if not r.success)
+
+    deferred = defer.succeed(None)
+    for i, level in enumerate(plan):
+        deferred.addCallback(next_level, i, level)
+        deferred.addCallback(collect)
+    deferred.addCallback(lambda _: reports)
+    return deferred
+
+
+class _BrickStopper:
+    """
+    Stop a brick walking through its poweroff escalation steps. Every step
+    has timeout seconds to succeed before the next step is tried.
+    """
+
+    def __init__(self, brick, timeout, clock):
+        self.brick = brick
+        self.timeout = timeout
+        self.clock = clock
+        self.steps = list(brick.poweroff_escalation)
+        self.escalations = -1
+        self.call = None
+        self.started = clock.seconds()
+        self.deferred = defer.Deferred()
+
+    def stop(self):
+        self._next_step()
+        return self.deferred
+
+    def _next_step(self):
+        self.call = None
+        if not self.steps:
+            self._done(failure.Failure(defer.TimeoutError(
+                _("Cannot stop '%s'") % self.brick.name)))
+            return
+        self.escalations += 1
+        if self.escalations:
+            logger.warn(escalate_stop, brick=self.brick.name,
+                        timeout=self.timeout)
+        self.call = self.clock.callLater(self.timeout, self._next_step)
+        d = defer.maybeDeferred(self.brick.poweroff, **self.steps.pop(0))
+        d.addCallbacks(self._exited, self._done)
+
+    def _exited(self, result):
+        self._done(result)
+        # the deferred is shared with the other callers of poweroff()
+        return result
+
+    def _done(self, result):
+        if self.deferred.called:
+            return
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        elapsed = self.clock.seconds() - self.started
+        escalations = max(self.escalations, 0)
+        if isinstance(result, failure.Failure):
+            report = BrickReport(self.brick, False, elapsed, result,
+                                 escalations)
+        else:
+            report = BrickReport(self.brick, True, elapsed,
+                                 escalations=escalations)
+        self.deferred.callback(report)
+
+
+def _stop_brick(brick, timeouts, clock):
+    timeout = timeouts.get(brick.get_type(), DEFAULT_STOP_TIMEOUT)
+    return _BrickStopper(brick, timeout, clock).stop()
+
+
+def stop(bricks, concurrency=None, timeouts=None, clock=None):
+    """
+    Stop the running bricks in reverse dependency order, the bricks plugged
+    into a switch are stopped before the switch itself. At most concurrency
+    bricks are stopped at the same time. If a brick does not stop in time,
+    the next, harsher, step of its poweroff escalation is tried (for example
+    TERM, then KILL).
+
+    Return a deferred that fires with a list of BrickReport, one for each
+    running brick, in stopping order.
+
+    :type bricks: Iterable[virtualbricks.bricks.Brick]
+    :type concurrency: Optional[int]
+    :param timeouts: per brick type timeouts that override STOP_TIMEOUTS.
+    :type timeouts: Optional[Dict[str, float]]
+    :type clock: Optional[twisted.internet.interfaces.IReactorTime]
+    :rtype: twisted.internet.defer.Deferred[List[BrickReport]]
+    """
+
+    if concurrency is None:
+        concurrency = int(settings.get("stopconcurrency"))
+    if clock is None:
+        from twisted.internet import reactor as clock
+    timeouts = dict(STOP_TIMEOUTS, **(timeouts or {}))
+    running = [brick for brick in bricks if is_running(brick)]
+    graph = dependencies(running)
+    try:
+        plan = levels(graph)
+    except errors.LinkLoopError:
+        logger.warn(loop_on_stop)
+        plan = [list(graph)]
+    targets = set(running)
+    plan = [[b for b in level if b in targets] for level in reversed(plan)]
+    semaphore = defer.DeferredSemaphore(max(concurrency, 1))
+    reports = []
+
+    def next_level(_, i, level):
+        logger.debug(level_stopping, count=len(level), depth=i)
+        return defer.gatherResults(
+            [semaphore.run(_stop_brick, b, timeouts, clock) for b in level])
+
+    deferred = defer.succeed(None)
+    for i, level in enumerate(filter(None, plan)):
+        deferred.addCallback(next_level, i, level)
+        deferred.addCallback(reports.extend)
+    deferred.addCallback(lambda _: reports)
+    return deferred
+
+
+def private_disks(bricks):
+    """
+    Return the private disks, with an image, of the virtual machines that
+    are not running. The disks of the running virtual machines are in use
+    and must not be touched.
+
+    :type bricks: Iterable[virtualbricks.bricks.Brick]
+    :rtype: List[virtualbricks.virtualmachines.Disk]
+    """
+
+    return [disk for brick in bricks
+            if is_virtualmachine(brick) and not is_running(brick)
+            for disk in brick.disks()
+            if disk.image is not None and disk.is_cow()]
+
+
+def _prepare_disk(disk, clock):
+    started = clock.seconds()
+
+    def report(result):
+        elapsed = clock.seconds() - started
+        if isinstance(result, failure.Failure):
+            return DiskReport(disk, False, elapsed, failure=result)
+        return DiskReport(disk, True, elapsed, result)
+
+    return defer.maybeDeferred(disk.prepare).addBoth(report)
+
+
+def prepare(bricks, concurrency=None, progress=None, clock=None):
+    """
+    Create, or validate, the private COW images of the given virtual
+    machines ahead of their start. At most concurrency qemu-img processes
+    run at the same time. A disk that cannot be prepared does not stop the
+    others, it will be tried again when its virtual machine starts.
+
+    progress, if given, is called with the number of disks done, the total
+    number of disks and the DiskReport every time a disk is done.
+
+    Return a deferred that fires with a list of DiskReport, one for each
+    disk, in completion order.
+
+    :type bricks: Iterable[virtualbricks.bricks.Brick]
+    :type concurrency: Optional[int]
+    :type progress: Optional[Callable[[int, int, DiskReport], None]]
+    :type clock: Optional[twisted.internet.interfaces.IReactorTime]
+    :rtype: twisted.internet.defer.Deferred[List[DiskReport]]
+    """
+
+    if concurrency is None:
+        concurrency = int(settings.get("prepareconcurrency"))
+    if clock is None:
+        from twisted.internet import reactor as clock
+    disks = private_disks(bricks)
+    total = len(disks)
+    logger.debug(preparing_disks, count=total)
+    semaphore = defer.DeferredSemaphore(max(concurrency, 1))
+    reports = []
+
+    def done(report):
+        reports.append(report)
+        if report.success:
+            logger.info(disk_prepared, done=len(reports), total=total,
+                        vm=report.disk.vm.name, device=report.disk.device,
+                        elapsed=report.elapsed)
+        else:
+            logger.failure(disk_prepare_failed, report.failure,
+                           done=len(reports), total=total,
+                           vm=report.disk.vm.name, device=report.disk.device)
+        if progress is not None:
+            progress(len(reports), total, report)
+
+    deferreds = [semaphore.run(_prepare_disk, disk, clock).addCallback(done)
+                 for disk in disks]
+    deferred = defer.gatherResults(deferreds)
+    deferred.addCallback(lambda _: reports)
+    return deferred
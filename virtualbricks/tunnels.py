@@ -16,19 +16,45 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import errno
+import hashlib
 import os
 
-from virtualbricks import bricks, link, log
+from twisted.internet import threads
+
+from virtualbricks import bricks, link, log, project, tools
 from virtualbricks.spawn import abspath_vde
 
 
 logger = log.Logger()
-pwdgen_exit = log.Event("Command pwdgen exited with {code}")
+key_written = log.Event("Tunnel key written to {path}")
+remove_key_error = log.Event("Cannot remove tunnel key {path}")
 
 if False:  # pyflakes
     _ = str
 
 
+def write_key(project_name, name, password):
+    """
+    Write the key file of the tunnel in the runtime directory of the project
+    and return its path. The key is the same produced by
+    `echo password | sha1sum`.
+
+    This function does I/O, do not call it from the reactor thread.
+
+    :type project_name: str
+    :type name: str
+    :type password: str
+    :rtype: str
+    """
+
+    path = os.path.join(tools.runtime_dir(project_name),
+                        "tunnel_%s.key" % name)
+    digest = hashlib.sha1(password.encode("utf-8") + b"\n").hexdigest()
+    tools.write_private_file(path, ("%s  -\n" % digest).encode("ascii"))
+    return path
+
+
 class TunnelListenConfig(bricks.Config):
 
     parameters = {"password": bricks.String(""),
@@ -39,12 +65,14 @@ class TunnelListen(bricks.Brick):
 
     type = "TunnelListen"
     config_factory = TunnelListenConfig
+    _key_path = None
     command_builder = {"-s": None,
                        "#password": "password",
                        "-p": "port"}
 
     def __init__(self, factory, name):
         bricks.Brick.__init__(self, factory, name)
+        self.command_builder = dict(self.command_builder)
         self.command_builder["-s"] = self.sock_path
         self.plugs.append(link.Plug(self))
 
@@ -67,22 +95,29 @@ class TunnelListen(bricks.Brick):
         return bool(self.plugs[0].sock)
 
     def args(self):
-        # TODO: port to utils.getProcessOutput
-        pwdgen = "echo %s | sha1sum >/tmp/tunnel_%s.key && sync" % (
-            self.config["password"], self.name)
-        exitstatus = os.system(pwdgen)
-        logger.info(pwdgen_exit, code=exitstatus)
-        res = []
-        res.append(self.prog())
-        res.append("-P")
-        res.append("/tmp/tunnel_%s.key" % self.name)
-        for arg in self.build_cmd_line():
-            res.append(arg)
-        return res
-
-    #def post_poweroff(self):
-    #    os.unlink("/tmp/tunnel_%s.key" % self.name)
-    #    pass
+        if project.manager.current is not None:
+            project_name = project.manager.current.name
+        else:
+            project_name = "default"
+        d = threads.deferToThread(write_key, project_name, self.name,
+                                  self.config["password"])
+        d.addCallback(self._key_written)
+        return d
+
+    def _key_written(self, path):
+        logger.debug(key_written, path=path)
+        self._key_path = path
+        return [self.prog(), "-P", path] + self.build_cmd_line()
+
+    def process_ended(self, proc, status):
+        path, self._key_path = self._key_path, None
+        if path is not None:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    logger.failure(remove_key_error, path=path)
+        bricks.Brick.process_ended(self, proc, status)
 
 
 class TunnelConnectConfig(TunnelListenConfig):
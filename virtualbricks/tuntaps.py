@@ -87,8 +87,7 @@ class Tap(PrivilegedBrick):
     def __init__(self, factory, name):
         bricks.Brick.__init__(self, factory, name)
         self.plugs.append(link.Plug(self))
-        self.command_builder["-s"] = self.sock_path
-        self.command_builder["*tap"] = self.get_name
+        self.command_builder = {"-s": self.sock_path, "*tap": self.get_name}
 
     def sock_path(self):
         if self.plugs[0].sock:
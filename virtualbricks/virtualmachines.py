@@ -26,13 +26,15 @@ import re
 import shutil
 import warnings
 
-from twisted.internet import defer
+from twisted.internet import defer, endpoints, reactor
 from twisted.internet.utils import getProcessOutput
+from twisted.python import failure
 
-from virtualbricks import errors, tools, settings, bricks, log, project
+from virtualbricks import (errors, tools, settings, bricks, log, project, qmp,
+                           imagecache)
 from virtualbricks.spawn import abspath_qemu, encode_proc_output, qemu_img
 from virtualbricks.observable import Event, Observable
-from virtualbricks.tools import NotCowFileError, discard_first_arg, sync
+from virtualbricks.tools import NotCowFileError, discard_first_arg, fsync
 
 
 if False:
@@ -59,6 +61,17 @@ own_err = log.Event("plug {plug} does not belong to {brick}")
 acquire_lock = log.Event("Aquiring disk locks")
 release_lock = log.Event("Releasing disk locks")
 search_usb = log.Event('Searching USB devices')
+qmp_fallback = log.Event("QMP unavailable ({error}), sending {command} to "
+                         "the human monitor")
+suspend_vm = log.Event("Suspending {vm}")
+resume_vm = log.Event("Resuming {vm}")
+
+# the name of the snapshot used to suspend and resume a virtual machine
+SUSPEND_POINT = "virtualbricks"
+# seconds given to savevm, loadvm and commit, they copy the whole state
+SNAPSHOT_TIMEOUT = 600.0
+# seconds the size of an image is trusted without checking the file again
+SIZE_MAX_AGE = 2.0
 
 
 @dataclass
@@ -318,9 +331,11 @@ class Image:
         :rtype: str
         """
 
-        if not self.exists():
+        try:
+            info = imagecache.get_info(self.path, SIZE_MAX_AGE)
+        except OSError:
             return '0B'
-        return sizeof_fmt(os.path.getsize(self.path))
+        return sizeof_fmt(info.size)
 
     def exists(self):
         return os.path.exists(self.path)
@@ -398,6 +413,10 @@ def move(src, dst):
             raise
 
 
+# private images being created or validated, path -> waiting deferreds
+_preparing = {}
+
+
 class Disk:
 
     @property
@@ -439,6 +458,9 @@ class Disk:
 
     def set_image(self, image):
         self.image = image
+        # the image is saved in the section of the virtual machine
+        self.vm.revision += 1
+        self.vm.factory.touch()
 
     def acquire(self):
         self.lock_image()
@@ -485,8 +507,8 @@ class Disk:
             "-F", settings.get('cowfmt'), filename
         ]
         deferred = qemu_img(args)
-        deferred.addCallback(discard_first_arg(sync))
-        # Always return None, independently of the return from sync
+        deferred.addCallback(discard_first_arg(fsync, filename))
+        # Always return None, independently of the return from fsync
         deferred.addCallback(lambda _: None)
         return deferred
 
@@ -516,7 +538,7 @@ class Disk:
         except Exception:
             return defer.fail()
         try:
-            backing_file = tools.get_backing_file(image_file)
+            backing_file = imagecache.get_backing_file(image_file)
         except FileNotFoundError:
             # TODO
             # logger.debug(new_private_image_file, image_file=image_file)
@@ -557,6 +579,37 @@ class Disk:
         filename = f'{self.vm.name}_{self.device}.cow'
         return os.path.join(self._basefolder(), filename)
 
+    def prepare(self):
+        """
+        Create or validate the private image of this disk. Concurrent calls
+        for the same private image wait for the same qemu-img process, so a
+        virtual machine started while its disks are being prepared does not
+        create them twice.
+
+        :return: the path of the private image.
+        :rtype: twisted.internet.defer.Deferred[str]
+        """
+
+        assert self.image is not None
+
+        path = self.get_cow_path()
+        deferred = defer.Deferred()
+        waiters = _preparing.get(path)
+        if waiters is not None:
+            waiters.append(deferred)
+        else:
+            _preparing[path] = [deferred]
+
+            def done(result):
+                for waiter in _preparing.pop(path):
+                    if isinstance(result, failure.Failure):
+                        waiter.errback(result)
+                    else:
+                        waiter.callback(path)
+
+            self._ensure_private_image_cow(path).addBoth(done)
+        return deferred
+
     def get_real_disk_name(self):
         return self.disk_image_path()
 
@@ -576,10 +629,7 @@ class Disk:
             # XXX: this should be really an error
             return defer.succeed('No image file set for this disk')
         if self.is_cow():
-            private_image_path = self.get_cow_path()
-            deferred = self._ensure_private_image_cow(private_image_path)
-            deferred.addCallback(lambda _: private_image_path)
-            return deferred
+            return self.prepare()
         else:
             return defer.succeed(self.image.path)
 
@@ -837,9 +887,14 @@ class VirtualMachine(bricks.Brick):
     config_factory = VirtualMachineConfig
     process_protocol = bricks.Process
     default_arg0 = 'qemu-system-x86_64'
+    # ACPI powerdown first, then TERM and KILL
+    poweroff_escalation = ({}, {"term": True}, {"kill": True})
+
+    _qmp = None
 
     def __init__(self, factory, name):
         bricks.Brick.__init__(self, factory, name)
+        self._qmp_waiters = []
         self._observable.add_event("image-changed")
         self.image_changed = Event(self._observable, 'image-changed')
         self.config["name"] = name
@@ -896,13 +951,156 @@ class VirtualMachine(bricks.Brick):
             return defer.succeed((self, self._last_status))
         elif not any((kill, term)):
             self.logger.info(powerdown, vm=self)
-            self.send(b"system_powerdown\n")
+            self._stop_requested = True
+            d = self.get_qmp()
+            d.addCallback(lambda client: client.system_powerdown())
+            d.addErrback(self._hmp_fallback, b"system_powerdown")
             return self._exited_d
         if term:
             return bricks.Brick.poweroff(self)
         else:
             return bricks.Brick.poweroff(self, kill)
 
+    def process_ended(self, proc, status):
+        self._qmp = None
+        bricks.Brick.process_ended(self, proc, status)
+
+    # QMP
+
+    def qmp_path(self):
+        return "%s/%s.qmp" % (settings.VIRTUALBRICKS_HOME, self.name)
+
+    def qmp_endpoint(self):
+        return endpoints.UNIXClientEndpoint(reactor, self.qmp_path())
+
+    def get_qmp(self):
+        """
+        Return a deferred that fires with the QMP client connected to the
+        running virtual machine. The connection is opened the first time
+        and then reused.
+
+        :rtype: twisted.internet.defer.Deferred[qmp.QMPProtocol]
+        """
+
+        if self.proc is None:
+            return defer.fail(errors.ManagementError(
+                _("Cannot connect to '%s': not running") % self.name))
+        if self._qmp is not None and self._qmp.connected:
+            return defer.succeed(self._qmp)
+        deferred = defer.Deferred()
+        self._qmp_waiters.append(deferred)
+        if len(self._qmp_waiters) == 1:
+            qmp.connect(self.qmp_endpoint()).addBoth(self._qmp_connected)
+        return deferred
+
+    def _qmp_connected(self, result):
+        if not isinstance(result, failure.Failure):
+            self._qmp = result
+        waiters, self._qmp_waiters = self._qmp_waiters, []
+        for deferred in waiters:
+            if isinstance(result, failure.Failure):
+                deferred.errback(result)
+            else:
+                deferred.callback(result)
+
+    def _hmp_fallback(self, fail, command):
+        # qemu does not answer on the QMP socket, i.e. it is still starting,
+        # use the human monitor on stdio
+        self.logger.warn(qmp_fallback, command=command,
+                         error=fail.getErrorMessage())
+        self.send(command + b"\n")
+
+    def _suspend_image(self):
+        img = self.config["hda"]
+        if img.is_cow():
+            return img.get_cow_path()
+        elif img.image:
+            return img.image.path
+        return None
+
+    def suspend(self):
+        """
+        Save the state of the virtual machine in the SUSPEND_POINT snapshot
+        of its first disk and stop it. Return a deferred that fires when the
+        virtual machine is stopped.
+
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        path = self._suspend_image()
+        image_format = None
+        if path is not None:
+            try:
+                image_format = imagecache.get_info(path).get_format()
+            except OSError:
+                pass
+        if image_format not in (tools.ImageFormat.QCOW2,
+                                tools.ImageFormat.QCOW3):
+            return defer.fail(errors.BadConfigError(
+                _("Suspend/Resume not supported on this disk.")))
+        self.logger.info(suspend_vm, vm=self)
+
+        def connection_lost(fail):
+            # qemu can close the connection before answering to quit
+            if fail.check(errors.QMPError):
+                self._stop_requested = False
+                return fail
+            fail.trap(errors.ManagementError)
+
+        def quit(client):
+            # the virtual machine must not be restarted by the supervisor
+            self._stop_requested = True
+            return client.quit().addErrback(connection_lost)
+
+        def save(client):
+            d = client.stop()
+            d.addCallback(lambda _: client.savevm(SUSPEND_POINT,
+                                                  SNAPSHOT_TIMEOUT))
+            d.addCallback(lambda _: quit(client))
+            return d
+
+        d = self.get_qmp()
+        d.addCallback(save)
+        d.addCallback(lambda _: self._exited_d or (self, self._last_status))
+        return d
+
+    def resume(self):
+        """
+        Restore the state saved by suspend(). If the virtual machine is not
+        running it is started from the snapshot.
+
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        self.logger.info(resume_vm, vm=self)
+        if self.proc is not None:
+            return self.get_qmp().addCallback(self._loadvm)
+        path = self._suspend_image()
+        if path is None:
+            return defer.fail(errors.BadConfigError(
+                _("Suspend/Resume not supported on this disk.")))
+
+        def check(chain):
+            snapshots = chain[0].get("snapshots", ())
+            if SUSPEND_POINT not in (s["name"] for s in snapshots):
+                raise errors.BadConfigError(_("Cannot find suspend point."))
+            return self.poweron(SUSPEND_POINT)
+
+        return imagecache.cached_qemu_img_info(path).addCallback(check)
+
+    def _loadvm(self, client):
+
+        def check(devices):
+            if not any(SUSPEND_POINT in dev.snapshots for dev in devices):
+                raise errors.BadConfigError(_("Cannot find suspend point."))
+            return client.loadvm(SUSPEND_POINT, SNAPSHOT_TIMEOUT)
+
+        d = client.query_block()
+        d.addCallback(check)
+        d.addCallback(lambda _: client.cont())
+        d.addCallback(lambda _: self)
+        return d
+
     def get_parameters(self):
         try:
             command = self.prog()
@@ -945,47 +1143,14 @@ class VirtualMachine(bricks.Brick):
         return d
 
     def __args(self, results):
+        machine, display, boot = self.cached_args("qemu", self.__config_args)
         res = [self.prog()]
-        if (self.config['kvm'] or self.config['machine'] or
-                self.config['kvmsm']):
-            props = []
-            if self.config["machine"]:
-                props.append('type={}'.format(self.config["machine"]))
-            if self.config['kvm']:
-                props.append('accel=kvm:tcg')
-            if self.config["kvmsm"]:
-                props.append(
-                    'kvm_shadow_mem={}'.format(self.config["kvmsmem"])
-                )
-            res.extend(['-machine', ','.join(props)])
-
-        if self.config["cpu"]:
-            res.extend(["-cpu", self.config["cpu"]])
-        res.extend(list(self.build_cmd_line()))
-        if self.config["novga"]:
-            res.extend(["-display", "none"])
+        res.extend(machine)
+        res.extend(self.build_cmd_line())
+        res.extend(display)
         for disk_args in results:
             res.extend(disk_args)
-        if self.config["kernelenbl"] and self.config["kernel"]:
-            res.extend(["-kernel", self.config["kernel"]])
-        if self.config["initrdenbl"] and self.config["initrd"]:
-            res.extend(["-initrd", self.config["initrd"]])
-        if (self.config["kopt"] and self.config["kernelenbl"] and
-                self.config["kernel"]):
-            res.extend([
-                "-append",
-                "'{0}'".format(re.sub("\"", "", self.config["kopt"]))
-            ])
-        if self.config["gdb"]:
-            res.extend(["-gdb", "tcp::%d" % self.config["gdbport"]])
-        if self.config["vnc"]:
-            res.extend(["-vnc", ":%d" % self.config["vncN"]])
-        if self.config["vga"]:
-            res.extend(["-vga", "std"])
-
-        if self.config["usbmode"]:
-            for usb_dev in self.config["usbdevlist"]:
-                res.extend(['-usbdevice', f'host:{usb_dev.id}'])
+        res.extend(boot)
 
         res.extend(["-name", self.name])
         if not self.plugs and not self.socks:
@@ -1027,17 +1192,59 @@ class VirtualMachine(bricks.Brick):
         res.extend(["-mon", "chardev=mon", "-chardev",
                     "socket,id=mon,path=%s,server,nowait" %
                     self.console(),
+                    "-mon", "chardev=qmp,mode=control", "-chardev",
+                    "socket,id=qmp,path=%s,server,nowait" %
+                    self.qmp_path(),
                     "-mon", "chardev=mon_cons", "-chardev",
                     "stdio,id=mon_cons,signal=off"])
         return res
 
+    def __config_args(self):
+        # the arguments that depend only on the configuration, before and
+        # after the disks
+        config = self.config
+        machine = []
+        if config["kvm"] or config["machine"] or config["kvmsm"]:
+            props = []
+            if config["machine"]:
+                props.append("type={}".format(config["machine"]))
+            if config["kvm"]:
+                props.append("accel=kvm:tcg")
+            if config["kvmsm"]:
+                props.append("kvm_shadow_mem={}".format(config["kvmsmem"]))
+            machine.extend(["-machine", ",".join(props)])
+        if config["cpu"]:
+            machine.extend(["-cpu", config["cpu"]])
+
+        display = []
+        if config["novga"]:
+            display.extend(["-display", "none"])
+
+        boot = []
+        if config["kernelenbl"] and config["kernel"]:
+            boot.extend(["-kernel", config["kernel"]])
+        if config["initrdenbl"] and config["initrd"]:
+            boot.extend(["-initrd", config["initrd"]])
+        if config["kopt"] and config["kernelenbl"] and config["kernel"]:
+            boot.extend([
+                "-append", "'{0}'".format(re.sub("\"", "", config["kopt"]))
+            ])
+        if config["gdb"]:
+            boot.extend(["-gdb", "tcp::%d" % config["gdbport"]])
+        if config["vnc"]:
+            boot.extend(["-vnc", ":%d" % config["vncN"]])
+        if config["vga"]:
+            boot.extend(["-vga", "std"])
+        if config["usbmode"]:
+            for usb_dev in config["usbdevlist"]:
+                boot.extend(["-usbdevice", f"host:{usb_dev.id}"])
+        return tuple(machine), tuple(display), tuple(boot)
+
     def add_sock(self, mac=None, model=None):
-        s = self.factory.new_sock(self)
-        sock = VMSock(s)
         vlan = len(self.plugs) + len(self.socks)
-        sock.path = "{0}/{1.brick.name}_sock_eth{2}[]".format(
-            settings.VIRTUALBRICKS_HOME, sock, vlan)
-        sock.nickname = "{0.brick.name}_sock_eth{1}".format(sock, vlan)
+        nickname = "{0}_sock_eth{1}".format(self.name, vlan)
+        sock = VMSock(self.factory.new_sock(self, nickname))
+        sock.path = "{0}/{1}[]".format(settings.VIRTUALBRICKS_HOME, nickname)
         self.socks.append(sock)
         if mac:
             sock.mac = mac
@@ -1068,9 +1275,16 @@ class VirtualMachine(bricks.Brick):
         except ValueError:
             self.logger.error(own_err, plug=plug, brick=self)
 
-    def commit_disks(self, args):
-        # XXX: fixme
-        self.send("commit all\n")
+    def commit_disks(self, device="all"):
+        """
+        Commit the changes of the COW disks to their backing images.
+
+        :type device: str
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        return self.get_qmp().addCallback(
+            lambda client: client.commit(device, SNAPSHOT_TIMEOUT))
 
     def acquire(self):
         """Acquire locks on images if needed."""
@@ -1096,7 +1310,7 @@ class VirtualMachine(bricks.Brick):
             yield self.config[hd]
 
     def set_image(self, disk, image):
-        self.config[disk].image = image
+        self.config[disk].set_image(image)
         if not self._restore:
             self._observable.notify("image-changed", (self, image))
 
@@ -156,17 +156,21 @@ class Netemu(Wire):
             if right_to_left in attrs:
                 self.config[right_to_left] = attrs.pop(right_to_left)
 
-    # callbacks for live-management
+    # callbacks for live-management, the commands are coalesced so that
+    # dragging a slider sends only the last value
 
     def cbset_chanbufsize(self, value):
         if self.config["chanbufsizesymm"]:
-            self.send(b"chanbufsize %d\n" % (value,))
+            self.send_coalesced("chanbufsize",
+                                b"chanbufsize %d\n" % (value,))
         else:
-            self.send(b"chanbufsize LR %d\n" % (value,))
+            self.send_coalesced("chanbufsize LR",
+                                b"chanbufsize LR %d\n" % (value,))
 
     def cbset_chanbufsizer(self, value):
         if not self.config["chanbufsizesymm"]:
-            self.send(b"chanbufsize RL %d\n" % (value,))
+            self.send_coalesced("chanbufsize RL",
+                                b"chanbufsize RL %d\n" % (value,))
 
     def cbset_chanbufsizesymm(self, value):
         self.cbset_chanbufsize(self.config["chanbufsize"])
@@ -174,13 +178,13 @@ class Netemu(Wire):
 
     def cbset_delay(self, value):
         if self.config["delaysymm"]:
-            self.send(b"delay %d\n" % (value,))
+            self.send_coalesced("delay", b"delay %d\n" % (value,))
         else:
-            self.send(b"delay LR %d\n" % (value,))
+            self.send_coalesced("delay LR", b"delay LR %d\n" % (value,))
 
     def cbset_delayr(self, value):
         if not self.config["delaysymm"]:
-            self.send(b"delay RL %d\n" % (value,))
+            self.send_coalesced("delay RL", b"delay RL %d\n" % (value,))
 
     def cbset_delaysymm(self, value):
         self.cbset_delay(self.config["delay"])
@@ -188,13 +192,13 @@ class Netemu(Wire):
 
     def cbset_loss(self, value):
         if self.config["losssymm"]:
-            self.send(b"loss %f\n" % (value,))
+            self.send_coalesced("loss", b"loss %f\n" % (value,))
         else:
-            self.send(b"loss LR %f\n" % (value,))
+            self.send_coalesced("loss LR", b"loss LR %f\n" % (value,))
 
     def cbset_lossr(self, value):
         if not self.config["losssymm"]:
-            self.send(b"loss RL %f\n" % (value,))
+            self.send_coalesced("loss RL", b"loss RL %f\n" % (value,))
 
     def cbset_losssymm(self, value):
         self.cbset_loss(self.config["loss"])
@@ -202,13 +206,15 @@ class Netemu(Wire):
 
     def cbset_bandwidth(self, value):
         if self.config["bandwidthsymm"]:
-            self.send(b"bandwidth %d\n" % (value,))
+            self.send_coalesced("bandwidth", b"bandwidth %d\n" % (value,))
         else:
-            self.send(b"bandwidth LR %d\n" % (value,))
+            self.send_coalesced("bandwidth LR",
+                                b"bandwidth LR %d\n" % (value,))
 
     def cbset_bandwidthr(self, value):
         if not self.config["bandwidthsymm"]:
-            self.send(b"bandwidth RL %d\n" % (value,))
+            self.send_coalesced("bandwidth RL",
+                                b"bandwidth RL %d\n" % (value,))
 
     def cbset_bandwidthsymm(self, value):
         self.cbset_bandwidth(self.config["bandwidth"])